@@ -7,10 +7,18 @@ Solution: Load model AFTER fork (lazy loading per worker)
 
 import os
 import sys
+import atexit
+import threading
+import time
+import shutil
+import zipfile
 import tempfile
 import base64
 import io
+import json
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from PIL import Image
@@ -25,11 +33,37 @@ os.environ['TF_NUM_INTRAOP_THREADS'] = '1'
 os.environ['TF_NUM_INTEROP_THREADS'] = '1'
 os.environ['KMP_AFFINITY'] = 'none'
 
-# Import the preprocessing function
-from utils.preprocess_mri_to_png import preprocess_single_file
+# Import the preprocessing functions
+from utils.preprocess_mri_to_png import preprocess_single_file, iter_preprocessed_slices
+
+# Import the bounded-queue helpers used to overlap the request stages
+from utils.pipeline import prefetch, map_in_background, iter_slabs
+
+# Import the disk-backed store used by the full-volume mode
+from utils.slice_store import SliceStore, plan_slab_size
+
+# Import the header-only pre-flight checks
+from utils.nifti_header import (
+    InvalidVolumeError, VolumeTooLargeError,
+    read_nifti_header, validate_header, estimate_resources, check_limits
+)
+
+# Optional process pool for volume preprocessing (PREPROCESS_WORKERS > 0).
+# CRITICAL: it is forked HERE, before TensorFlow is imported below, so the workers never contain TensorFlow
+PREPROCESS_WORKERS = int(os.environ.get("PREPROCESS_WORKERS", "0"))
+_preprocess_pool = None
+if PREPROCESS_WORKERS > 0:
+    from utils.preprocess_pool import PreprocessPool
+    _preprocess_pool = PreprocessPool(PREPROCESS_WORKERS)
+    atexit.register(_preprocess_pool.close)
+    print(f"[INFO] Worker PID {os.getpid()}: Started {PREPROCESS_WORKERS} preprocessing process(es)", flush=True)
 
 # Import the model and prediction function
-from models.patch_based_tensor import model_builder, predict_patients_slices
+import keras
+from models.patch_based_tensor import (model_builder, iter_patch_predictions, render_heatmap, PatchPredictor,
+                                       fold_batchnorm, check_folding_parity, warm_up_model, aggregate_scores,
+                                       AGGREGATIONS, BATCH_BUCKETS)
+from models.registry import ModelRegistry, UnknownModelError, load_registry_file
 
 app = Flask(__name__)
 CORS(app,resources={
@@ -47,54 +81,345 @@ backend_dir = os.path.dirname(os.path.abspath(__file__))
 MODEL_CHECKPOINT_PATH = os.path.join(backend_dir, "weights", "cp_mid.weights.h5")
 PATCH_SIZE = 32
 
-# CRITICAL: Global model variable that gets loaded LAZILY per worker
-_model = None
+# Opt-in inference speedups: XLA compiled inference, and bfloat16 mixed precision (only on CPUs with native bf16)
+INFERENCE_JIT = os.environ.get("INFERENCE_JIT", "0") == "1"
+INFERENCE_MIXED_PRECISION = os.environ.get("INFERENCE_MIXED_PRECISION", "0") == "1"
+
+# Serve a copy of the model with BatchNormalization folded into the conv/dense weights and Dropout removed
+# (same outputs, checked against the original at load time)
+INFERENCE_FOLD_BN = os.environ.get("INFERENCE_FOLD_BN", "1") == "1"
+
+# Max number of items waiting between two pipeline stages (preprocess -> inference -> encode)
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", "4"))
+
+# Optional relevance gate: slices with less tissue than this fraction are replaced by more informative ones
+MIN_SLICE_TISSUE_FRACTION = float(os.environ["MIN_SLICE_TISSUE_FRACTION"]) if os.environ.get("MIN_SLICE_TISSUE_FRACTION") else None
+
+# Memory ceiling for the slices in flight during full-volume (all_slices) requests
+FULL_VOLUME_MEMORY_MB = float(os.environ.get("FULL_VOLUME_MEMORY_MB", "256"))
+
+# Upload limits, checked from the NIfTI header before the volume is loaded
+MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", "512"))
+MAX_VOLUME_VOXELS = int(os.environ.get("MAX_VOLUME_VOXELS", "40000000"))
+MAX_ESTIMATED_MEMORY_MB = float(os.environ.get("MAX_ESTIMATED_MEMORY_MB", "1536"))
+MAX_ESTIMATED_SECONDS = float(os.environ.get("MAX_ESTIMATED_SECONDS", "600"))
+
+# Score-only mode (/predict with mode=score): coarser patch stride and fewer slices, no imagery
+SCORE_STRIDE = int(os.environ.get("SCORE_STRIDE", "16"))
+SCORE_SLICES = int(os.environ.get("SCORE_SLICES", "8"))
+
+# /predict_batch: max volumes per request (zip contents included), and how many are preprocessed at once
+# without the process pool (with it, the pool's PREPROCESS_WORKERS processes do the work)
+MAX_BATCH_VOLUMES = int(os.environ.get("MAX_BATCH_VOLUMES", "8"))
+BATCH_PREPROCESS_THREADS = int(os.environ.get("BATCH_PREPROCESS_THREADS", "2"))
+
+# Werkzeug rejects request bodies over this size with a 413 before they are read
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_MB * 1024 * 1024
 
-def get_model():
+# Optional model registry (JSON file mapping model IDs / modalities to weights, see models/registry.py).
+# Without it the registry holds a single "default" model, MODEL_CHECKPOINT_PATH
+MODEL_REGISTRY = os.environ.get("MODEL_REGISTRY")
+
+# Memory budget for the models kept loaded in a worker, least recently used ones are dropped above it
+MODEL_MEMORY_BUDGET_MB = float(os.environ.get("MODEL_MEMORY_BUDGET_MB", "1024"))
+
+# CRITICAL: Global registry that loads the models LAZILY per worker
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def load_model(model_id, spec):
     """
-    Lazy load model per worker to avoid Gunicorn fork issues.
+    Build, load and warm up one registry model (the registry's loader).
+    Called after fork, the first time a request asks for the model, since
     TensorFlow/Keras doesn't work well when model is loaded before fork.
     """
-    global _model
+    weights_path = spec["weights"]
+    print(f"[INFO] Worker PID {os.getpid()}: Loading model '{model_id}' for the first time...", flush=True)
+    sys.stdout.flush()
+    
+    # Verify model file exists
+    if not os.path.exists(weights_path):
+        error_msg = f"Model weights not found at {weights_path}"
+        print(f"[ERROR] {error_msg}", flush=True)
+        raise FileNotFoundError(error_msg)
     
-    if _model is None:
-        print(f"[INFO] Worker PID {os.getpid()}: Loading model for the first time...", flush=True)
+    try:
+        # Build model architecture (the registry entry can give a smaller one, ex: a compressed model)
+        print(f"[INFO] Worker {os.getpid()}: Building model architecture...", flush=True)
+        architecture = {key: tuple(spec[key]) for key in ("filters", "dense_units") if key in spec}
+        model, _, _ = model_builder(patch_size=PATCH_SIZE, resume=False, mixed_precision=INFERENCE_MIXED_PRECISION,
+                                    **architecture)
+        
+        # Load weights
+        print(f"[INFO] Worker {os.getpid()}: Loading weights from {weights_path}...", flush=True)
+        model.load_weights(weights_path)
+
+        # Fold BatchNormalization away, kept only if it matches the original model
+        if INFERENCE_FOLD_BN:
+            rng = np.random.default_rng(0)
+            blocks = rng.integers(0, 256, size=(64, 4, 4, 3), dtype=np.uint8)
+            check_patches = blocks.repeat(PATCH_SIZE // 4, axis=1).repeat(PATCH_SIZE // 4, axis=2)
+            tolerance = 1e-2 if INFERENCE_MIXED_PRECISION else 1e-4
+            try:
+                folded = fold_batchnorm(model, mixed_precision=INFERENCE_MIXED_PRECISION)
+                max_diff, flips = check_folding_parity(model, folded, check_patches)
+                if max_diff <= tolerance and flips == 0:
+                    print(f"[INFO] Worker {os.getpid()}: Using BN folded model (max |diff| {max_diff:.1e})", flush=True)
+                    model = folded
+                else:
+                    print(f"[WARNING] Worker {os.getpid()}: BN folded model differs from the original "
+                          f"(max |diff| {max_diff:.1e}, {flips} flips), serving the original", flush=True)
+            except ValueError as e:
+                print(f"[WARNING] Worker {os.getpid()}: Could not fold BatchNormalization ({e}), serving the original", flush=True)
+
+        # Serve through a single compiled inference function instead of model.predict
+        if INFERENCE_JIT:
+            print(f"[INFO] Worker {os.getpid()}: Using XLA compiled inference", flush=True)
+            model = PatchPredictor(model, jit_compile=True)
+        
+        # CRITICAL: Warm up the model with a dummy batch of every bucket size
+        # This forces TensorFlow to compile every graph BEFORE handling real requests
+        # (inference pads its batches to these sizes, so no request triggers tracing)
+        print(f"[INFO] Worker {os.getpid()}: Warming up model on every batch bucket...", flush=True)
         sys.stdout.flush()
         
-        # Verify model file exists
-        if not os.path.exists(MODEL_CHECKPOINT_PATH):
-            error_msg = f"Model weights not found at {MODEL_CHECKPOINT_PATH}"
-            print(f"[ERROR] {error_msg}", flush=True)
-            raise FileNotFoundError(error_msg)
+        timings = warm_up_model(model, patch_size=PATCH_SIZE)
+        print(f"[INFO] Worker {os.getpid()}: Warm-up took {sum(timings.values()):.2f}s "
+              f"({', '.join(f'{size}: {t:.2f}s' for size, t in timings.items())})", flush=True)
         
-        try:
-            # Build model architecture
-            print(f"[INFO] Worker {os.getpid()}: Building model architecture...", flush=True)
-            _model, _, _ = model_builder(patch_size=PATCH_SIZE, resume=False)
-            
-            # Load weights
-            print(f"[INFO] Worker {os.getpid()}: Loading weights from {MODEL_CHECKPOINT_PATH}...", flush=True)
-            _model.load_weights(MODEL_CHECKPOINT_PATH)
-            
-            # CRITICAL: Warm up the model with a dummy prediction
-            # This forces TensorFlow to compile the graph BEFORE handling real requests
-            print(f"[INFO] Worker {os.getpid()}: Warming up model with dummy prediction...", flush=True)
-            sys.stdout.flush()
-            
-            dummy_input = np.zeros((1, PATCH_SIZE, PATCH_SIZE, 3), dtype=np.float32)
-            _ = _model.predict(dummy_input, verbose=0)
-            
-            print(f"[SUCCESS] Worker {os.getpid()}: Model ready for inference!", flush=True)
-            sys.stdout.flush()
-            
-        except Exception as e:
-            print(f"[ERROR] Worker {os.getpid()}: Failed to load model: {e}", flush=True)
-            import traceback
-            traceback.print_exc()
-            sys.stdout.flush()
-            raise
+        print(f"[SUCCESS] Worker {os.getpid()}: Model '{model_id}' ready for inference!", flush=True)
+        sys.stdout.flush()
+        
+    except Exception as e:
+        print(f"[ERROR] Worker {os.getpid()}: Failed to load model '{model_id}': {e}", flush=True)
+        import traceback
+        traceback.print_exc()
+        sys.stdout.flush()
+        raise
+    
+    return model
+
+
+def get_registry():
+    """
+    Lazily create the model registry per worker (no model is loaded until a request needs it).
+    """
+    global _registry
+    
+    # Concurrent first requests must share one registry
+    with _registry_lock:
+        if _registry is None:
+            if MODEL_REGISTRY:
+                specs, default = load_registry_file(MODEL_REGISTRY)
+            else:
+                specs, default = {"default": {"weights": MODEL_CHECKPOINT_PATH}}, "default"
+            _registry = ModelRegistry(specs, default, loader=load_model, memory_budget_mb=MODEL_MEMORY_BUDGET_MB,
+                                      batch_size=max(BATCH_BUCKETS), clear_session=keras.backend.clear_session)
+            print(f"[INFO] Worker {os.getpid()}: Model registry with {len(specs)} model(s), "
+                  f"default '{default}', budget {MODEL_MEMORY_BUDGET_MB:.0f} MB", flush=True)
     
-    return _model
+    return _registry
+
+
+def encode_png(array):
+    """Encode a uint8 image array as a base64 PNG data URL."""
+    buffer = io.BytesIO()
+    Image.fromarray(array).save(buffer, format="PNG")
+    encoded = base64.b64encode(buffer.getvalue()).decode("utf-8")
+    return f"data:image/png;base64,{encoded}"
+
+
+def encode_prediction(item):
+    """Render the heatmap overlay for one slice and encode it (with the raw slice) for the frontend."""
+    i, (img, coords, preds) = item
+    result = render_heatmap(img, coords, preds, patch_size=PATCH_SIZE, return_originals=True)
+    print(f"[INFO] Encoded slice {i+1}", flush=True)
+    return {
+        "slice_index": i,
+        "overlay": encode_png(result["overlay"]),
+        "raw": encode_png(result["raw_slice"])
+    }
+
+
+def preflight_upload(file, n_slices, stride=8, resident_slices=None):
+    """
+    Read only the NIfTI header of an upload and decide whether we can afford to process it.
+    Returns the parsed header (to be passed to preprocess_single_file) and the resource plan.
+    n_slices=None means every slice (full-volume mode), with at most resident_slices in memory.
+    Raises InvalidVolumeError or VolumeTooLargeError.
+    """
+    return preflight_volume(file.stream, file.filename, n_slices, stride, resident_slices)
+
+
+def preflight_volume(stream, filename, n_slices, stride=8, resident_slices=None):
+    """
+    preflight_upload for any seekable stream (ex: a volume extracted from a zip archive).
+    """
+    gzipped = filename.endswith(".nii.gz")
+
+    # The size of an uncompressed upload lets us detect truncated files up front
+    upload_bytes = None
+    if not gzipped:
+        start = stream.tell()
+        stream.seek(0, os.SEEK_END)
+        upload_bytes = stream.tell() - start
+        stream.seek(start)
+
+    header = read_nifti_header(stream, gzipped=gzipped)
+    info = validate_header(header, upload_bytes=upload_bytes)
+    plan = estimate_resources(header, n_slices=n_slices or 0, size=224, patch_size=PATCH_SIZE, stride=stride)
+    if n_slices is None:
+        # Upper bound on the number of slices: the longest axis after resampling to 1mm
+        plan = estimate_resources(header, n_slices=max(plan["resampled_shape"]), size=224,
+                                  patch_size=PATCH_SIZE, stride=stride, resident_slices=resident_slices)
+
+    print(f"[INFO] Header: shape={info['shape']}, zooms={info['zooms']}, dtype={info['dtype']}", flush=True)
+    print(f"[INFO] Estimated {plan['memory_mb']:.0f} MB, {plan['seconds']:.1f}s, {plan['patches']} patches", flush=True)
+
+    check_limits(plan,
+                 max_voxels=MAX_VOLUME_VOXELS,
+                 max_memory_mb=MAX_ESTIMATED_MEMORY_MB,
+                 max_seconds=MAX_ESTIMATED_SECONDS)
+    return header, plan
+
+
+def request_slices(temp_path, header, n_slices):
+    """
+    Preprocessed slices for one request. With the process pool enabled the whole stack is
+    prepared in another process (and returned through shared memory) while this thread waits
+    without holding the GIL; otherwise slices are streamed from a background thread.
+    """
+    kwargs = dict(
+        file_path=temp_path,
+        n_slices=n_slices,
+        use_25d=False,
+        size=224,
+        axis=2,
+        use_all_slices=False,
+        header=header,
+        min_tissue_fraction=MIN_SLICE_TISSUE_FRACTION
+    )
+    if _preprocess_pool is not None:
+        slices_array = _preprocess_pool.preprocess(**kwargs)
+        print(f"[INFO] Preprocessed {slices_array.shape[0]} slices in the process pool", flush=True)
+        return iter(slices_array)
+
+    return prefetch(iter_preprocessed_slices(**kwargs), maxsize=PIPELINE_QUEUE_SIZE, name="preprocess")
+
+
+def store_prediction(store, item):
+    """Render one slice and append its raw image and overlay to a SliceStore."""
+    i, (img, coords, preds) = item
+    result = render_heatmap(img, coords, preds, patch_size=PATCH_SIZE, return_originals=True)
+    store.append(raw=result["raw_slice"], overlay=result["overlay"])
+    if (i + 1) % 10 == 0:
+        print(f"[INFO] Stored slice {i+1}", flush=True)
+
+
+def predict_full_volume(model, temp_path, header, filename, slab_size):
+    """
+    Full-volume mode: score every slice inside the brain bounds, slab_size slices at a time,
+    writing each rendered slice to a disk-backed SliceStore as soon as it is ready.
+    The JSON response is then streamed from the store one slice at a time, so memory use
+    does not grow with the number of slices.
+    """
+    print(f"[INFO] Full-volume mode with slabs of {slab_size} slices", flush=True)
+    store = SliceStore(keys=("raw", "overlay"))
+
+    try:
+        # The next slab is preprocessed while the current one is being scored
+        slices = prefetch(
+            iter_preprocessed_slices(
+                file_path=temp_path,
+                use_25d=False,
+                size=224,
+                axis=2,
+                use_all_slices=True,
+                header=header,
+                min_tissue_fraction=MIN_SLICE_TISSUE_FRACTION
+            ),
+            maxsize=slab_size,
+            name="preprocess"
+        )
+
+        def slab_predictions():
+            for slab in iter_slabs(slices, slab_size):
+                yield from iter_patch_predictions(model, slab, patch_size=PATCH_SIZE, stride=8)
+
+        map_in_background(
+            lambda item: store_prediction(store, item),
+            enumerate(slab_predictions()),
+            maxsize=slab_size,
+            name="render"
+        )
+    except Exception:
+        store.close()
+        raise
+
+    print(f"[INFO] Stored {len(store)} slices, streaming response", flush=True)
+
+    def generate():
+        try:
+            yield f'{{"filename": {json.dumps(filename)}, "status": "success", "count": {len(store)}, "slices": ['
+            for i in range(len(store)):
+                stored = store[i]
+                encoded = {
+                    "slice_index": i,
+                    "overlay": encode_png(np.asarray(stored["overlay"])),
+                    "raw": encode_png(np.asarray(stored["raw"]))
+                }
+                yield ("," if i else "") + json.dumps(encoded)
+            yield "]}"
+        finally:
+            store.close()
+
+    return app.response_class(generate(), mimetype="application/json")
+
+
+def score_options():
+    """
+    Aggregation settings of a mode=score request (form fields aggregate, patch_k, slice_k):
+    patch scores -> slice score with patch_k, slice scores -> volume score with slice_k.
+    Raises ValueError for invalid values.
+    """
+    aggregate = request.form.get("aggregate", "top_k")
+    if aggregate not in AGGREGATIONS:
+        raise ValueError(f"aggregate must be one of {', '.join(AGGREGATIONS)}")
+    try:
+        patch_k = int(request.form.get("patch_k", "16"))
+        slice_k = int(request.form.get("slice_k", "3"))
+    except ValueError:
+        raise ValueError("patch_k and slice_k must be integers")
+    if patch_k < 1 or slice_k < 1:
+        raise ValueError("patch_k and slice_k must be at least 1")
+    return {"aggregate": aggregate, "patch_k": patch_k, "slice_k": slice_k}
+
+
+def score_volume(model, temp_path, header, options):
+    """
+    Score-only mode: SCORE_SLICES slices at a SCORE_STRIDE patch stride, each slice reduced to
+    one score and the slices to a volume score. Nothing is rendered or encoded.
+    """
+    slices = request_slices(temp_path, header, n_slices=SCORE_SLICES)
+
+    slice_scores = []
+    n_patches = 0
+    for img, coords, preds in iter_patch_predictions(model, slices, patch_size=PATCH_SIZE, stride=SCORE_STRIDE):
+        slice_scores.append(aggregate_scores(preds, options["aggregate"], options["patch_k"]))
+        n_patches += len(preds)
+
+    return {
+        "score": round(aggregate_scores(slice_scores, options["aggregate"], options["slice_k"]), 6),
+        "slice_scores": [round(score, 6) for score in slice_scores],
+        "patches": n_patches,
+        **options
+    }
+
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({"error": f"Upload is larger than the {MAX_UPLOAD_MB} MB limit"}), 413
 
 
 @app.route("/", methods=["GET"])
@@ -103,7 +428,8 @@ def home():
     return jsonify({
         "message": "Backend API is running!",
         "status": "ok",
-        "worker_pid": os.getpid()
+        "worker_pid": os.getpid(),
+        "models": get_registry().stats()
     })
 
 
@@ -112,6 +438,13 @@ def predict():
     """
     Accepts an uploaded MRI file (.nii or .nii.gz), runs inference,
     and returns heatmaps for each slice.
+    Send the form field all_slices=true to score every slice of the brain
+    (full-volume mode) instead of 20 evenly spaced slices.
+    Send the form field model=<id> or modality=<T1, T2...> to pick a registry
+    model, the default model is used otherwise.
+    Send mode=score for a quick triage score instead of heatmaps: a coarse stride
+    over fewer slices, aggregated into per-slice and volume probabilities (see
+    score_options) and returned as a small JSON document without any imagery.
     """
     print(f"[DEBUG] Worker {os.getpid()}: /predict endpoint called", flush=True)
     sys.stdout.flush()
@@ -129,6 +462,43 @@ def predict():
         return jsonify({
             "error": "Invalid file type. Please upload a .nii or .nii.gz file"
         }), 400
+
+    # Pick the model before anything is read or written
+    try:
+        model_id = get_registry().resolve(request.form.get("model"), request.form.get("modality"))
+    except UnknownModelError as e:
+        print(f"[DEBUG] {e}", flush=True)
+        return jsonify({"error": str(e)}), 400
+
+    # Score-only mode skips every image (heatmaps, overlays, PNG / base64 encoding)
+    mode = request.form.get("mode", "heatmap")
+    if mode not in ("heatmap", "score"):
+        return jsonify({"error": "mode must be heatmap or score"}), 400
+    score_only = mode == "score"
+    if score_only:
+        try:
+            options = score_options()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+    # Full-volume mode scores every slice in bounded slabs instead of 20 sampled slices
+    use_all_slices = not score_only and request.form.get("all_slices", "").lower() in ("1", "true", "yes")
+    slab_size = plan_slab_size(FULL_VOLUME_MEMORY_MB, size=224, patch_size=PATCH_SIZE, stride=8)
+
+    # Check the header before anything is written to disk
+    try:
+        if score_only:
+            header, plan = preflight_upload(file, n_slices=SCORE_SLICES, stride=SCORE_STRIDE)
+        elif use_all_slices:
+            header, plan = preflight_upload(file, n_slices=None, stride=8, resident_slices=2 * slab_size)
+        else:
+            header, plan = preflight_upload(file, n_slices=20, stride=8)
+    except VolumeTooLargeError as e:
+        print(f"[DEBUG] Volume rejected: {e}", flush=True)
+        return jsonify({"error": str(e)}), 413
+    except InvalidVolumeError as e:
+        print(f"[DEBUG] Invalid volume: {e}", flush=True)
+        return jsonify({"error": str(e)}), 400
     
     # Save to temporary location
     suffix = ".nii.gz" if file.filename.endswith(".nii.gz") else ".nii"
@@ -143,74 +513,45 @@ def predict():
         print(f"[INFO] Starting inference for {file.filename}...", flush=True)
         sys.stdout.flush()
         
-        # Step 1: Get the model (lazy loads if needed)
-        print("[INFO] Getting model instance...", flush=True)
-        model = get_model()
-        print("[INFO] Model instance acquired", flush=True)
-        sys.stdout.flush()
-        
-        # Step 2: Preprocess the .nii file to get array of slices
-        print("[INFO] Preprocessing MRI volume...", flush=True)
-        sys.stdout.flush()
-        
-        slices_array = preprocess_single_file(
-            file_path=temp_path,
-            n_slices=20,
-            use_25d=False,
-            size=224,
-            axis=2,
-            use_all_slices=False
-        )
-        
-        print(f"[INFO] Preprocessed {slices_array.shape[0]} slices", flush=True)
-        print(f"[DEBUG] Slices array shape: {slices_array.shape}, dtype: {slices_array.dtype}", flush=True)
-        sys.stdout.flush()
-        
-        # Step 3: Run inference on all slices
-        print("[INFO] Running model inference...", flush=True)
-        sys.stdout.flush()
-        
-        results = predict_patients_slices(
-            model=model,
-            checkpoint_path=MODEL_CHECKPOINT_PATH,
-            slices_array=slices_array,
-            patch_size=PATCH_SIZE,
-            stride=8,
-            return_originals=True,
-            skip_load=True,  # Weights already loaded
-        )
-
-        print(f"[INFO] Inference returned {len(results)} results", flush=True)
-        sys.stdout.flush()
-        
-        # Step 4: Convert both overlay and raw images to base64 for frontend
-        print("[INFO] Encoding results for frontend...", flush=True)
-        encoded_slices = []
-        
-        for i, result in enumerate(results):
-            overlay_img = Image.fromarray(result["overlay"])
-            overlay_buffer = io.BytesIO()
-            overlay_img.save(overlay_buffer, format="PNG")
-            overlay_buffer.seek(0)
-            overlay_encoded = base64.b64encode(overlay_buffer.read()).decode("utf-8")
+        # Step 1: Get the model (lazy loads if needed, shared with the other requests using it)
+        print(f"[INFO] Getting model '{model_id}'...", flush=True)
+        with get_registry().acquire(model_id) as (model_id, model):
+            print("[INFO] Model instance acquired", flush=True)
+            sys.stdout.flush()
             
-            raw_img = Image.fromarray(result["raw_slice"])
-            raw_buffer = io.BytesIO()
-            raw_img.save(raw_buffer, format="PNG")
-            raw_buffer.seek(0)
-            raw_encoded = base64.b64encode(raw_buffer.read()).decode("utf-8")
+            if score_only:
+                start = time.perf_counter()
+                result = score_volume(model, temp_path, header, options)
+                print(f"[SUCCESS] Scored {file.filename} in {time.perf_counter() - start:.2f}s: {result['score']:.4f}", flush=True)
+                return jsonify({"filename": file.filename, "model": model_id, "mode": "score", **result,
+                                "status": "success"})
             
-            encoded_slices.append({
-                "slice_index": i,
-                "overlay": f"data:image/png;base64,{overlay_encoded}",
-                "raw": f"data:image/png;base64,{raw_encoded}"
-            })
+            if use_all_slices:
+                return predict_full_volume(model, temp_path, header, file.filename, slab_size)
+            
+            # Step 2: Preprocess in the process pool, or stream slices from a background thread (bounded queue)
+            print("[INFO] Preprocessing MRI volume and running inference...", flush=True)
+            sys.stdout.flush()
+            
+            slices = request_slices(temp_path, header, n_slices=20)
+            
+            # Step 3: Run inference in this thread as slices arrive, packing patches into full batches
+            predictions = iter_patch_predictions(model, slices, patch_size=PATCH_SIZE, stride=8)
+            
+            # Step 4: Render and encode each finished slice for the frontend on another thread
+            encoded_slices = map_in_background(
+                encode_prediction,
+                enumerate(predictions),
+                maxsize=PIPELINE_QUEUE_SIZE,
+                name="encode"
+            )
         
         print(f"[SUCCESS] Inference complete for {file.filename}", flush=True)
         sys.stdout.flush()
         
         return jsonify({
             "filename": file.filename,
+            "model": model_id,
             "slices": encoded_slices,
             "count": len(encoded_slices),
             "status": "success"
@@ -230,6 +571,234 @@ def predict():
             print(f"[INFO] Cleaned up temporary file", flush=True)
 
 
+def is_nifti(filename):
+    return filename.endswith(".nii") or filename.endswith(".nii.gz")
+
+
+def collect_batch_volumes(uploads, temp_dir):
+    """
+    Save every NIfTI upload of a /predict_batch request, and every NIfTI file inside uploaded
+    .zip archives, into temp_dir, checking each header before the volume is used.
+    Returns one entry per volume, in upload (then archive) order:
+        {"filename", "path", "header"} or {"filename", "error"} for volumes that can't be scored.
+    Raises VolumeTooLargeError when the request holds more than MAX_BATCH_VOLUMES volumes.
+    """
+    volumes = []
+
+    def add_volume(filename, stream, save):
+        if len(volumes) >= MAX_BATCH_VOLUMES:
+            raise VolumeTooLargeError(f"A batch can hold at most {MAX_BATCH_VOLUMES} volumes")
+        try:
+            header, _ = preflight_volume(stream, filename, n_slices=20, stride=8)
+        except (InvalidVolumeError, VolumeTooLargeError) as e:
+            print(f"[DEBUG] {filename} rejected: {e}", flush=True)
+            volumes.append({"filename": filename, "error": str(e)})
+            return
+        suffix = ".nii.gz" if filename.endswith(".nii.gz") else ".nii"
+        path = os.path.join(temp_dir, f"volume_{len(volumes):03d}{suffix}")
+        save(path)
+        volumes.append({"filename": filename, "path": path, "header": header})
+
+    for upload in uploads:
+        if upload.filename.endswith(".zip"):
+            try:
+                archive = zipfile.ZipFile(upload.stream)
+            except zipfile.BadZipFile as e:
+                volumes.append({"filename": upload.filename, "error": f"Invalid zip archive: {e}"})
+                continue
+            with archive:
+                for info in archive.infolist():
+                    # Skip folders and macOS metadata, member paths are never used on disk
+                    name = os.path.basename(info.filename)
+                    if info.is_dir() or not is_nifti(name) or name.startswith("._") or info.filename.startswith("__MACOSX/"):
+                        continue
+                    # The declared size is also a hard limit on what extraction reads
+                    if info.file_size > MAX_UPLOAD_MB * 1024 * 1024:
+                        volumes.append({"filename": info.filename,
+                                        "error": f"Volume is larger than the {MAX_UPLOAD_MB} MB limit"})
+                        continue
+                    extracted = os.path.join(temp_dir, f"extracted{'.nii.gz' if name.endswith('.nii.gz') else '.nii'}")
+                    with archive.open(info) as member, open(extracted, "wb") as out:
+                        shutil.copyfileobj(member, out, 1024 * 1024)
+                    with open(extracted, "rb") as stream:
+                        add_volume(info.filename, stream, lambda path: os.replace(extracted, path))
+                    if os.path.exists(extracted):
+                        os.remove(extracted)
+        elif is_nifti(upload.filename):
+            add_volume(upload.filename, upload.stream, upload.save)
+        else:
+            volumes.append({"filename": upload.filename,
+                            "error": "Invalid file type. Please upload .nii, .nii.gz or .zip files"})
+    return volumes
+
+
+def batch_model_ids(registry, n_volumes):
+    """
+    Model of every volume of a batch from the form fields model / modality: either one value
+    for the whole batch or one value per volume (in the order of the volumes in the response).
+    Raises UnknownModelError.
+    """
+    models = request.form.getlist("model")
+    modalities = request.form.getlist("modality")
+    for field, values in (("model", models), ("modality", modalities)):
+        if len(values) not in (0, 1, n_volumes):
+            raise UnknownModelError(f"Send one {field} for the whole batch or one per volume ({n_volumes})")
+
+    def pick(values, i):
+        return values[0] if len(values) == 1 else values[i] if values else None
+
+    return [registry.resolve(pick(models, i), pick(modalities, i)) for i in range(n_volumes)]
+
+
+def start_batch_preprocessing(volumes):
+    """
+    Start preprocessing every valid volume of a batch at once, in the process pool when it is
+    enabled, otherwise on BATCH_PREPROCESS_THREADS threads.
+    Returns (jobs, take, stop): jobs maps volume index -> pending job, take(job) waits for a job
+    and returns its slices, stop() must be called once the batch is done (it collects the jobs
+    that were never taken, so no shared memory block is left behind).
+    """
+    executor = None
+    jobs = {}
+    for i, volume in enumerate(volumes):
+        if "error" in volume:
+            continue
+        kwargs = dict(file_path=volume["path"], n_slices=20, use_25d=False, size=224, axis=2,
+                      use_all_slices=False, header=volume["header"], min_tissue_fraction=MIN_SLICE_TISSUE_FRACTION)
+        if _preprocess_pool is not None:
+            jobs[i] = _preprocess_pool.submit(**kwargs)
+        else:
+            executor = executor or ThreadPoolExecutor(max_workers=BATCH_PREPROCESS_THREADS, thread_name_prefix="batch-preprocess")
+            jobs[i] = executor.submit(preprocess_single_file, **kwargs)
+
+    take = _preprocess_pool.result if _preprocess_pool is not None else (lambda job: job.result())
+
+    def stop():
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        for job in jobs.values():
+            try:
+                take(job)
+            except Exception:
+                pass
+        jobs.clear()
+
+    return jobs, take, stop
+
+
+def iter_batch_slices(volumes, indices, jobs, take, owners):
+    """
+    Slices of the given batch volumes one after the other, as their preprocessing finishes.
+    (volume index, slice index) of every slice is appended to owners; a volume whose
+    preprocessing fails gets an "error" instead.
+    """
+    for i in indices:
+        try:
+            slices = take(jobs.pop(i))
+        except Exception as e:
+            print(f"[ERROR] Preprocessing failed for {volumes[i]['filename']}: {e}", flush=True)
+            volumes[i]["error"] = f"Preprocessing failed: {e}"
+            continue
+        print(f"[INFO] Preprocessed {len(slices)} slices of {volumes[i]['filename']}", flush=True)
+        volumes[i]["slices"] = [None] * len(slices)
+        for j, img in enumerate(slices):
+            owners.append((i, j))
+            yield img
+
+
+@app.route("/predict_batch", methods=["POST"])
+def predict_batch():
+    """
+    Accepts several MRI files (.nii / .nii.gz, form field files) and/or zip archives of them,
+    and returns the heatmaps of 20 slices per volume, like /predict, for every volume.
+    All volumes are preprocessed concurrently and their patches are scored together in the same
+    batches, volumes are only told apart again when the results are rendered.
+    Send model=<id> or modality=<T1, T2...> once for the whole batch, or once per volume.
+    """
+    print(f"[DEBUG] Worker {os.getpid()}: /predict_batch endpoint called", flush=True)
+    uploads = request.files.getlist("files") + request.files.getlist("file")
+    if not uploads:
+        return jsonify({"error": "No file uploaded"}), 400
+
+    start = time.perf_counter()
+    temp_dir = tempfile.mkdtemp(prefix="batch_")
+    try:
+        # Step 1: Save and check every volume (a bad volume only fails itself)
+        try:
+            volumes = collect_batch_volumes(uploads, temp_dir)
+        except VolumeTooLargeError as e:
+            return jsonify({"error": str(e)}), 413
+        if not volumes:
+            return jsonify({"error": "No NIfTI file found in the upload"}), 400
+
+        try:
+            model_ids = batch_model_ids(get_registry(), len(volumes))
+        except UnknownModelError as e:
+            return jsonify({"error": str(e)}), 400
+
+        valid = [i for i, volume in enumerate(volumes) if "error" not in volume]
+        print(f"[INFO] Batch of {len(volumes)} volumes, {len(valid)} valid", flush=True)
+
+        # Step 2: Preprocess every volume concurrently
+        jobs, take, stop = start_batch_preprocessing(volumes)
+        try:
+            # Step 3: Score the volumes of each model together, patches of consecutive volumes share batches
+            for model_id in dict.fromkeys(model_ids[i] for i in valid):
+                indices = [i for i in valid if model_ids[i] == model_id]
+                with get_registry().acquire(model_id) as (model_id, model):
+                    owners = deque()
+                    predictions = iter_patch_predictions(model, iter_batch_slices(volumes, indices, jobs, take, owners),
+                                                         patch_size=PATCH_SIZE, stride=8)
+
+                    # Step 4: Render and encode each finished slice on another thread
+                    def encode(item):
+                        (i, j), prediction = item
+                        return i, j, encode_prediction((j, prediction))
+
+                    encoded = map_in_background(
+                        encode,
+                        ((owners.popleft(), prediction) for prediction in predictions),
+                        maxsize=PIPELINE_QUEUE_SIZE,
+                        name="encode"
+                    )
+                for i, j, result in encoded:
+                    volumes[i]["slices"][j] = result
+                    volumes[i]["model"] = model_id
+        finally:
+            stop()
+
+        results = []
+        for volume in volumes:
+            if "error" in volume:
+                results.append({"filename": volume["filename"], "status": "error", "error": volume["error"]})
+            else:
+                results.append({"filename": volume["filename"], "status": "success", "model": volume["model"],
+                                "slices": volume["slices"], "count": len(volume["slices"])})
+        n_scored = sum(result["status"] == "success" for result in results)
+        elapsed = time.perf_counter() - start
+        print(f"[SUCCESS] Batch scored {n_scored}/{len(volumes)} volumes in {elapsed:.1f}s "
+              f"({n_scored / elapsed:.2f} volumes/s)", flush=True)
+
+        return jsonify({
+            "volumes": results,
+            "count": len(results),
+            "scored": n_scored,
+            "status": "success" if n_scored else "error"
+        }), (200 if n_scored else 400)
+
+    except Exception as e:
+        print(f"[ERROR] Batch inference failed: {e}", flush=True)
+        import traceback
+        traceback.print_exc()
+        sys.stdout.flush()
+        return jsonify({"error": str(e)}), 500
+
+    finally:
+        # Clean up every temporary file of the batch
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        print(f"[INFO] Cleaned up batch temporary files", flush=True)
+
+
 @app.route("/preview", methods=["POST"])
 def preview():
     """Generate and return a scrollable axial preview of the uploaded MRI file."""
@@ -243,20 +812,32 @@ def preview():
             "error": "Invalid file type. Please upload a .nii or .nii.gz file"
         }), 400
 
+    # Preview skips inference, but still loads and resamples the whole volume
+    try:
+        header, _ = preflight_upload(file, n_slices=0)
+    except VolumeTooLargeError as e:
+        return jsonify({"error": str(e)}), 413
+    except InvalidVolumeError as e:
+        return jsonify({"error": str(e)}), 400
+
     with tempfile.TemporaryDirectory() as temp_dir:
         suffix = ".nii.gz" if file.filename.endswith(".nii.gz") else ".nii"
         temp_path = os.path.join(temp_dir, f"uploaded{suffix}")
         file.save(temp_path)
 
         try:
-            preprocess_single_file(
-                temp_path,
+            # Runs in the process pool when it is enabled, the PNGs land in temp_dir either way
+            preprocess = _preprocess_pool.preprocess if _preprocess_pool is not None else preprocess_single_file
+            preprocess(
+                file_path=temp_path,
                 n_slices=20,
                 use_25d=False,
                 size=224,
                 axis=2,
                 out_dir=temp_dir,
-                use_all_slices=False
+                use_all_slices=False,
+                header=header,
+                min_tissue_fraction=MIN_SLICE_TISSUE_FRACTION
             )
 
             png_files = sorted(Path(temp_dir).glob("*.png"))
@@ -0,0 +1,184 @@
+"""
+-----------------------------------------
+Benchmark of the training data formats
+
+Compares how fast training batches can be
+read from:
+    - the lzf h5 file (what create_dataset_stream writes)
+    - the same data as a gzip h5 file
+    - the memory mapped .npy shards
+      (convert_h5_to_mmap_shards)
+
+Each format is read through the tf.data
+pipeline used for training, and through the
+plain numpy readers in <processes> processes
+at once (to see how the formats behave when
+several training/tuning processes share a box).
+
+Run from the project root:
+    python backend/models/benchmark_formats.py --h5 training_patches.h5
+
+NOTE: the first pass over a format may come
+      from disk and later passes from the page
+      cache, so every format is read <repeats> times
+-----------------------------------------
+"""
+import os
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import h5py
+from tqdm import tqdm
+
+from patch_based_tensor import (chunked_data_gen, mmap_data_gen, iter_h5_chunk_batches,
+                                iter_mmap_batches, convert_h5_to_mmap_shards, MMAP_INDEX)
+
+"""
+----------------
+Argparser
+----------------
+"""
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--h5", required=True, help="lzf h5 patch file made by patch_based_tensor.py --make_dataset")
+    parser.add_argument("--work_dir", default="format_benchmark", help="where the gzip copy and the mmap shards are written")
+    parser.add_argument("--batch_size", type=int, default=128)
+    parser.add_argument("--readers", type=int, default=4, help="parallel readers in the tf.data pipeline")
+    parser.add_argument("--processes", type=int, default=4, help="processes reading at the same time in the multi-process test")
+    parser.add_argument("--max_samples", type=int, default=500000, help="samples read per pass (0 = whole file)")
+    parser.add_argument("--repeats", type=int, default=2, help="passes over each format")
+    return parser.parse_args()
+
+"""
+-----------------------------------------
+Function: convert_h5_to_gzip
+    copies an h5 patch file into a gzip
+    compressed one with the same chunk layout
+-----------------------------------------
+"""
+def convert_h5_to_gzip(src_path, dst_path, level=4):
+    with h5py.File(src_path, 'r') as src, h5py.File(dst_path, 'w') as dst:
+        data_len = len(src['train_x'])
+        chunks = src['train_x'].chunks or (256, 32, 32, 3)
+        x_ds = dst.create_dataset('train_x', shape=src['train_x'].shape, dtype=np.uint8,
+                                  compression='gzip', compression_opts=level, chunks=chunks)
+        y_ds = dst.create_dataset('train_y', shape=src['train_y'].shape, dtype=np.int32,
+                                  compression='gzip', compression_opts=level)
+
+        # copy a block of whole chunks at a time
+        block = chunks[0] * 64
+        for start in tqdm(range(0, data_len, block), desc="Writing gzip copy"):
+            end = min(start + block, data_len)
+            x_ds[start:end] = src['train_x'][start:end]
+            y_ds[start:end] = src['train_y'][start:end]
+
+"""
+-----------------------------------------
+Function: disk_size_mb
+    size of a file, or of every file in a folder
+-----------------------------------------
+"""
+def disk_size_mb(path):
+    if os.path.isdir(path):
+        total = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    else:
+        total = os.path.getsize(path)
+    return total / (1024 ** 2)
+
+"""
+-----------------------------------------
+Function: time_tf_dataset
+    reads up to <max_samples> samples from a
+    tf.data dataset, returns samples/sec
+-----------------------------------------
+"""
+def time_tf_dataset(ds, max_samples):
+    n = 0
+    start = time.perf_counter()
+    for x, _ in ds:
+        n += int(x.shape[0])
+        if max_samples and n >= max_samples:
+            break
+    return n / (time.perf_counter() - start)
+
+"""
+-----------------------------------------
+Function: read_part
+    runs in a benchmark process: reads its
+    share of the data with the numpy readers
+    returns the number of samples read
+-----------------------------------------
+"""
+def read_part(job):
+    fmt, path, batch_size, shard_index, num_shards, max_samples = job
+    if fmt == 'mmap':
+        batches = iter_mmap_batches(path, batch_size, shuffle=True, shard_index=shard_index, num_shards=num_shards)
+    else:
+        batches = iter_h5_chunk_batches(path, batch_size, shuffle=True, shard_index=shard_index, num_shards=num_shards)
+
+    n = 0
+    for x, _ in batches:
+        # touch the data so mapped pages are really read
+        x.sum(dtype=np.uint64)
+        n += len(x)
+        if max_samples and n >= max_samples:
+            break
+    return n
+
+"""
+-----------------------------------------
+Function: time_processes
+    reads a format from <processes> processes
+    at once, returns total samples/sec
+-----------------------------------------
+"""
+def time_processes(fmt, path, batch_size, processes, max_samples):
+    per_process = -(-max_samples // processes) if max_samples else 0
+    jobs = [(fmt, path, batch_size, i, processes, per_process) for i in range(processes)]
+
+    # fork is fine here, the children only use numpy and h5py
+    with multiprocessing.get_context("fork").Pool(processes=processes) as pool:
+        start = time.perf_counter()
+        n = sum(pool.map(read_part, jobs))
+        return n / (time.perf_counter() - start)
+
+def main(args):
+    os.makedirs(args.work_dir, exist_ok=True)
+    gzip_path = os.path.join(args.work_dir, 'patches_gzip.h5')
+    shard_dir = os.path.join(args.work_dir, 'patches_mmap')
+
+    # build the alternative formats once
+    if not os.path.exists(gzip_path):
+        convert_h5_to_gzip(args.h5, gzip_path)
+    if not os.path.exists(os.path.join(shard_dir, MMAP_INDEX)):
+        convert_h5_to_mmap_shards(args.h5, shard_dir)
+
+    formats = [
+        ("h5 lzf", "h5", args.h5),
+        ("h5 gzip", "h5", gzip_path),
+        ("mmap npy", "mmap", shard_dir),
+    ]
+
+    results = []
+    for name, fmt, path in formats:
+        for repeat in range(args.repeats):
+            if fmt == 'mmap':
+                ds = mmap_data_gen(path, args.batch_size, shuffle=True, readers=args.readers)
+            else:
+                ds = chunked_data_gen(path, args.batch_size, shuffle=True, readers=args.readers)
+            tf_rate = time_tf_dataset(ds, args.max_samples)
+            proc_rate = time_processes(fmt, path, args.batch_size, args.processes, args.max_samples)
+            print(f"[INFO] {name} pass {repeat + 1}: tf.data {tf_rate:,.0f} samples/s, "
+                  f"{args.processes} processes {proc_rate:,.0f} samples/s")
+            results.append((name, repeat + 1, disk_size_mb(path), tf_rate, proc_rate))
+
+    # summary table
+    print()
+    print(f"{'format':<10} {'pass':>4} {'size MB':>10} {'tf.data/s':>12} {f'{args.processes} procs/s':>12}")
+    for name, repeat, size_mb, tf_rate, proc_rate in results:
+        print(f"{name:<10} {repeat:>4} {size_mb:>10,.0f} {tf_rate:>12,.0f} {proc_rate:>12,.0f}")
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
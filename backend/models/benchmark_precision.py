@@ -0,0 +1,157 @@
+"""
+-----------------------------------------
+Benchmark of the XLA / mixed precision modes
+
+Builds the patch model in every combination of
+    - float32 or bfloat16 mixed precision
+    - with or without XLA (jit_compile)
+all starting from the same weights, and reports:
+    - training steps/sec (model.fit on batches
+      already in memory, so only compute is timed)
+    - inference patches/sec, through model.predict
+      and through PatchPredictor (XLA compiled for
+      the jit variants)
+    - numeric drift of the PatchPredictor outputs
+      against float32 model.predict (max / mean
+      absolute difference, and how many patches
+      change side of the 0.5 threshold)
+With --fold_bn every variant is also run with
+BatchNormalization folded away (fold_batchnorm,
+inference only, so no training speed).
+
+Patches come from an h5 patch file (--h5), or
+are smoothed random noise if no file is given
+(uniform noise saturates the model's output and
+hides any drift).
+
+Run from the project root:
+    python backend/models/benchmark_precision.py --weights backend/weights/cp_mid.weights.h5
+-----------------------------------------
+"""
+import time
+import argparse
+import numpy as np
+import h5py
+import tensorflow as tf
+from scipy.ndimage import gaussian_filter
+
+from patch_based_tensor import model_builder, PatchPredictor, predict_patch_batch, cpu_supports_bf16, fold_batchnorm
+
+"""
+----------------
+Argparser
+----------------
+"""
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weights", default=None, help="weights to start from (random weights if not given)")
+    parser.add_argument("--h5", default=None, help="h5 patch file to take the patches from (ex: val_patches.h5)")
+    parser.add_argument("--batch_size", type=int, default=128)
+    parser.add_argument("--train_steps", type=int, default=50, help="timed training steps per variant")
+    parser.add_argument("--patches", type=int, default=8192, help="patches scored per variant")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fold_bn", action="store_true", help="also benchmark every variant with BatchNormalization folded")
+    return parser.parse_args()
+
+"""
+-----------------------------------------
+Function: time_training
+    steps/sec of model.fit on <steps> batches
+    (one untimed epoch first, to build the graph)
+-----------------------------------------
+"""
+def time_training(model, x, y, batch_size, steps):
+    ds = tf.data.Dataset.from_tensor_slices((x, y)).batch(batch_size, drop_remainder=True).repeat()
+    model.fit(ds, steps_per_epoch=2, epochs=1, verbose=0)
+    start = time.perf_counter()
+    model.fit(ds, steps_per_epoch=steps, epochs=1, verbose=0)
+    return steps / (time.perf_counter() - start)
+
+"""
+-----------------------------------------
+Function: time_inference
+    scores <patches> in batches the way the API
+    does, returns (patches/sec, predictions)
+-----------------------------------------
+"""
+def time_inference(predictor, patches, batch_size):
+    # first batch builds / compiles the inference graph
+    predict_patch_batch(predictor, patches[:batch_size])
+
+    preds = []
+    start = time.perf_counter()
+    for i in range(0, len(patches), batch_size):
+        preds.append(predict_patch_batch(predictor, patches[i:i + batch_size]))
+    rate = len(patches) / (time.perf_counter() - start)
+    return rate, np.concatenate(preds)
+
+"""
+-----------------------------------------
+Function: load_patches
+    first <n> patches and labels of an h5 file,
+    or smoothed random patches if path is None
+-----------------------------------------
+"""
+def load_patches(path, n, rng):
+    if path:
+        with h5py.File(path, 'r') as f:
+            return f['train_x'][:n], f['train_y'][:n].astype(np.int32)
+    noise = rng.normal(120, 60, size=(n, 32, 32, 3))
+    patches = np.clip(gaussian_filter(noise, sigma=(0, 2, 2, 0)), 0, 255).astype(np.uint8)
+    return patches, rng.integers(0, 2, size=(n,)).astype(np.int32)
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    tf.keras.utils.set_random_seed(args.seed)
+
+    patches, labels = load_patches(args.h5, max(args.patches, args.batch_size * 16), rng)
+    n_train = args.batch_size * 16
+    x_train = patches[:n_train].astype(np.float32) / 255.0
+    y_train = labels[:n_train]
+    patches = patches[:args.patches]
+
+    # every variant starts from these weights
+    base, _, _ = model_builder(32)
+    if args.weights:
+        base.load_weights(args.weights)
+    weights = base.get_weights()
+
+    bf16 = cpu_supports_bf16()
+    print(f"[INFO] CPU native bfloat16: {'yes' if bf16 else 'no'}")
+    variants = [("float32", False, False, False), ("float32 + XLA", False, True, False)]
+    if bf16:
+        variants += [("bf16", True, False, False), ("bf16 + XLA", True, True, False)]
+    if args.fold_bn:
+        variants += [(name + " + fold", mixed, jit, True) for name, mixed, jit, _ in variants]
+
+    results = []
+    baseline = None
+    for name, mixed, jit, fold in variants:
+        print(f"[INFO] Benchmarking {name}...")
+
+        # inference first, from the untouched weights
+        model, _, _ = model_builder(32, jit_compile=jit, mixed_precision=mixed)
+        model.set_weights(weights)
+        inference_model = fold_batchnorm(model, mixed_precision=mixed) if fold else model
+        predict_rate, predict_preds = time_inference(inference_model, patches, args.batch_size)
+        fn_rate, preds = time_inference(PatchPredictor(inference_model, jit_compile=jit), patches, args.batch_size)
+
+        # drift is measured against float32 model.predict
+        if baseline is None:
+            baseline = predict_preds
+        diff = np.abs(preds - baseline)
+        flips = int(np.sum((preds > 0.5) != (baseline > 0.5)))
+
+        # the folded model is inference only
+        train_rate = float('nan') if fold else time_training(model, x_train, y_train, args.batch_size, args.train_steps)
+        results.append((name, train_rate, predict_rate, fn_rate, float(diff.max()), float(diff.mean()), flips))
+
+    # summary table
+    print()
+    print(f"{'variant':<22} {'train steps/s':>13} {'predict p/s':>12} {'predictor p/s':>14} {'max |diff|':>11} {'mean |diff|':>12} {'flips':>6}")
+    for name, train_rate, predict_rate, fn_rate, max_diff, mean_diff, flips in results:
+        print(f"{name:<22} {train_rate:>13.2f} {predict_rate:>12,.0f} {fn_rate:>14,.0f} {max_diff:>11.2e} {mean_diff:>12.2e} {flips:>6}")
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
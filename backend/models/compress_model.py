@@ -0,0 +1,293 @@
+"""
+-----------------------------------------
+Model compression: structured pruning and
+distillation of the patch model
+
+Starting from the trained model (the teacher)
+it makes smaller variants:
+    - pruned: the teacher with whole conv
+      channels / dense units removed (the least
+      important ones, kept fraction --keep),
+      then fine tuned
+    - students: a fresh model_builder model with
+      the given conv filters / dense widths
+      (--student), trained from scratch
+every variant is trained on the training h5
+file against the labels AND the teacher's
+predictions (distillation).
+
+For the teacher and every variant it reports:
+    - parameter count
+    - patches/sec, scored the way the API does
+      (BN folded, PatchPredictor, float32)
+    - validation accuracy and ROC AUC on the
+      balanced validation subset
+and saves each variant's weights and
+architecture in --out_dir, they can be rebuilt with
+    model_builder(32, filters=..., dense_units=...)
+
+Input range: every step here (distillation,
+evaluation and the speed test) feeds raw 0-255
+patches, the range train_model trains on. The
+API divides patches by 255 before scoring
+(predict_patch_batch), so its outputs are not
+the ones reported here.
+
+Run from the project root:
+    python backend/models/compress_model.py --weights backend/weights/cp_mid.weights.h5 \
+        --keep 0.5 0.25 --student 16,32,64 64,128
+-----------------------------------------
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+import keras
+from keras import layers
+from sklearn.metrics import roc_auc_score
+
+from patch_based_tensor import (model_builder, chunked_data_gen, balanced_val_subset, fold_batchnorm,
+                                PatchPredictor, batchnorm_affine)
+
+"""
+----------------
+Argparser
+----------------
+"""
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weights", default="backend/weights/cp_mid.weights.h5", help="teacher weights")
+    parser.add_argument("--train", default="training_patches.h5")
+    parser.add_argument("--val", default="val_patches.h5")
+    parser.add_argument("--out_dir", default="backend/models/compressed")
+    parser.add_argument("--keep", type=float, nargs="*", default=[0.5, 0.25],
+                        help="fraction of conv channels / dense units kept, one pruned variant per value")
+    parser.add_argument("--student", nargs=2, action="append", metavar=("FILTERS", "DENSE"),
+                        help="student architecture, ex: --student 16,32,64 64,128 (can be repeated)")
+    parser.add_argument("--steps", type=int, default=3000, help="training steps per variant")
+    parser.add_argument("--batch_size", type=int, default=128)
+    parser.add_argument("--alpha", type=float, default=0.5, help="weight of the labels vs the teacher in the loss")
+    parser.add_argument("--temperature", type=float, default=2.0, help="softening of the teacher / student logits")
+    parser.add_argument("--val_samples", type=int, default=8192)
+    parser.add_argument("--speed_patches", type=int, default=16384, help="patches scored for the speed test")
+    return parser.parse_args()
+
+"""
+-----------------------------------------
+Function: model_layers
+    the layers of a model_builder model by
+    role: (convs, batchnorms, denses), the last
+    dense being the output layer
+-----------------------------------------
+"""
+def model_layers(model):
+    convs = [l for l in model.layers if isinstance(l, layers.Conv2D)]
+    bns = [l for l in model.layers if isinstance(l, layers.BatchNormalization)]
+    denses = [l for l in model.layers if isinstance(l, layers.Dense)]
+    return convs, bns, denses
+
+"""
+-----------------------------------------
+Function: prune_model
+    structured pruning: keeps the <keep>
+    fraction of the most important channels of
+    every conv and units of every hidden dense
+    layer, and copies their weights into a
+    smaller model_builder model
+        conv channel importance - L1 norm of its
+            kernel times its BN scale (how much
+            it can move the next layer)
+        dense unit importance - L1 norm of its
+            incoming times its outgoing weights
+-----------------------------------------
+"""
+def prune_model(teacher, keep):
+    convs, bns, denses = model_layers(teacher)
+
+    conv_keep = []
+    for conv, bn in zip(convs, bns):
+        kernel = conv.get_weights()[0]
+        scale, _ = batchnorm_affine(bn)
+        importance = np.abs(kernel).sum(axis=(0, 1, 2)) * np.abs(scale)
+        n = max(1, int(round(conv.filters * keep)))
+        conv_keep.append(np.sort(np.argsort(importance)[::-1][:n]))
+
+    dense_keep = []
+    for dense, next_dense in zip(denses[:-1], denses[1:]):
+        importance = np.abs(dense.get_weights()[0]).sum(axis=0) * np.abs(next_dense.get_weights()[0]).sum(axis=1)
+        n = max(1, int(round(dense.units * keep)))
+        dense_keep.append(np.sort(np.argsort(importance)[::-1][:n]))
+
+    pruned, _, _ = model_builder(32, filters=tuple(len(k) for k in conv_keep),
+                                 dense_units=tuple(len(k) for k in dense_keep))
+    p_convs, p_bns, p_denses = model_layers(pruned)
+
+    # copy the kept slices, every layer's inputs follow the previous layer's outputs
+    previous = np.arange(convs[0].get_weights()[0].shape[2])
+    for conv, bn, p_conv, p_bn, kept in zip(convs, bns, p_convs, p_bns, conv_keep):
+        kernel, bias = conv.get_weights()
+        p_conv.set_weights([kernel[:, :, previous][..., kept], bias[kept]])
+        p_bn.set_weights([w[kept] for w in bn.get_weights()])
+        previous = kept
+    for dense, p_dense, kept in zip(denses, p_denses, dense_keep + [np.arange(denses[-1].units)]):
+        kernel, bias = dense.get_weights()
+        p_dense.set_weights([kernel[previous][:, kept], bias[kept]])
+        previous = kept
+    return pruned
+
+"""
+-----------------------------------------
+Function: distillation_loss
+    y_true holds (label, teacher probability)
+    loss = alpha * BCE(label, student)
+         + (1 - alpha) * T^2 * BCE(teacher, student)
+    with both teacher and student logits
+    divided by the temperature T in the
+    second term
+-----------------------------------------
+"""
+def distillation_loss(alpha, temperature):
+    def to_logit(p):
+        p = tf.clip_by_value(p, 1e-7, 1 - 1e-7)
+        return tf.math.log(p) - tf.math.log1p(-p)
+
+    def loss(y_true, y_pred):
+        y_pred = tf.cast(tf.reshape(y_pred, (-1,)), tf.float32)
+        label, teacher = y_true[:, 0], y_true[:, 1]
+        hard = keras.losses.binary_crossentropy(label[:, None], y_pred[:, None])
+        soft_teacher = tf.sigmoid(to_logit(teacher) / temperature)
+        soft_student = tf.sigmoid(to_logit(y_pred) / temperature)
+        soft = keras.losses.binary_crossentropy(soft_teacher[:, None], soft_student[:, None])
+        return alpha * hard + (1 - alpha) * temperature ** 2 * soft
+    return loss
+
+"""
+-----------------------------------------
+Function: label_accuracy
+    accuracy against the labels only (the first
+    column of the distillation targets)
+-----------------------------------------
+"""
+def label_accuracy(y_true, y_pred):
+    return keras.metrics.binary_accuracy(y_true[:, :1], tf.reshape(y_pred, (-1, 1)))
+
+"""
+-----------------------------------------
+Function: distill
+    trains <student> for <steps> batches of the
+    training file, each batch labelled with
+    the teacher's predictions
+-----------------------------------------
+"""
+def distill(student, teacher, args):
+    teacher_fn = tf.function(lambda x: tf.cast(teacher(x, training=False), tf.float32))
+
+    def add_teacher(x, y):
+        x = tf.cast(x, tf.float32)
+        y = tf.cast(y, tf.float32)
+        return x, tf.stack([y, tf.reshape(teacher_fn(x), (-1,))], axis=1)
+
+    training = chunked_data_gen(args.train, batch_size=args.batch_size, shuffle=True).repeat()
+    training = training.map(add_teacher).prefetch(tf.data.AUTOTUNE)
+
+    student.compile(optimizer=keras.optimizers.Adam(learning_rate=0.0005),
+                    loss=distillation_loss(args.alpha, args.temperature),
+                    metrics=[label_accuracy])
+    student.fit(training, steps_per_epoch=args.steps, epochs=1, verbose=2)
+    return student
+
+"""
+-----------------------------------------
+Function: evaluate
+    (accuracy, ROC AUC) on the validation subset,
+    inputs fed the same way as during training
+-----------------------------------------
+"""
+def evaluate(model, x_val, y_val):
+    preds = model.predict(x_val.astype(np.float32), batch_size=1024, verbose=0).reshape(-1)
+    accuracy = float(np.mean((preds > 0.5) == y_val))
+    auc = float(roc_auc_score(y_val, preds)) if len(np.unique(y_val)) > 1 else float('nan')
+    return accuracy, auc
+
+"""
+-----------------------------------------
+Function: patches_per_sec
+    scores <patches> with the API's inference
+    path: BN folded, PatchPredictor, fixed
+    batches of <batch_size> (the tail batch
+    zero padded), inputs unscaled like in
+    evaluate
+-----------------------------------------
+"""
+def patches_per_sec(model, patches, batch_size=128):
+    predictor = PatchPredictor(fold_batchnorm(model), jit_compile=False)
+
+    def run(chunk):
+        batch = np.zeros((batch_size, *chunk.shape[1:]), dtype=np.float32)
+        batch[:len(chunk)] = chunk
+        return predictor.predict(batch)[:len(chunk)]
+
+    run(patches[:batch_size])
+    start = time.perf_counter()
+    for i in range(0, len(patches), batch_size):
+        run(patches[i:i + batch_size])
+    return len(patches) / (time.perf_counter() - start)
+
+def main(args):
+    os.makedirs(args.out_dir, exist_ok=True)
+    x_val, y_val = balanced_val_subset(args.val, args.val_samples)
+    speed_patches = np.resize(x_val, (args.speed_patches, 32, 32, 3))
+
+    teacher, _, _ = model_builder(32)
+    teacher.load_weights(args.weights)
+
+    # (name, model, filters, dense units)
+    variants = []
+    for keep in args.keep:
+        print(f"[INFO] Pruning to {keep:.0%} of the channels / units...")
+        pruned = prune_model(teacher, keep)
+        convs, _, denses = model_layers(pruned)
+        variants.append((f"pruned_{int(keep * 100)}", pruned,
+                         [c.filters for c in convs], [d.units for d in denses[:-1]]))
+    for filters, dense in args.student or []:
+        filters = [int(f) for f in filters.split(",")]
+        dense = [int(d) for d in dense.split(",")]
+        student, _, _ = model_builder(32, filters=tuple(filters), dense_units=tuple(dense))
+        variants.append((f"student_{'-'.join(map(str, filters))}_{'-'.join(map(str, dense))}", student, filters, dense))
+
+    results = []
+    accuracy, auc = evaluate(teacher, x_val, y_val)
+    results.append({"variant": "teacher", "params": teacher.count_params(),
+                    "patches_per_sec": patches_per_sec(teacher, speed_patches),
+                    "val_accuracy": accuracy, "val_auc": auc})
+
+    for name, model, filters, dense in variants:
+        print(f"[INFO] Training {name} against the teacher...")
+        distill(model, teacher, args)
+        accuracy, auc = evaluate(model, x_val, y_val)
+        results.append({"variant": name, "params": model.count_params(),
+                        "patches_per_sec": patches_per_sec(model, speed_patches),
+                        "val_accuracy": accuracy, "val_auc": auc})
+
+        # weights plus what model_builder needs to rebuild the model
+        weights_path = os.path.join(args.out_dir, f"{name}.weights.h5")
+        model.save_weights(weights_path)
+        with open(os.path.join(args.out_dir, f"{name}.json"), "w") as f:
+            json.dump({"filters": filters, "dense_units": dense, "weights": os.path.basename(weights_path),
+                       **results[-1]}, f, indent=2)
+
+    # summary table
+    base = results[0]["patches_per_sec"]
+    print()
+    print(f"{'variant':<26} {'params':>10} {'patches/s':>10} {'speedup':>8} {'val acc':>8} {'val AUC':>8}")
+    for r in results:
+        print(f"{r['variant']:<26} {r['params']:>10,} {r['patches_per_sec']:>10,.0f} "
+              f"{r['patches_per_sec'] / base:>7.2f}x {r['val_accuracy']:>8.4f} {r['val_auc']:>8.4f}")
+    with open(os.path.join(args.out_dir, "report.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
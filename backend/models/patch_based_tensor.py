@@ -1,4 +1,12 @@
 import os
+import sys
+import json
+import time
+import socket
+import subprocess
+import queue
+import shutil
+import threading
 import argparse
 import tensorflow as tf
 import matplotlib
@@ -8,9 +16,11 @@ from matplotlib import cm
 import pandas as pd
 from PIL import Image
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import random
 import h5py
+from collections import deque
 from tqdm import tqdm
 import keras
 from keras import layers
@@ -30,11 +40,31 @@ Argparser
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--patients", required=True, help="name of directory of the preprocessed training files after project root folder 'Early-Detection-Of...'")
-    parser.add_argument("--hypertune", action='store_true')
+    parser.add_argument("--hypertune", action='store_true', help="run the hyperparameter search (Hyperband) instead of training")
+    parser.add_argument("--tune_workers", type=int, default=4, help="parallel trial processes for --hypertune")
+    parser.add_argument("--tune_samples", type=int, default=65536, help="training patches in the cached search subset")
+    parser.add_argument("--tune_max_epochs", type=int, default=9, help="most epochs (over the subset) any trial is trained for")
+    parser.add_argument("--tune_dir", default="logs/hypertune", help="search results and the cached subsets")
     parser.add_argument("--train", action='store_true', help='train a new model')
     parser.add_argument("--make_dataset", action='store_true', help='remake the dataset files')
     parser.add_argument("--batch_size", type=int , default=128, help="batch size used for training")
+    parser.add_argument("--readers", type=int, default=4,
+                        help="number of h5 chunk reader processes (or mmap shard reader generators) during training")
+    parser.add_argument("--data_format", choices=["h5", "mmap", "stacks"], default="h5",
+                        help="train from the lzf h5 file, from memory mapped .npy shards (converted from the h5 file by --make_dataset), "
+                             "or sample patches on the fly from slice stacks (preprocessed with --patch_format stacks)")
+    parser.add_argument("--samples_per_epoch", type=int, default=None, help="samples per epoch with --data_format stacks (default: number of valid windows)")
+    parser.add_argument("--val_samples", type=int, default=8192, help="patches in the cached, patient balanced validation subset")
+    parser.add_argument("--val_batch_size", type=int, default=1024, help="batch size used for validation")
+    parser.add_argument("--full_validation", action="store_true", help="validate on the whole validation file instead of the cached subset")
+    parser.add_argument("--val_every", type=int, default=0, help="also validate every N training steps (0 = only at the end of the epoch)")
     parser.add_argument("--resume", action="store_true", help="decide whether to resume training from previous checkpoint")
+    parser.add_argument("--jit_compile", action="store_true", help="compile the training step with XLA")
+    parser.add_argument("--mixed_precision", action="store_true", help="train in bfloat16 mixed precision (if the CPU supports it)")
+    parser.add_argument("--metrics_log", default=None,
+                        help="record step time, input wait, samples/sec and input queue depth to <metrics_log>.csv/.json")
+    parser.add_argument("--profile_steps", type=int, nargs=2, default=None, metavar=("N", "M"),
+                        help="record a TensorFlow profiler trace of training steps N to M (into logs/profile)")
     return parser.parse_args()
 
 """
@@ -48,34 +78,77 @@ def load_patch(path):
     arr = np.asarray(Image.open(patch_path))
     return arr, label
 
+"""
+--------------------------------------------
+Function load_patch_batch:
+    loads a whole batch of patches in a worker
+    so only one stacked array per batch is
+    sent back to the parent process
+--------------------------------------------
+"""
+def load_patch_batch(entries):
+    arrs = np.stack([load_patch(entry)[0] for entry in entries])
+    labels = np.array([label for _, label in entries], dtype=np.int32)
+    return arrs, labels
+
+"""
+--------------------------------------------
+Function list_patch_dir:
+    returns the patch PNGs of one slice
+    folder (os.scandir avoids a stat per file)
+--------------------------------------------
+"""
+def list_patch_dir(entry):
+    img_path, label = entry
+    with os.scandir(img_path) as it:
+        patches = sorted(e.path for e in it if e.is_file() and e.name.lower().endswith('.png'))
+    return [(patch_path, label) for patch_path in patches]
+
 """
 -----------------------------------------
 Function: create_dataset_stream
     new dataset creation function that
     saves converted dataset to h5 files
+
+    patches are loaded by the pool in batches
+    of <chunks_per_write> h5 chunks and every
+    batch is written with a single call that
+    starts on a chunk boundary, so each lzf
+    chunk is compressed once
 -----------------------------------------
 """
-def create_dataset_stream(base_dir, output_file, threads=8):
+def create_dataset_stream(base_dir, output_file, threads=8, chunks_per_write=4):
+    chunk_len = 256
+
     # Estimate total patches
     print('getting all patch paths')
-    patch_entries = []   # list of (patch_file_path, label)
-    i = 0
-    # walk through each patch in the indicated directory
+    image_dirs = []   # list of (slice_folder_path, label)
+    dir_patients = []   # patient number of each slice folder
+    patients = []   # "class/patient" names
+    # walk through each patient in the indicated directory
     for label, class_name in enumerate(['control', 'ms']):
         class_dir = os.path.join(base_dir, class_name)
-        for patient in os.listdir(class_dir):
+        for patient in sorted(os.listdir(class_dir)):
             patient_path = os.path.join(class_dir, patient)
-            for image in os.listdir(patient_path):
-                img_path = os.path.join(patient_path, image)
-                for patch in os.listdir(img_path):
-                    patch_path = os.path.join(img_path, patch)
-                    if patch_path.lower().endswith('.png'):
-                        # append found path to array
-                        patch_entries.append((patch_path, label))
-                        i += 1
+            for image in sorted(os.listdir(patient_path)):
+                image_dirs.append((os.path.join(patient_path, image), label))
+                dir_patients.append(len(patients))
+            patients.append(f"{class_name}/{patient}")
+
+    # the slice folders hold the actual patches, list them on several threads
+    patch_entries = []   # list of (patch_file_path, label)
+    patch_patients = []
+    with ThreadPool(processes=threads) as pool:
+        for patient, entries in zip(dir_patients, pool.imap(list_patch_dir, image_dirs)):
+            patch_entries.extend(entries)
+            patch_patients.extend([patient] * len(entries))
 
     total_patches = len(patch_entries)
 
+    # work is handed out in whole chunks so every write is chunk aligned
+    write_len = chunk_len * chunks_per_write
+    batches = [patch_entries[i:i + write_len] for i in range(0, total_patches, write_len)]
+
     # create and open new file for save data
     """
     NOTE: lzf compression was used for write speeds at the cost of lower compression
@@ -87,21 +160,70 @@ def create_dataset_stream(base_dir, output_file, threads=8):
                                 shape=(total_patches, 32, 32, 3),
                                 dtype=np.uint8, 
                                 compression='lzf', 
-                                chunks=(256, 32, 32, 3))
+                                chunks=(chunk_len, 32, 32, 3))
         y_ds = f.create_dataset('train_y', 
                                 shape=(total_patches,), 
                                 dtype=np.int32, 
                                 compression='lzf')
+        # patient of every patch (index into the 'patients' attribute)
+        f.create_dataset('patient', data=np.array(patch_patients, dtype=np.int32), compression='lzf')
+        f.attrs['patients'] = patients
 
         # multithreaded loading of files to speed up runtime
-        with Pool(processes=threads) as pool:
-            for idx, (arr, label) in enumerate(
-                tqdm(pool.imap(load_patch, patch_entries, chunksize=128),
-                     total=total_patches,
-                     desc="Loading patches")
-            ):
-                x_ds[idx] = arr
-                y_ds[idx] = label
+        with Pool(processes=threads) as pool, tqdm(total=total_patches, desc="Loading patches") as pbar:
+            start = 0
+            for arrs, labels in pool.imap(load_patch_batch, batches):
+                end = start + len(arrs)
+                x_ds[start:end] = arrs
+                y_ds[start:end] = labels
+                start = end
+                pbar.update(len(arrs))
+
+"""
+-----------------------------------------
+Function: create_dataset_from_shards
+    builds the same h5 file as
+    create_dataset_stream, but from the .npy
+    patch shards written by preprocessing
+    with --patch_format shards (no PNGs)
+-----------------------------------------
+"""
+SHARD_INDEX = 'patch_shards.csv'
+
+def create_dataset_from_shards(base_dir, output_file):
+    # read the shard index written by preprocess_mri_to_png.py
+    index = pd.read_csv(os.path.join(base_dir, SHARD_INDEX))
+    total_patches = int(index['n_patches'].sum())
+    print(f'found {len(index)} shards with {total_patches} patches')
+
+    with h5py.File(output_file, 'w') as f:
+        x_ds = f.create_dataset('train_x', 
+                                shape=(total_patches, 32, 32, 3),
+                                dtype=np.uint8, 
+                                compression='lzf', 
+                                chunks=(256, 32, 32, 3))
+        y_ds = f.create_dataset('train_y', 
+                                shape=(total_patches,), 
+                                dtype=np.int32, 
+                                compression='lzf')
+        # patient of every patch (index into the 'patients' attribute)
+        patients = sorted(index['patient_id'].astype(str).unique())
+        patient_number = {pid: i for i, pid in enumerate(patients)}
+        p_ds = f.create_dataset('patient', 
+                                shape=(total_patches,), 
+                                dtype=np.int32, 
+                                compression='lzf')
+        f.attrs['patients'] = patients
+
+        # each shard is copied in one write instead of one write per patch
+        start = 0
+        for shard in tqdm(index.itertuples(), total=len(index), desc="Copying shards"):
+            patches = np.load(os.path.join(base_dir, shard.file), mmap_mode='r')
+            end = start + len(patches)
+            x_ds[start:end] = patches
+            y_ds[start:end] = shard.label
+            p_ds[start:end] = patient_number[str(shard.patient_id)]
+            start = end
 
 """
 -----------------------------------------
@@ -140,6 +262,671 @@ def data_gen(path, batch_size=32, shuffle=True):
     ds = ds.prefetch(tf.data.AUTOTUNE)
     return ds
 
+"""
+-----------------------------------------
+Function: h5_chunk_ids
+    ids of the h5 chunks that belong to one
+    reader (every readers-th chunk) of one
+    shard (every num_shards-th chunk)
+-----------------------------------------
+"""
+def h5_chunk_ids(data_len, chunk_len, reader=0, readers=1, shard_index=0, num_shards=1):
+    n_chunks = -(-data_len // chunk_len)
+    return np.arange(n_chunks)[shard_index::num_shards][reader::readers]
+
+"""
+-----------------------------------------
+Function: read_h5_chunks
+    reads the whole chunks <chunk_ids> of an
+    h5 patch file (each one decompressed
+    exactly once), returns (x, y)
+-----------------------------------------
+"""
+def read_h5_chunks(x_ds, y_ds, chunk_ids, chunk_len):
+    data_len = len(x_ds)
+    xs, ys = [], []
+    for c in chunk_ids:
+        start = int(c) * chunk_len
+        end = min(start + chunk_len, data_len)
+        xs.append(x_ds[start:end])
+        ys.append(y_ds[start:end])
+    return np.concatenate(xs), np.concatenate(ys)
+
+"""
+-----------------------------------------
+Chunk reader processes
+
+h5py serializes every call behind one global
+lock (and tf.data generators hold the GIL), so
+reader threads can't decompress chunks at the
+same time. The chunks are read in a pool of
+processes instead, one per reader, shared by
+every chunked_data_gen of the process.
+
+fork is fine here, the children only use numpy
+and h5py (like benchmark_formats). The pool is
+created when the dataset is built, before
+tf.data starts running its generators.
+-----------------------------------------
+"""
+_chunk_reader_pools = {}
+_chunk_reader_files = {}
+
+def chunk_reader_pool(processes):
+    if processes not in _chunk_reader_pools:
+        import multiprocessing
+        _chunk_reader_pools[processes] = multiprocessing.get_context("fork").Pool(processes=processes)
+    return _chunk_reader_pools[processes]
+
+def _read_h5_chunks_job(job):
+    # runs in a reader process, which keeps its file handles open between jobs
+    path, chunk_ids, chunk_len = job
+    if path not in _chunk_reader_files:
+        _chunk_reader_files[path] = h5py.File(path, 'r')
+    f = _chunk_reader_files[path]
+    return read_h5_chunks(f['train_x'], f['train_y'], chunk_ids, chunk_len)
+
+"""
+-----------------------------------------
+Function: iter_h5_chunk_batches
+    reads batches from an h5 patch file one
+    whole chunk at a time (see chunked_data_gen)
+
+    with <pool> the chunks are read by the
+    pool's processes, <chunks_per_read> chunks
+    per job and at most <ahead> jobs in flight,
+    otherwise they are read in this process
+-----------------------------------------
+"""
+def iter_h5_chunk_batches(path, batch_size=32, shuffle=True, buffer_chunks=64, reader=0, readers=1, shard_index=0, num_shards=1,
+                          pool=None, chunks_per_read=4, ahead=8):
+    rng = np.random.default_rng()
+
+    with h5py.File(path, 'r') as f:
+        data_len = len(f['train_x'])
+        chunk_len = f['train_x'].chunks[0] if f['train_x'].chunks else 256
+
+    my_chunks = h5_chunk_ids(data_len, chunk_len, reader, readers, shard_index, num_shards)
+    if shuffle:
+        rng.shuffle(my_chunks)
+    groups = [my_chunks[i:i + chunks_per_read] for i in range(0, len(my_chunks), chunks_per_read)]
+
+    def iter_reads():
+        if pool is None:
+            with h5py.File(path, 'r') as f:
+                for group in groups:
+                    yield read_h5_chunks(f['train_x'], f['train_y'], group, chunk_len)
+            return
+
+        # results come back in order, only <ahead> jobs are queued at a time
+        jobs = deque()
+        try:
+            for group in groups:
+                jobs.append(pool.apply_async(_read_h5_chunks_job, ((path, group, chunk_len),)))
+                if len(jobs) >= ahead:
+                    yield jobs.popleft().get()
+            while jobs:
+                yield jobs.popleft().get()
+        finally:
+            # results of jobs that are never collected are just dropped
+            jobs.clear()
+
+    # patches left over from the previous buffer (fewer than batch_size)
+    x_left = np.empty((0, 32, 32, 3), dtype=np.uint8)
+    y_left = np.empty((0,), dtype=np.int32)
+    xs, ys, n_buffered = [x_left], [y_left], 0
+
+    reads = iter_reads()
+    while True:
+        read = next(reads, None)
+        if read is not None:
+            xs.append(read[0])
+            ys.append(read[1])
+            n_buffered += chunks_per_read
+            if n_buffered < buffer_chunks:
+                continue
+        elif n_buffered == 0:
+            break
+
+        x_buf = np.concatenate(xs)
+        y_buf = np.concatenate(ys)
+
+        # shuffle the patches of every chunk in the buffer together
+        if shuffle:
+            order = rng.permutation(len(x_buf))
+            x_buf = x_buf[order]
+            y_buf = y_buf[order]
+
+        n_full = len(x_buf) // batch_size * batch_size
+        for b in range(0, n_full, batch_size):
+            yield x_buf[b:b + batch_size], y_buf[b:b + batch_size]
+        x_left, y_left = x_buf[n_full:], y_buf[n_full:]
+        xs, ys, n_buffered = [x_left], [y_left], 0
+
+        if read is None:
+            break
+
+    # last partial batch of this reader
+    if len(x_left):
+        yield x_left, y_left
+
+"""
+-----------------------------------------
+Function: interleave_readers
+    runs <readers> batch generators side by
+    side in tf.data and mixes their batches
+    make_gen(reader) must yield (x, y) batches
+
+    the generators all run under the GIL, so
+    this overlaps their reads with training
+    (and with numpy work that releases the
+    GIL, like copying from memory mapped
+    shards), it does not make them run in
+    parallel
+-----------------------------------------
+"""
+def interleave_readers(make_gen, readers, deterministic):
+    # outputs are already batched
+    output_sig = (
+        tf.TensorSpec(shape=(None, 32, 32, 3), dtype=tf.uint8),
+        tf.TensorSpec(shape=(None,), dtype=tf.int32)
+    )
+
+    ds = tf.data.Dataset.range(readers).interleave(
+        lambda r: tf.data.Dataset.from_generator(make_gen, args=(r,), output_signature=output_sig),
+        cycle_length=readers,
+        block_length=1,
+        num_parallel_calls=readers,
+        deterministic=deterministic)
+    ds = ds.prefetch(tf.data.AUTOTUNE)
+    return ds
+
+"""
+-----------------------------------------
+Function: chunked_data_gen
+    faster replacement for data_gen when
+    training from the lzf h5 files
+
+    data_gen reads one random patch at a time,
+    which makes h5py decompress a whole
+    (256, 32, 32, 3) chunk to use a single
+    patch. Here the shuffling is done at chunk
+    level instead:
+        - the chunk order is shuffled every epoch
+        - whole chunks are read (decompressed once)
+        - <buffer_chunks> chunks are kept in memory
+          and their patches shuffled together
+        - batches are built in numpy and handed
+          to tf.data already batched
+    with <readers> > 1 the chunks are read and
+    decompressed by that many reader processes
+    at the same time (see chunk_reader_pool).
+
+    shard_index / num_shards keep only every
+    num_shards-th chunk (for splitting the data
+    between training processes)
+-----------------------------------------
+"""
+def chunked_data_gen(path, batch_size=32, shuffle=True, buffer_chunks=64, readers=4, shard_index=0, num_shards=1):
+    # only the layout of the file is needed here, the readers open their own handles
+    with h5py.File(path, 'r') as f:
+        data_len = len(f['train_x'])
+        chunk_len = f['train_x'].chunks[0] if f['train_x'].chunks else 256
+    n_chunks = len(h5_chunk_ids(data_len, chunk_len, shard_index=shard_index, num_shards=num_shards))
+    readers = max(1, min(readers, n_chunks))
+    pool = chunk_reader_pool(readers) if readers > 1 else None
+
+    def gen():
+        yield from iter_h5_chunk_batches(path, batch_size, shuffle, buffer_chunks,
+                                         shard_index=shard_index, num_shards=num_shards,
+                                         pool=pool, ahead=2 * readers)
+
+    # outputs are already batched
+    output_sig = (
+        tf.TensorSpec(shape=(None, 32, 32, 3), dtype=tf.uint8),
+        tf.TensorSpec(shape=(None,), dtype=tf.int32)
+    )
+    ds = tf.data.Dataset.from_generator(gen, output_signature=output_sig)
+    return ds.prefetch(tf.data.AUTOTUNE)
+
+"""
+-----------------------------------------
+Function: convert_h5_to_mmap_shards
+    converts an h5 patch file into fixed size
+    uncompressed .npy shards plus an index:
+        <out_dir>/x_00000.npy   (n, 32, 32, 3) uint8
+        <out_dir>/y_00000.npy   (n,) int32
+        <out_dir>/index.json
+    the shards can be memory mapped, so there
+    is nothing to decompress and every process
+    reading them shares the same page cache
+-----------------------------------------
+"""
+MMAP_INDEX = 'index.json'
+
+def convert_h5_to_mmap_shards(h5_path, out_dir, shard_size=65536):
+    os.makedirs(out_dir, exist_ok=True)
+
+    shards = []
+    with h5py.File(h5_path, 'r') as f:
+        x_ds = f['train_x']
+        y_ds = f['train_y']
+        data_len = len(x_ds)
+
+        for i, start in enumerate(tqdm(range(0, data_len, shard_size), desc="Writing shards")):
+            end = min(start + shard_size, data_len)
+            entry = {"x": f"x_{i:05d}.npy", "y": f"y_{i:05d}.npy", "n_patches": end - start}
+            for key, ds in [("x", x_ds), ("y", y_ds)]:
+                # write to a temp name first so a half written shard is never picked up
+                tmp_path = os.path.join(out_dir, entry[key] + '.tmp')
+                with open(tmp_path, 'wb') as out:
+                    np.save(out, ds[start:end])
+                os.replace(tmp_path, os.path.join(out_dir, entry[key]))
+            shards.append(entry)
+
+    # the index is written last, it marks the conversion as complete
+    index = {"n_patches": data_len, "shard_size": shard_size, "shards": shards}
+    tmp_path = os.path.join(out_dir, MMAP_INDEX + '.tmp')
+    with open(tmp_path, 'w') as out:
+        json.dump(index, out, indent=2)
+    os.replace(tmp_path, os.path.join(out_dir, MMAP_INDEX))
+    return index
+
+"""
+-----------------------------------------
+Function: open_mmap_shards
+    opens every shard in read only mmap mode
+    returns (index, list of x maps, list of y maps)
+-----------------------------------------
+"""
+def open_mmap_shards(shard_dir):
+    with open(os.path.join(shard_dir, MMAP_INDEX)) as f:
+        index = json.load(f)
+    xs = [np.load(os.path.join(shard_dir, s["x"]), mmap_mode='r') for s in index["shards"]]
+    ys = [np.load(os.path.join(shard_dir, s["y"]), mmap_mode='r') for s in index["shards"]]
+    return index, xs, ys
+
+"""
+-----------------------------------------
+Function: iter_mmap_batches
+    reads batches from memory mapped shards
+    shuffling is done over every patch (random
+    reads are cheap, nothing is decompressed)
+-----------------------------------------
+"""
+def iter_mmap_batches(shard_dir, batch_size=32, shuffle=True, reader=0, readers=1, shard_index=0, num_shards=1):
+    index, xs, ys = open_mmap_shards(shard_dir)
+    shard_size = index["shard_size"]
+
+    ids = np.arange(index["n_patches"])[shard_index::num_shards][reader::readers]
+    if shuffle:
+        np.random.default_rng().shuffle(ids)
+
+    for b in range(0, len(ids), batch_size):
+        # sorted ids keep the reads of a batch in file order
+        idx = np.sort(ids[b:b + batch_size])
+        shard_of = idx // shard_size
+
+        x = np.empty((len(idx), 32, 32, 3), dtype=np.uint8)
+        y = np.empty((len(idx),), dtype=np.int32)
+        for s in np.unique(shard_of):
+            sel = shard_of == s
+            offsets = idx[sel] - s * shard_size
+            x[sel] = xs[s][offsets]
+            y[sel] = ys[s][offsets]
+        yield x, y
+
+"""
+-----------------------------------------
+Function: mmap_data_gen
+    same as chunked_data_gen but reads the
+    memory mapped shards written by
+    convert_h5_to_mmap_shards
+-----------------------------------------
+"""
+def mmap_data_gen(shard_dir, batch_size=32, shuffle=True, readers=4, shard_index=0, num_shards=1):
+    def gen(reader):
+        yield from iter_mmap_batches(shard_dir, batch_size, shuffle,
+                                     reader, readers, shard_index, num_shards)
+
+    return interleave_readers(gen, readers, deterministic=not shuffle)
+
+"""
+-----------------------------------------
+Function: read_h5_rows
+    reads the rows <ids> (sorted) of an h5
+    dataset into <out>, a whole block of chunks
+    at a time in file order (much faster than
+    fancy indexing a compressed dataset)
+-----------------------------------------
+"""
+def read_h5_rows(ds, ids, out, desc=None):
+    block = (ds.chunks[0] if ds.chunks else 256) * 64
+    for start in tqdm(range(0, len(ds), block), desc=desc, disable=desc is None):
+        lo, hi = np.searchsorted(ids, [start, start + block])
+        if lo < hi:
+            out[lo:hi] = ds[start:start + block][ids[lo:hi] - start]
+    return out
+
+"""
+-----------------------------------------
+Function: cache_patch_subset
+    copies a random, class stratified subset of
+    an h5 patch file into one uncompressed .npy
+    shard (same layout as convert_h5_to_mmap_shards,
+    so mmap_data_gen reads it)
+
+    balance=True takes the same number of patches
+    of each class, balance=False keeps the class
+    ratio of the file
+    an existing subset made from the same file
+    with the same settings is reused
+-----------------------------------------
+"""
+def cache_patch_subset(h5_path, out_dir, n_samples, seed=0, balance=True):
+    settings = {"source": os.path.abspath(h5_path), "seed": seed, "balance": balance}
+    index_path = os.path.join(out_dir, MMAP_INDEX)
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        if index.get("settings") == settings and index.get("requested") == n_samples:
+            print(f"[INFO] Using cached subset {out_dir} ({index['n_patches']} patches)")
+            return index
+
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    with h5py.File(h5_path, 'r') as f:
+        x_ds = f['train_x']
+        labels = f['train_y'][:]
+        data_len = len(labels)
+
+        # pick the ids of every class
+        classes, counts = np.unique(labels, return_counts=True)
+        picked = []
+        for c, count in zip(classes, counts):
+            if balance:
+                take = n_samples // len(classes)
+            else:
+                take = int(round(n_samples * count / data_len))
+            class_ids = np.flatnonzero(labels == c)
+            picked.append(rng.choice(class_ids, size=min(take, count), replace=False))
+        ids = np.sort(np.concatenate(picked))
+
+        entry = {"x": "x_00000.npy", "y": "y_00000.npy", "n_patches": len(ids)}
+        x_tmp = os.path.join(out_dir, entry["x"] + '.tmp')
+        x_out = np.lib.format.open_memmap(x_tmp, mode='w+', dtype=np.uint8, shape=(len(ids), 32, 32, 3))
+        read_h5_rows(x_ds, ids, x_out, desc=f"Caching {os.path.basename(out_dir)}")
+        x_out.flush()
+        del x_out
+        os.replace(x_tmp, os.path.join(out_dir, entry["x"]))
+
+        y_tmp = os.path.join(out_dir, entry["y"] + '.tmp')
+        with open(y_tmp, 'wb') as out:
+            np.save(out, labels[ids].astype(np.int32))
+        os.replace(y_tmp, os.path.join(out_dir, entry["y"]))
+
+    # the index is written last, it marks the subset as complete
+    index = {"n_patches": len(ids), "shard_size": len(ids), "shards": [entry],
+             "requested": n_samples, "settings": settings}
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as out:
+        json.dump(index, out, indent=2)
+    os.replace(tmp_path, index_path)
+    return index
+
+"""
+-----------------------------------------
+Function: take_balanced
+    picks <n> ids spread as evenly as possible
+    over <groups> (list of id arrays): every
+    group gets the same share, and what small
+    groups can't fill goes to the bigger ones
+-----------------------------------------
+"""
+def take_balanced(groups, n, rng):
+    picked = []
+    groups = sorted(groups, key=len)
+    for i, group in enumerate(groups):
+        share = (n - sum(len(p) for p in picked)) // (len(groups) - i)
+        picked.append(rng.choice(group, size=min(share, len(group)), replace=False))
+    return np.concatenate(picked) if picked else np.empty(0, dtype=np.int64)
+
+"""
+-----------------------------------------
+Function: balanced_val_subset
+    draws a fixed validation subset from an h5
+    patch file: half of the patches from each
+    class, and inside a class the same number
+    from every patient (so patients with many
+    slices don't dominate the score)
+    returns (x uint8, y int32) numpy arrays
+
+    files made before the patient of each patch
+    was recorded are only balanced by class
+-----------------------------------------
+"""
+def balanced_val_subset(path, n_samples=8192, seed=0):
+    rng = np.random.default_rng(seed)
+    with h5py.File(path, 'r') as f:
+        labels = f['train_y'][:]
+        has_patients = 'patient' in f
+        if has_patients:
+            patients = f['patient'][:]
+        else:
+            print(f"[WARNING] {path} has no patient ids, validation subset is only balanced by class")
+            patients = np.zeros_like(labels)
+
+        classes = np.unique(labels)
+        picked = []
+        for c in classes:
+            class_ids = np.flatnonzero(labels == c)
+            groups = [class_ids[patients[class_ids] == p] for p in np.unique(patients[class_ids])]
+            picked.append(take_balanced(groups, n_samples // len(classes), rng))
+        ids = np.sort(np.concatenate(picked))
+
+        x = read_h5_rows(f['train_x'], ids, np.empty((len(ids), 32, 32, 3), dtype=np.uint8))
+        y = labels[ids].astype(np.int32)
+
+    from_patients = f" from {len(np.unique(patients[ids]))} patients" if has_patients else ""
+    print(f"[INFO] Validation subset: {len(ids)} patches{from_patients}")
+    return x, y
+
+"""
+-----------------------------------------
+Function: val_subset_gen
+    the balanced validation subset as a
+    tf.data dataset kept in memory: drawn once,
+    never shuffled, in big batches
+    <path> is an h5 patch file or a folder of
+    slice stacks (see stack_val_subset)
+-----------------------------------------
+"""
+def val_subset_gen(path, n_samples=8192, batch_size=1024, seed=0):
+    if os.path.isdir(path):
+        x, y = stack_val_subset(path, n_samples, seed)
+    else:
+        x, y = balanced_val_subset(path, n_samples, seed)
+    ds = tf.data.Dataset.from_tensor_slices((x, y))
+    ds = ds.batch(batch_size)
+    ds = ds.prefetch(tf.data.AUTOTUNE)
+    return ds
+
+"""
+-----------------------------------------
+Function: load_slice_stacks
+    loads every slice stack written by
+    preprocessing with --patch_format stacks
+    into one array in RAM (stacks are ~100x
+    smaller than the patches cut from them)
+
+    returns a dict with:
+        slices  - uint8 (total slices, 224, 224, 3)
+        windows - int32 (total windows, 3) rows of
+                  (global slice index, top, left)
+        patient_start / patient_count - range of
+                  each patient's rows in windows
+        patient_label - label of each patient
+-----------------------------------------
+"""
+STACK_INDEX = 'slice_stacks.csv'
+
+def load_slice_stacks(base_dir):
+    index = pd.read_csv(os.path.join(base_dir, STACK_INDEX))
+    # patients without any valid window cannot be sampled from
+    index = index[index['n_windows'] > 0].reset_index(drop=True)
+    print(f'found {len(index)} patients with {int(index["n_windows"].sum())} valid windows')
+
+    slices, windows = [], []
+    slice_offset = 0
+    for row in tqdm(index.itertuples(), total=len(index), desc="Loading slice stacks"):
+        stack = np.load(os.path.join(base_dir, row.slices))
+        win = np.load(os.path.join(base_dir, row.windows)).copy()
+        # slice numbers become indices into the combined array
+        win[:, 0] += slice_offset
+        slice_offset += len(stack)
+        slices.append(stack)
+        windows.append(win)
+
+    counts = index['n_windows'].to_numpy(dtype=np.int64)
+    return {
+        "slices": np.concatenate(slices),
+        "windows": np.concatenate(windows),
+        "patient_start": np.concatenate([[0], np.cumsum(counts)[:-1]]),
+        "patient_count": counts,
+        "patient_label": index['label'].to_numpy(dtype=np.int32),
+    }
+
+"""
+-----------------------------------------
+Function: cut_windows
+    cuts the windows <picks> (rows of windows)
+    out of their slices in one indexing call
+-----------------------------------------
+"""
+def cut_windows(slices, windows, picks, patch_size=32):
+    offsets = np.arange(patch_size)
+    s, top, left = windows[picks].T
+    return slices[s[:, None, None],
+                  top[:, None, None] + offsets[None, :, None],
+                  left[:, None, None] + offsets[None, None, :]]
+
+"""
+-----------------------------------------
+Function: stack_val_subset
+    balanced_val_subset for slice stacks: a
+    fixed set of <n_samples> valid windows,
+    half from each class and inside a class the
+    same number from every patient
+    returns (x uint8, y int32) numpy arrays
+-----------------------------------------
+"""
+def stack_val_subset(base_dir, n_samples=8192, seed=0, patch_size=32):
+    rng = np.random.default_rng(seed)
+    data = load_slice_stacks(base_dir)
+    patient_start = data["patient_start"]
+    patient_count = data["patient_count"]
+    patient_label = data["patient_label"]
+
+    classes = np.unique(patient_label)
+    picked = []
+    for c in classes:
+        groups = [np.arange(patient_start[p], patient_start[p] + patient_count[p])
+                  for p in np.flatnonzero(patient_label == c)]
+        picked.append(take_balanced(groups, n_samples // len(classes), rng))
+    picks = np.sort(np.concatenate(picked))
+
+    x = cut_windows(data["slices"], data["windows"], picks, patch_size)
+    y = np.repeat(patient_label, patient_count)[picks].astype(np.int32)
+    print(f"[INFO] Validation subset: {len(picks)} windows from {len(patient_label)} patients")
+    return x, y
+
+"""
+-----------------------------------------
+Function: stack_data_gen
+    training data made on the fly from the
+    slice stacks: every batch is a fresh random
+    set of valid windows cut out of the slices
+    (only windows that passed the preprocessing
+    patch filter are ever picked)
+
+    balance=True picks a class first, then a
+    patient of that class, then one of that
+    patient's windows, so every class and every
+    patient is seen equally often no matter how
+    many patches they have. balance=False picks
+    uniformly over all windows.
+
+    batches are built in a parallel tf.data map,
+    one epoch is <samples_per_epoch> samples
+-----------------------------------------
+"""
+def stack_data_gen(base_dir, batch_size=32, samples_per_epoch=None, patch_size=32, balance=True):
+    data = load_slice_stacks(base_dir)
+    slices = data["slices"]
+    windows = data["windows"]
+    patient_start = data["patient_start"]
+    patient_count = data["patient_count"]
+    patient_label = data["patient_label"]
+    window_label = np.repeat(patient_label, patient_count)
+
+    # patients sorted by class, for the balanced draw
+    by_class = np.argsort(patient_label, kind='stable')
+    class_ids, class_start, class_size = np.unique(patient_label[by_class], return_index=True, return_counts=True)
+
+    if samples_per_epoch is None:
+        samples_per_epoch = len(windows)
+    steps = max(1, samples_per_epoch // batch_size)
+
+    def make_batch(_):
+        rng = np.random.default_rng()
+        if balance:
+            cls = rng.integers(len(class_ids), size=batch_size)
+            patients = by_class[class_start[cls] + (rng.random(batch_size) * class_size[cls]).astype(np.int64)]
+            picks = patient_start[patients] + (rng.random(batch_size) * patient_count[patients]).astype(np.int64)
+        else:
+            picks = rng.integers(len(windows), size=batch_size)
+
+        return cut_windows(slices, windows, picks, patch_size), window_label[picks]
+
+    def tf_make_batch(i):
+        x, y = tf.numpy_function(make_batch, [i], (tf.uint8, tf.int32))
+        x.set_shape((batch_size, patch_size, patch_size, 3))
+        y.set_shape((batch_size,))
+        return x, y
+
+    ds = tf.data.Dataset.range(steps)
+    ds = ds.map(tf_make_batch, num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+    ds = ds.prefetch(tf.data.AUTOTUNE)
+    return ds
+
+"""
+-----------------------------------------
+Function: stack_full_val_gen
+    every valid window of the slice stacks in
+    <base_dir> exactly once, in order (no shuffle,
+    no repeat), for a full validation sweep
+-----------------------------------------
+"""
+def stack_full_val_gen(base_dir, batch_size=1024, patch_size=32):
+    data = load_slice_stacks(base_dir)
+    slices = data["slices"]
+    windows = data["windows"]
+    window_label = np.repeat(data["patient_label"], data["patient_count"]).astype(np.int32)
+
+    def make_batch(picks):
+        return cut_windows(slices, windows, picks, patch_size), window_label[picks]
+
+    def tf_make_batch(picks):
+        x, y = tf.numpy_function(make_batch, [picks], (tf.uint8, tf.int32))
+        x.set_shape((None, patch_size, patch_size, 3))
+        y.set_shape((None,))
+        return x, y
+
+    ds = tf.data.Dataset.range(len(windows)).batch(batch_size)
+    ds = ds.map(tf_make_batch, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    ds = ds.prefetch(tf.data.AUTOTUNE)
+    return ds
+
 """
 --------------------------------------------------------
 Class BatchCheckpoint
@@ -148,59 +935,389 @@ Class BatchCheckpoint
     to retrain a model to test fixes.
 
     Saves to seperate weights file every n steps
+
+    The weights are copied in memory and written
+    by a background thread (from a copy of the model)
+    to a temp file that is then renamed over
+    <filepath>, so training only stalls for the copy
+    and a crash mid-write never leaves a broken file.
+    The last <keep> checkpoints are also kept as
+    <name>.batchNNNNNNN.weights.h5
     
     **recieved help from ChatGPT to get working and to 
     understand how a class could be used to make this work
 --------------------------------------------------------
 """
 class BatchCheckpoint(tf.keras.callbacks.Callback):
-    def __init__(self, filepath, n=500):
+    def __init__(self, filepath, n=500, keep=3):
         super().__init__()
         self.filepath = filepath
         self.n = n
+        self.keep = keep
         self.batch_counter = 0
 
+        # time training spent waiting on checkpoints, and time spent writing them in the background
+        self.stall_seconds = 0.0
+        self.write_seconds = 0.0
+        self.saves = 0
+
+        self._shadow = None     # copy of the model that the writer thread saves from
+        self._writer = None     # thread writing the current checkpoint
+        self._error = None      # exception raised by the writer thread
+        self._rotated = deque() # paths of the last <keep> checkpoints
+
+    # copy of the model built once, so the weights can be saved while training keeps going
+    def on_train_begin(self, logs=None):
+        self._shadow = keras.models.clone_model(self.model)
+        # the copy gets its own optimizer, built so it can hold the optimizer state (saved with the weights for --resume)
+        if getattr(self._shadow, 'optimizer', None) is not None:
+            self._shadow.optimizer.build(self._shadow.trainable_variables)
+
     # check if weights need to be saved after each step
     def on_batch_end(self, batch, logs=None):
         self.batch_counter += 1
         if self.batch_counter % self.n == 0:
-            self.model.save_weights(self.filepath)
-            print(f"\nSaved weights at batch {self.batch_counter}")
+            start = time.perf_counter()
+            # only one write at a time, training waits if the previous one is still going
+            self._wait_for_writer()
+            # the only copy made on the training thread, the file is written in the background
+            weights = self.model.get_weights()
+            optimizer_state = [v.numpy() for v in self.model.optimizer.variables] if self._shadow.optimizer else []
+            self._writer = threading.Thread(target=self._write, args=(weights, optimizer_state, self.batch_counter),
+                                            name="checkpoint-writer", daemon=True)
+            self._writer.start()
+            stalled = time.perf_counter() - start
+            self.stall_seconds += stalled
+            print(f"\nSaving weights at batch {self.batch_counter} (training stalled {stalled:.3f}s)")
+
+    # make sure the last checkpoint is on disk before training returns
+    def on_train_end(self, logs=None):
+        start = time.perf_counter()
+        self._wait_for_writer()
+        self.stall_seconds += time.perf_counter() - start
+        if self.saves:
+            print(f"[INFO] {self.saves} mid-epoch checkpoints: training stalled {self.stall_seconds:.2f}s in total, "
+                  f"{self.write_seconds:.2f}s of writing done in the background")
+
+    def _wait_for_writer(self):
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    # runs on the writer thread
+    def _write(self, weights, optimizer_state, batch_number):
+        try:
+            start = time.perf_counter()
+            self._shadow.set_weights(weights)
+            for var, value in zip(self._shadow.optimizer.variables if optimizer_state else [], optimizer_state):
+                var.assign(value)
+
+            # keras needs the .weights.h5 ending, so the temp name keeps it
+            base = self.filepath[:-len('.weights.h5')] if self.filepath.endswith('.weights.h5') else self.filepath
+            tmp_path = f"{base}.tmp-{os.getpid()}.weights.h5"
+            self._shadow.save_weights(tmp_path)
+
+            if self.keep > 0:
+                # keep a numbered copy of the last <keep> checkpoints
+                rotated = f"{base}.batch{batch_number:07d}.weights.h5"
+                os.replace(tmp_path, rotated)
+                self._rotated.append(rotated)
+                while len(self._rotated) > self.keep:
+                    old = self._rotated.popleft()
+                    if os.path.exists(old):
+                        os.remove(old)
+                shutil.copyfile(rotated, tmp_path)
+
+            # readers of <filepath> (ex: the API) only ever see a complete file
+            os.replace(tmp_path, self.filepath)
+            self.write_seconds += time.perf_counter() - start
+            self.saves += 1
+        except BaseException as e:
+            self._error = e
 
 """
 -----------------------------------------
-Function: model_builder
-    main model builder
+Class PeriodicValidation
+    evaluates <val_dataset> every <n> batches
+    during the epoch (meant for the small
+    cached validation subset) and prints
+    val_loss / val_accuracy
+
+    model.evaluate() can't be used here: it
+    resets and overwrites the compiled metrics
+    that fit() is still accumulating, so the
+    validation runs its own loop with its own
+    loss / accuracy metrics
 -----------------------------------------
 """
-def model_builder(patch_size, resume=False):
-    inputs = keras.Input((patch_size, patch_size, 3))
+class PeriodicValidation(tf.keras.callbacks.Callback):
+    def __init__(self, val_dataset, n=1000):
+        super().__init__()
+        self.val_dataset = val_dataset
+        self.n = n
+        self.history = []   # (batch, val_loss, val_accuracy)
 
-    x = layers.Conv2D(32, 3, activation='relu', padding='same')(inputs)
-    x = layers.BatchNormalization()(x)
-    x = layers.MaxPooling2D(2)(x)
+        self.loss_fn = keras.losses.BinaryCrossentropy(reduction=None)
+        self.val_loss = keras.metrics.Mean()
+        self.val_accuracy = keras.metrics.BinaryAccuracy()
+        self._step = None
 
-    x = layers.Conv2D(64, 3, activation='relu', padding='same')(x)
-    x = layers.BatchNormalization()(x)
-    x = layers.MaxPooling2D(2)(x)
+    def on_train_begin(self, logs=None):
+        def step(x, y):
+            y = tf.reshape(tf.cast(y, tf.float32), (-1, 1))
+            preds = tf.cast(tf.reshape(self.model(tf.cast(x, tf.float32), training=False), (-1, 1)), tf.float32)
+            self.val_loss.update_state(self.loss_fn(y, preds))
+            self.val_accuracy.update_state(y, preds)
+        self._step = tf.function(step, reduce_retracing=True)
 
-    x = layers.Conv2D(128, 3, activation='relu', padding='same', name="last_conv")(x)
-    x = layers.BatchNormalization()(x)
-    x = layers.GlobalAveragePooling2D()(x)
+    def on_batch_end(self, batch, logs=None):
+        if (batch + 1) % self.n == 0:
+            start = time.perf_counter()
+            self.val_loss.reset_state()
+            self.val_accuracy.reset_state()
+            for x, y in self.val_dataset:
+                self._step(x, y)
+            loss = float(self.val_loss.result())
+            accuracy = float(self.val_accuracy.result())
+            self.history.append((batch + 1, loss, accuracy))
+            print(f"\n[INFO] Batch {batch + 1}: val_loss {loss:.4f}, "
+                  f"val_accuracy {accuracy:.4f} ({time.perf_counter() - start:.1f}s)")
+
+"""
+-----------------------------------------
+Function: instrument_dataset
+    wraps a training dataset so the time the
+    model spends waiting for its input can be
+    measured (used with TrainingMonitor)
+
+    a background thread pulls batches from <ds>
+    into a queue of <depth> batches, and for
+    every batch handed to the model
+    (samples, time it was handed over, batches
+    left in the queue) is appended to the
+    returned deque. Keras fetches the next batch
+    while the current step runs, so the wait is
+    worked out by TrainingMonitor from the hand
+    over time and the start of the step.
+-----------------------------------------
+"""
+def instrument_dataset(ds, depth=8):
+    stats = deque()
+    q = queue.Queue(maxsize=depth)
+    done = object()
+
+    def producer():
+        try:
+            for x, y in ds:
+                q.put((x.numpy(), y.numpy()))
+        finally:
+            q.put(done)
+
+    def gen():
+        thread = threading.Thread(target=producer, name="instrumented-input", daemon=True)
+        thread.start()
+        while True:
+            item = q.get()
+            if item is done:
+                return
+            stats.append((len(item[0]), time.perf_counter(), q.qsize()))
+            yield item
+
+    output_sig = (
+        tf.TensorSpec(shape=(None, 32, 32, 3), dtype=tf.uint8),
+        tf.TensorSpec(shape=(None,), dtype=tf.int32)
+    )
+    return tf.data.Dataset.from_generator(gen, output_signature=output_sig), stats
+
+"""
+--------------------------------------------------------
+Class TrainingMonitor
+    records where the training time goes, per step:
+        step_seconds     - whole training step
+        wait_seconds     - time spent waiting on the
+                           input pipeline (needs the
+                           stats from instrument_dataset)
+        compute_seconds  - the rest of the step
+        samples_per_sec
+        queue_depth      - batches ready in the input
+                           queue when the step started
+    rows are written to <log_path>.csv and a summary
+    to <log_path>.json (every <flush_every> steps and
+    at the end of training)
+
+    profile_steps=(N, M) records a TensorFlow profiler
+    trace of steps N to M into <profile_dir>
+    (open it with TensorBoard's profile tab)
+--------------------------------------------------------
+"""
+class TrainingMonitor(tf.keras.callbacks.Callback):
+    def __init__(self, log_path, stats=None, profile_steps=None, profile_dir="logs/profile", flush_every=1000):
+        super().__init__()
+        self.log_path = log_path
+        self.stats = stats
+        self.profile_steps = profile_steps
+        self.profile_dir = profile_dir
+        self.flush_every = flush_every
+        self.rows = []
+        self.step = 0
+        self._step_start = None
+        self._profiling = False
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.step += 1
+        if self.profile_steps and self.step == self.profile_steps[0]:
+            tf.profiler.experimental.start(self.profile_dir)
+            self._profiling = True
+        self._step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        step_seconds = time.perf_counter() - self._step_start
+
+        # input side of this step, from instrument_dataset: the step could not
+        # go further than the time its batch was handed over by the input queue
+        samples, wait, depth = None, 0.0, None
+        if self.stats:
+            samples, ready, depth = self.stats.popleft()
+            wait = min(max(0.0, ready - self._step_start), step_seconds)
+
+        self.rows.append({
+            "step": self.step,
+            "step_seconds": step_seconds,
+            "wait_seconds": wait,
+            "compute_seconds": step_seconds - wait,
+            "samples": samples,
+            "samples_per_sec": samples / step_seconds if samples else None,
+            "queue_depth": depth,
+        })
+
+        if self._profiling and self.step >= self.profile_steps[1]:
+            self._stop_profiler()
+        if self.step % self.flush_every == 0:
+            self.write_logs()
+
+    def on_train_end(self, logs=None):
+        self._stop_profiler()
+        summary = self.write_logs()
+        if summary:
+            print(f"[INFO] {summary['steps']} steps, {summary['mean_step_seconds'] * 1000:.1f} ms/step, "
+                  f"{summary['input_wait_fraction'] * 100:.1f}% of the time waiting on input, "
+                  f"{summary['samples_per_sec'] or 0:,.0f} samples/s")
+            print(f"[INFO] Training metrics written to {self.log_path}.csv / .json")
+
+    def _stop_profiler(self):
+        if self._profiling:
+            tf.profiler.experimental.stop()
+            self._profiling = False
+            print(f"\n[INFO] Profiler trace of steps {self.profile_steps[0]}-{self.profile_steps[1]} saved to {self.profile_dir}")
+
+    # write the per-step rows and a summary, returns the summary
+    def write_logs(self):
+        if not self.rows:
+            return None
+        df = pd.DataFrame(self.rows)
+        # the first step includes building the training graph, it is left out of the summary
+        steady = df.iloc[1:] if len(df) > 1 else df
+        total = steady['step_seconds'].sum()
+        summary = {
+            "steps": int(len(df)),
+            "mean_step_seconds": float(steady['step_seconds'].mean()),
+            "p50_step_seconds": float(steady['step_seconds'].quantile(0.5)),
+            "p95_step_seconds": float(steady['step_seconds'].quantile(0.95)),
+            "mean_wait_seconds": float(steady['wait_seconds'].mean()),
+            "mean_compute_seconds": float(steady['compute_seconds'].mean()),
+            "input_wait_fraction": float(steady['wait_seconds'].sum() / total) if total else 0.0,
+            "samples_per_sec": float(steady['samples'].sum() / total) if steady['samples'].notna().any() else None,
+            "mean_queue_depth": float(steady['queue_depth'].mean()) if steady['queue_depth'].notna().any() else None,
+            "first_step_seconds": float(df['step_seconds'].iloc[0]),
+        }
+
+        os.makedirs(os.path.dirname(self.log_path) or '.', exist_ok=True)
+        df.to_csv(self.log_path + '.csv', index=False)
+        with open(self.log_path + '.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+"""
+-----------------------------------------
+Function: cpu_supports_bf16
+    True if the CPU has native bfloat16 math
+    (AVX512_BF16 or AMX), read from /proc/cpuinfo
+    (Linux only, False anywhere else)
+-----------------------------------------
+"""
+def cpu_supports_bf16():
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('flags'):
+                    flags = line.split(':', 1)[1].split()
+                    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+    except OSError:
+        pass
+    return False
 
-    x = layers.Dense(256, activation='relu')(x)
+"""
+-----------------------------------------
+Function: model_builder
+    main model builder
 
-    x = layers.Dense(512, activation='relu')(x)
-    x = layers.Dropout(0.3)(x)
-    output = layers.Dense(1, activation='sigmoid')(x)
+    jit_compile=True compiles the training step
+    with XLA (keras leaves XLA off on CPU only
+    machines by default)
+    mixed_precision=True runs the layers in
+    bfloat16 (weights stay float32, the output
+    layer stays float32) when the CPU supports it
+
+    filters / dense_units / dropout / learning_rate
+    set the architecture (the defaults are the
+    shipped model, other values are used by the
+    hyperparameter search)
+-----------------------------------------
+"""
+def model_builder(patch_size, resume=False, jit_compile=False, mixed_precision=False,
+                  filters=(32, 64, 128), dense_units=(256, 512), dropout=0.3, learning_rate=0.0001):
+    if mixed_precision and not cpu_supports_bf16():
+        print("[WARNING] CPU has no native bfloat16 support, building the model in float32")
+        mixed_precision = False
+
+    # the policy only applies to the layers built here
+    previous_policy = keras.mixed_precision.global_policy()
+    keras.mixed_precision.set_global_policy('mixed_bfloat16' if mixed_precision else 'float32')
+    try:
+        inputs = keras.Input((patch_size, patch_size, 3))
+
+        x = layers.Conv2D(filters[0], 3, activation='relu', padding='same')(inputs)
+        x = layers.BatchNormalization()(x)
+        x = layers.MaxPooling2D(2)(x)
+
+        x = layers.Conv2D(filters[1], 3, activation='relu', padding='same')(x)
+        x = layers.BatchNormalization()(x)
+        x = layers.MaxPooling2D(2)(x)
+
+        x = layers.Conv2D(filters[2], 3, activation='relu', padding='same', name="last_conv")(x)
+        x = layers.BatchNormalization()(x)
+        x = layers.GlobalAveragePooling2D()(x)
+
+        x = layers.Dense(dense_units[0], activation='relu')(x)
+
+        x = layers.Dense(dense_units[1], activation='relu')(x)
+        x = layers.Dropout(dropout)(x)
+        # sigmoid output kept in float32 for a stable loss and probabilities
+        output = layers.Dense(1, activation='sigmoid', dtype='float32')(x)
+    finally:
+        keras.mixed_precision.set_global_policy(previous_policy)
 
     model = keras.Model(inputs, output)
 
     if resume:
         model.load_weights("backend/models/cp_mid.weights.h5")
-    model.compile(optimizer=keras.optimizers.Adam(learning_rate=0.0001),
+    model.compile(optimizer=keras.optimizers.Adam(learning_rate=learning_rate),
                 loss='binary_crossentropy',
-                metrics=['accuracy'])
+                metrics=['accuracy'],
+                jit_compile=jit_compile)
 
     #set up checkpoints to save current weights
     checkpoint_path = "backend/models/cp.weights.h5"
@@ -212,19 +1329,196 @@ def model_builder(patch_size, resume=False):
                                             verbose=1)
     return model, checkpoint_path, callback
 
+"""
+-----------------------------------------
+Class AddBiasMap
+    adds a fixed (height, width, channels) map,
+    used by fold_batchnorm for the part of a
+    folded BatchNormalization shift that depends
+    on the position (near the zero padding)
+-----------------------------------------
+"""
+class AddBiasMap(layers.Layer):
+    def __init__(self, bias_map, **kwargs):
+        super().__init__(**kwargs)
+        self.bias_map = self.add_weight(shape=bias_map.shape, name='bias_map', trainable=False,
+                                        initializer=keras.initializers.Constant(bias_map))
+
+    def call(self, x):
+        return x + keras.ops.cast(self.bias_map, x.dtype)
+
+"""
+-----------------------------------------
+Function: batchnorm_affine
+    the (scale, shift) per channel that a
+    BatchNormalization layer applies at
+    inference: y = scale * x + shift
+-----------------------------------------
+"""
+def batchnorm_affine(bn):
+    mean = bn.moving_mean.numpy().astype(np.float64)
+    var = bn.moving_variance.numpy().astype(np.float64)
+    gamma = bn.gamma.numpy().astype(np.float64) if bn.scale else np.ones_like(mean)
+    beta = bn.beta.numpy().astype(np.float64) if bn.center else np.zeros_like(mean)
+    scale = gamma / np.sqrt(var + bn.epsilon)
+    return scale, beta - mean * scale
+
+"""
+-----------------------------------------
+Function: fold_batchnorm
+    builds an inference only copy of a
+    model_builder model with the
+    BatchNormalization layers folded away
+    and Dropout removed
+
+    in this model BN comes after the ReLU:
+        y = scale * relu(conv(x)) + shift
+    - scale > 0 moves inside the ReLU, so it
+      is folded into the conv's kernel and bias
+    - shift is carried forward: MaxPooling and
+      GlobalAveragePooling don't change a per
+      channel constant, so it is folded into
+      the next Dense bias, or into the next
+      conv as a bias (plus a small fixed map
+      near the border, where the zero padding
+      doesn't see the shift)
+    a BN that can't be folded (a scale <= 0, or
+    not after a conv) is kept as it is
+
+    convs keep bias + relu together so TF's
+    graph optimizer can run them as one fused
+    op (Conv2D + BiasAdd (+ Add) + Relu)
+-----------------------------------------
+"""
+def fold_batchnorm(model, mixed_precision=False):
+    model_layers = [l for l in model.layers if not isinstance(l, keras.layers.InputLayer)]
+    if mixed_precision and not cpu_supports_bf16():
+        mixed_precision = False
+
+    previous_policy = keras.mixed_precision.global_policy()
+    keras.mixed_precision.set_global_policy('mixed_bfloat16' if mixed_precision else 'float32')
+    try:
+        inputs = keras.Input(model.input_shape[1:])
+        x = inputs
+        shift = None    # per channel shift of a folded BN not applied yet
+        folded = 0
+        i = 0
+        while i < len(model_layers):
+            layer = model_layers[i]
+            next_layer = model_layers[i + 1] if i + 1 < len(model_layers) else None
+
+            if isinstance(layer, layers.Conv2D):
+                kernel, bias = [w.astype(np.float64) for w in layer.get_weights()]
+                activation = keras.activations.serialize(layer.activation)
+                activation = activation if isinstance(activation, str) else activation.get('config', {}).get('name', '')
+
+                # fold the scale of a following BN (inside the ReLU only if it is positive)
+                bn_scale, bn_shift = None, None
+                if isinstance(next_layer, layers.BatchNormalization):
+                    bn_scale, bn_shift = batchnorm_affine(next_layer)
+                    if activation == 'relu' and np.any(bn_scale <= 0):
+                        bn_scale, bn_shift = None, None
+                    elif activation not in ('relu', 'linear'):
+                        bn_scale, bn_shift = None, None
+
+                # shift left by the previous BN: conv(u + shift) = conv(u) + conv(shift)
+                bias_map = None
+                if shift is not None:
+                    shift_img = np.broadcast_to(shift, (1, *x.shape[1:])).astype(np.float64)
+                    shift_map = tf.nn.conv2d(shift_img, kernel, strides=layer.strides,
+                                             padding=layer.padding.upper()).numpy()[0]
+                    # the value away from the border goes into the bias, the rest into a map
+                    center = shift_map[shift_map.shape[0] // 2, shift_map.shape[1] // 2]
+                    bias = bias + center
+                    bias_map = shift_map - center
+                    shift = None
+
+                if bn_scale is not None:
+                    kernel, bias = kernel * bn_scale, bias * bn_scale
+                    if bias_map is not None:
+                        bias_map = bias_map * bn_scale
+                    if activation == 'linear':
+                        bias = bias + bn_shift
+                    else:
+                        shift = bn_shift
+                    folded += 1
+
+                has_map = bias_map is not None and np.any(bias_map != 0)
+                conv = layers.Conv2D(layer.filters, layer.kernel_size, strides=layer.strides,
+                                     padding=layer.padding, name=layer.name,
+                                     activation=None if has_map else activation)
+                x = conv(x)
+                conv.set_weights([kernel.astype(np.float32), bias.astype(np.float32)])
+                if has_map:
+                    x = AddBiasMap(bias_map.astype(np.float32), name=f"{layer.name}_border")(x)
+                    x = layers.Activation(activation)(x)
+                i += 2 if bn_scale is not None else 1
+                continue
+
+            if isinstance(layer, (layers.MaxPooling2D, layers.GlobalAveragePooling2D)):
+                # a per channel constant goes through both unchanged
+                x = layer.__class__.from_config(layer.get_config())(x)
+            elif isinstance(layer, layers.Dense):
+                kernel, bias = [w.astype(np.float64) for w in layer.get_weights()]
+                if shift is not None:
+                    bias = bias + shift @ kernel
+                    shift = None
+                config = layer.get_config()
+                dense = layers.Dense.from_config(config)
+                x = dense(x)
+                dense.set_weights([kernel.astype(np.float32), bias.astype(np.float32)])
+            elif isinstance(layer, layers.Dropout):
+                pass
+            else:
+                # anything else (ex: a BN that couldn't be folded) is copied as it is
+                if shift is not None:
+                    raise ValueError(f"can't carry a BatchNormalization shift into {layer.name}")
+                copy = layer.__class__.from_config(layer.get_config())
+                x = copy(x)
+                copy.set_weights(layer.get_weights())
+            i += 1
+    finally:
+        keras.mixed_precision.set_global_policy(previous_policy)
+
+    if shift is not None:
+        raise ValueError("model ends with a BatchNormalization shift that was never applied")
+
+    folded_model = keras.Model(inputs, x, name=f"{model.name}_folded")
+    print(f"[INFO] Folded {folded} BatchNormalization layers into the conv / dense weights")
+    return folded_model
+
+"""
+-----------------------------------------
+Function: check_folding_parity
+    runs both models on <patches> (uint8) and
+    returns (max |diff|, number of patches that
+    change side of the 0.5 threshold)
+-----------------------------------------
+"""
+def check_folding_parity(model, folded_model, patches, batch_size=256):
+    diffs, flips = [], 0
+    for b in range(0, len(patches), batch_size):
+        batch = patches[b:b + batch_size].astype(np.float32) / 255.0
+        ref = np.asarray(model(batch, training=False), dtype=np.float32).reshape(-1)
+        out = np.asarray(folded_model(batch, training=False), dtype=np.float32).reshape(-1)
+        diffs.append(np.abs(ref - out).max())
+        flips += int(np.sum((ref > 0.5) != (out > 0.5)))
+    return float(max(diffs)), flips
+
 """
 -----------------------------------------
 Function: train_model
     trains the model
 -----------------------------------------
 """
-def train_model(model, training_dataset, val_dataset, callback, batch_size):
-    # open training file
-    with h5py.File('training_patches.h5', 'r') as f:
-        train_len = f['train_x'].shape[0]
-    
-    # track iterations per epoch for progress tracking
-    steps = train_len // batch_size
+def train_model(model, training_dataset, val_dataset, callback, batch_size, steps=None, extra_callbacks=()):
+    if steps is None:
+        # open training file
+        with h5py.File('training_patches.h5', 'r') as f:
+            train_len = f['train_x'].shape[0]
+
+        # track iterations per epoch for progress tracking
+        steps = train_len // batch_size
 
     # mid-epoch weights
     batch_callback = BatchCheckpoint(filepath="backend/models/cp_mid.weights.h5",
@@ -235,7 +1529,7 @@ def train_model(model, training_dataset, val_dataset, callback, batch_size):
                     steps_per_epoch=steps,
                     epochs=1,
                     validation_data=val_dataset,
-                    callbacks=[callback, batch_callback],
+                    callbacks=[callback, batch_callback, *extra_callbacks],
                     )
 
     # creates the graph for the model's accuracy
@@ -244,6 +1538,178 @@ def train_model(model, training_dataset, val_dataset, callback, batch_size):
     history_df.loc[:, ['accuracy', 'val_accuracy']].plot()
     plt.show()
 
+"""
+-----------------------------------------
+Function: build_tuning_model
+    keras tuner model builder, the search space
+    over model_builder's architecture
+        base_filters - filters of the first conv
+                       (doubled at every block)
+        dense_1 / dense_2 - dense layer widths
+        dropout, learning_rate
+-----------------------------------------
+"""
+def build_tuning_model(hp, mixed_precision=False):
+    base_filters = hp.Choice('base_filters', [16, 32, 48, 64])
+    model, _, _ = model_builder(32, mixed_precision=mixed_precision,
+                                filters=(base_filters, base_filters * 2, base_filters * 4),
+                                dense_units=(hp.Choice('dense_1', [64, 128, 256, 512]),
+                                             hp.Choice('dense_2', [128, 256, 512])),
+                                dropout=hp.Float('dropout', 0.0, 0.5, step=0.1),
+                                learning_rate=hp.Float('learning_rate', 1e-4, 3e-3, sampling='log'))
+    return model
+
+"""
+-----------------------------------------
+Class TrialThroughput
+    adds 'samples_per_sec' (training only, the
+    first batch of each epoch is not counted
+    since it includes building the graph) to
+    the epoch logs, so keras tuner keeps it
+    with the trial's other metrics
+-----------------------------------------
+"""
+class TrialThroughput(tf.keras.callbacks.Callback):
+    def __init__(self, batch_size):
+        super().__init__()
+        self.batch_size = batch_size
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._first_end = None
+        self._last_end = None
+        self._steps = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        now = time.perf_counter()
+        if self._first_end is None:
+            self._first_end = now
+        else:
+            self._steps += 1
+        self._last_end = now
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is not None and self._steps:
+            logs['samples_per_sec'] = self._steps * self.batch_size / (self._last_end - self._first_end)
+
+"""
+-----------------------------------------
+Function: launch_tuner_workers
+    starts <n> tuner worker processes (this
+    script again, with the keras tuner worker
+    environment) that take trials from the chief
+    oracle on <port>, each with an equal share
+    of the CPU threads
+-----------------------------------------
+"""
+def launch_tuner_workers(n, port):
+    # the workers never remake the dataset
+    worker_args = [a for a in sys.argv[1:] if a != '--make_dataset']
+    threads = max(1, (os.cpu_count() or n) // n)
+
+    procs = []
+    for i in range(n):
+        env = dict(os.environ)
+        env.update({"KERASTUNER_TUNER_ID": f"tuner{i}",
+                    "KERASTUNER_ORACLE_IP": "127.0.0.1",
+                    "KERASTUNER_ORACLE_PORT": str(port),
+                    "TF_NUM_INTRAOP_THREADS": str(threads),
+                    "TF_NUM_INTEROP_THREADS": "2",
+                    "OMP_NUM_THREADS": str(threads)})
+        procs.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), *worker_args], env=env))
+    print(f"[INFO] Started {n} tuner workers ({threads} threads each)")
+    return procs
+
+"""
+-----------------------------------------
+Function: hypertune
+    Hyperband search (successive halving: many
+    trials get a few epochs, only the best ones
+    are trained longer) over build_tuning_model
+
+    the first call cuts a stratified training /
+    validation subset once into memory mapped
+    .npy files, starts <tune_workers> worker
+    processes and serves the search as the
+    chief; the workers (same function, started
+    with KERASTUNER_TUNER_ID set) run the trials
+    every trial in every process maps the same
+    files, so the subset sits in the page cache
+    once and the h5 files are never read again
+
+    trials stop early when val_loss stops
+    improving; the report (and
+    <tune_dir>/trials.csv) lists accuracy and
+    training samples/sec of every trial
+-----------------------------------------
+"""
+def hypertune(args):
+    train_cache = os.path.join(args.tune_dir, 'train_subset')
+    val_cache = os.path.join(args.tune_dir, 'val_subset')
+    is_worker = 'KERASTUNER_TUNER_ID' in os.environ
+
+    procs = []
+    if not is_worker:
+        start = time.perf_counter()
+        cache_patch_subset('training_patches.h5', train_cache, args.tune_samples)
+        cache_patch_subset('val_patches.h5', val_cache, max(args.batch_size, args.tune_samples // 4), balance=False)
+
+        # this process becomes the chief oracle
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        os.environ.update({"KERASTUNER_TUNER_ID": "chief",
+                           "KERASTUNER_ORACLE_IP": "127.0.0.1",
+                           "KERASTUNER_ORACLE_PORT": str(port)})
+        procs = launch_tuner_workers(args.tune_workers, port)
+
+    tuner = kt.Hyperband(lambda hp: build_tuning_model(hp, args.mixed_precision),
+                         objective='val_accuracy',
+                         max_epochs=args.tune_max_epochs,
+                         factor=3,
+                         directory=args.tune_dir,
+                         project_name='patch_model')
+
+    with open(os.path.join(train_cache, MMAP_INDEX)) as f:
+        steps = json.load(f)["n_patches"] // args.batch_size
+    training = mmap_data_gen(train_cache, batch_size=args.batch_size, shuffle=True, readers=2).repeat()
+    # validation is never shuffled, and in bigger batches
+    val = mmap_data_gen(val_cache, batch_size=args.batch_size * 4, shuffle=False, readers=2)
+
+    try:
+        tuner.search(training,
+                     steps_per_epoch=steps,
+                     validation_data=val,
+                     callbacks=[keras.callbacks.EarlyStopping(monitor='val_loss', patience=2),
+                                TrialThroughput(args.batch_size)],
+                     verbose=2)
+    finally:
+        for p in procs:
+            p.wait()
+    if is_worker:
+        return
+
+    # report every finished trial, best first
+    rows = []
+    for trial in tuner.oracle.trials.values():
+        if not trial.metrics.exists('val_accuracy'):
+            continue
+        row = {"trial": trial.trial_id,
+               "epochs": trial.hyperparameters.values.get('tuner/epochs'),
+               "val_accuracy": trial.metrics.get_best_value('val_accuracy')}
+        if trial.metrics.exists('samples_per_sec'):
+            row["samples_per_sec"] = trial.metrics.get_last_value('samples_per_sec')
+        row.update({k: v for k, v in trial.hyperparameters.values.items() if not k.startswith('tuner/')})
+        rows.append(row)
+
+    report = pd.DataFrame(rows).sort_values('val_accuracy', ascending=False)
+    report.to_csv(os.path.join(args.tune_dir, 'trials.csv'), index=False)
+    print(report.head(20).to_string(index=False))
+    print(f"[INFO] Search took {(time.perf_counter() - start) / 3600:.2f} hours, "
+          f"{len(rows)} trials, report in {os.path.join(args.tune_dir, 'trials.csv')}")
+
+    best = tuner.get_best_hyperparameters(1)[0].values
+    print(f"[INFO] Best hyperparameters: { {k: v for k, v in best.items() if not k.startswith('tuner/')} }")
+
 """
 -----------------------------------------
 Function: test_model
@@ -326,6 +1792,235 @@ def test_model(model, checkpoint_path, slice_path, patch_size=32, stride=8, disp
 
     return original_image, overlayed_image
 
+"""
+-----------------------------------------------------------
+Function: extract_patches
+    sliding window patch extraction for one slice.
+    Returns every (patch_size x patch_size) window at the given
+    stride, in row-major order, plus the (row, col) of each window.
+-----------------------------------------------------------
+"""
+def extract_patches(img, patch_size=32, stride=8):
+    h, w = img.shape[:2]
+
+    # strided view of every window, then keep only the ones on the stride grid
+    windows = np.lib.stride_tricks.sliding_window_view(img, (patch_size, patch_size), axis=(0, 1))
+    windows = windows[::stride, ::stride]
+
+    # (rows, cols, ch, ph, pw) -> (rows * cols, ph, pw, ch)
+    patches = np.ascontiguousarray(windows.transpose(0, 1, 3, 4, 2)).reshape(-1, patch_size, patch_size, img.shape[2])
+
+    rows = np.arange(0, h - patch_size + 1, stride)
+    cols = np.arange(0, w - patch_size + 1, stride)
+    coords = np.stack(np.meshgrid(rows, cols, indexing='ij'), axis=-1).reshape(-1, 2)
+    return patches, coords
+
+"""
+-----------------------------------------------------------
+Class: PatchPredictor
+    fast inference wrapper with the same predict() call as the
+    keras model, so it can be passed anywhere a model is used
+    for inference (iter_patch_predictions, predict_patch_batch).
+    The whole batch goes through one tf.function call (compiled
+    with XLA when jit_compile=True) instead of model.predict's
+    per-call data pipeline. Outputs are float32.
+-----------------------------------------------------------
+"""
+class PatchPredictor:
+    def __init__(self, model, jit_compile=True):
+        self.model = model
+        self.jit_compile = jit_compile
+        self._fn = tf.function(lambda x: tf.cast(model(x, training=False), tf.float32),
+                               jit_compile=jit_compile, reduce_retracing=True)
+
+    def predict(self, x, verbose=0, batch_size=None):
+        return self._fn(tf.convert_to_tensor(x, dtype=tf.float32)).numpy()
+
+    # drops the compiled function (its graphs hold the model) and the model itself
+    def release(self):
+        self._fn = None
+        self.model = None
+
+"""
+-----------------------------------------------------------
+Function: bucket_size
+    smallest batch bucket that holds <n> patches
+    (the largest bucket if none does)
+-----------------------------------------------------------
+"""
+BATCH_BUCKETS = (8, 16, 32, 64, 128)
+
+def bucket_size(n, buckets=BATCH_BUCKETS):
+    for size in buckets:
+        if size >= n:
+            return size
+    return buckets[-1]
+
+"""
+-----------------------------------------------------------
+Function: predict_patch_batch
+    runs the model on one batch of uint8 patches
+    (<model> can be a keras model or a PatchPredictor)
+
+    the batch is zero padded up to one of <buckets>
+    (and split if it is bigger than the largest), so
+    the model only ever sees a few fixed batch shapes
+    and nothing is traced again once warm_up_model
+    has run them all (buckets=None runs the batch as
+    it is)
+-----------------------------------------------------------
+"""
+def predict_patch_batch(model, patches, buckets=BATCH_BUCKETS):
+    if not buckets:
+        batch = patches.astype(np.float32) / 255.0
+        return model.predict(batch, batch_size=len(batch), verbose=0).reshape(-1)
+
+    preds = []
+    for start in range(0, len(patches), buckets[-1]):
+        chunk = patches[start:start + buckets[-1]]
+        size = bucket_size(len(chunk), buckets)
+        batch = np.zeros((size, *chunk.shape[1:]), dtype=np.float32)
+        batch[:len(chunk)] = chunk
+        batch /= 255.0
+        preds.append(model.predict(batch, batch_size=size, verbose=0).reshape(-1)[:len(chunk)])
+    return np.concatenate(preds) if preds else np.zeros(0, dtype=np.float32)
+
+"""
+-----------------------------------------------------------
+Function: warm_up_model
+    runs one batch of every bucket size through the
+    model so every graph is built before the first
+    request, returns {bucket size: seconds}
+-----------------------------------------------------------
+"""
+def warm_up_model(model, patch_size=32, buckets=BATCH_BUCKETS):
+    timings = {}
+    for size in buckets:
+        start = time.perf_counter()
+        predict_patch_batch(model, np.zeros((size, patch_size, patch_size, 3), dtype=np.uint8), buckets)
+        timings[size] = time.perf_counter() - start
+    return timings
+
+"""
+-----------------------------------------------------------
+Function: iter_patch_predictions
+    streaming inference over an iterable of slices.
+    Patches from consecutive slices are packed into full batches
+    of <batch_size> (instead of leaving a ragged tail batch on
+    every slice), and each slice is yielded as soon as all of
+    its patches have been scored:
+        (uint8 slice, coords, predictions)
+    (<buckets> is passed on to predict_patch_batch)
+-----------------------------------------------------------
+"""
+def iter_patch_predictions(model, slices, patch_size=32, stride=8, batch_size=128, buckets=BATCH_BUCKETS):
+    pending = deque()    # slices waiting for predictions: (img, coords)
+    queued = []          # patches not yet sent to the model
+    n_queued = 0
+    scored = []          # predictions not yet handed back to a slice
+    n_scored = 0
+
+    slices = iter(slices)
+    exhausted = False
+    while not exhausted or pending:
+        # pull the next slice and queue its patches
+        img = next(slices, None)
+        if img is None:
+            exhausted = True
+        else:
+            # confirm that slice is converted to uint8 (0-255)
+            img = np.asarray(img).astype(np.uint8)
+            patches, coords = extract_patches(img, patch_size, stride)
+            pending.append((img, coords))
+            queued.append(patches)
+            n_queued += len(patches)
+
+        # run the model on every full batch (and on the tail once there are no more slices)
+        if n_queued >= batch_size or (exhausted and n_queued):
+            patches = np.concatenate(queued)
+            n_full = len(patches) if exhausted else (len(patches) // batch_size) * batch_size
+            for j in range(0, n_full, batch_size):
+                scored.append(predict_patch_batch(model, patches[j:min(j + batch_size, n_full)], buckets))
+                n_scored += len(scored[-1])
+            queued = [patches[n_full:]] if n_full < len(patches) else []
+            n_queued = len(patches) - n_full
+
+        # hand back every slice whose predictions are complete
+        while pending and n_scored >= len(pending[0][1]):
+            img, coords = pending.popleft()
+            preds = np.concatenate(scored) if scored else np.zeros(0, dtype=np.float32)
+            scored = [preds[len(coords):]]
+            n_scored -= len(coords)
+            yield img, coords, preds[:len(coords)]
+
+"""
+-----------------------------------------------------------
+Function: aggregate_scores
+    reduces patch (or slice) probabilities to a single score
+        mean  - mean of every score
+        max   - highest score
+        top_k - mean of the <k> highest scores (a lesion
+                only covers a few patches, so the plain
+                mean is dominated by healthy tissue)
+-----------------------------------------------------------
+"""
+AGGREGATIONS = ("mean", "max", "top_k")
+
+def aggregate_scores(scores, method="top_k", k=16):
+    scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+    if len(scores) == 0:
+        return float('nan')
+    if method == "mean":
+        return float(scores.mean())
+    if method == "max":
+        return float(scores.max())
+    if method == "top_k":
+        k = max(1, min(int(k), len(scores)))
+        return float(np.partition(scores, len(scores) - k)[-k:].mean())
+    raise ValueError(f"Unknown aggregation '{method}' (expected one of {', '.join(AGGREGATIONS)})")
+
+"""
+-----------------------------------------------------------
+Function: render_heatmap
+    turns the patch predictions of one slice into the heatmap
+    and overlay images sent to the frontend
+-----------------------------------------------------------
+"""
+def render_heatmap(img, coords, predictions, patch_size=32, return_originals=False):
+    h, w = img.shape[:2]
+
+    # --- BUILD HEATMAP BASED ON PREDICTIONS ---
+    heatmap_sum = np.zeros((h, w), dtype=np.float32)
+    heatmap_count = np.zeros((h, w), dtype=np.float32)
+
+    for (row, col), p in zip(coords, predictions):
+        heatmap_sum[row:row+patch_size, col:col+patch_size] += p
+        heatmap_count[row:row+patch_size, col:col+patch_size] += 1
+
+    # Avoid division by zero error
+    heatmap = heatmap_sum / (heatmap_count + 1e-8)
+
+    # Normalize heatmap to [0,1]
+    hm_norm = (heatmap - heatmap.min()) / (heatmap.max() - heatmap.min() + 1e-8)
+
+    # Apply jet colormap (returns RGBA, keep RGB only)
+    heatmap_color = cm.jet(hm_norm)[..., :3]
+
+    # --- OVERLAY HEATMAP ON ORIGINAL SLICE ---
+    overlay = (0.5 * (img / 255.0)) + (0.5 * heatmap_color)
+    overlay = np.clip(overlay, 0, 1)
+
+    # Convert overlay back to uint8 for display/frontend transmission
+    result = {
+        "heatmap": (heatmap_color * 255).astype(np.uint8),
+        "overlay": (overlay * 255).astype(np.uint8)
+    }
+
+    if return_originals:
+        result["raw_slice"] = img
+
+    return result
+
 def predict_patients_slices(model, checkpoint_path, slices_array, patch_size=32, stride=8, return_originals = False, skip_load=True):
     """
     Run the MS inference on every slice of a preprocessed MRI volume.
@@ -351,89 +2046,12 @@ def predict_patients_slices(model, checkpoint_path, slices_array, patch_size=32,
     print(f"[INFO] Starting processing of {total_slices} slices", flush=True)
     sys.stdout.flush()
 
-    # Iterate through each preprocessed slice
-    for i in range(total_slices):
-        print(f"[INFO] Processing slice {i+1}/{total_slices}", flush=True)
-        sys.stdout.flush()
-
-        try:
-            # Confirm that slice is converted to uint8 (0-255)
-            print(f"[DEBUG] Converting slice {i+1} to uint8...", flush=True)
-            img = slices_array[i].astype(np.uint8) # Shape (224, 224, 3)
-            h, w, _ = img.shape
-            print(f"[DEBUG] Slice {i+1} shape: {img.shape}", flush=True)
-
-            patches = [] # List of the patch image arrays
-            coords = [] # Matching list of (row, col) positions
-
-            # --- SLIDING WINDOW PATCH EXTRACTION ---
-            print(f"[DEBUG] Extracting patches from slice {i+1}...", flush=True)
-            for row in range(0, h - patch_size + 1, stride):
-                for col in range (0, w - patch_size + 1, stride):
-                    patch = img[row:row+patch_size, col:col+patch_size]
-                    patches.append(patch)
-                    coords.append((row, col))
-
-            print(f"[DEBUG] Slice {i+1}: Extracted {len(patches)} patches", flush=True)
-            sys.stdout.flush()
-        except Exception as e:
-            print(f"[ERROR] Failed during patch extraction for slice {i+1}: {e}", flush=True)
-            raise
-        
-        # Convert to float in [0, 1] range for the model
-        patches = np.array(patches, dtype=np.float32) / 255.0
-
-        # --- MODEL PREDICTIONS ---
-        predictions = []
-        batch_size = 128
-
-        print(f"[DEBUG] Slice {i+1}: Starting predictions on {len(patches)} patches", flush=True)
-        sys.stdout.flush()
-
-        # Predict in batches to avoid CPU/GPU memory issues
-        for j in range (0, len(patches), batch_size):
-            batch = patches[j:j+batch_size]
-            try:
-                prediction = model.predict(batch, verbose=0).flatten()
-                predictions.extend(prediction)
-            except Exception as e:
-                print(f"[ERROR] Prediction failed on slice {i+1}, batch {j}: {e}", flush=True)
-                raise
-
-        print(f"[DEBUG] Slice {i+1}: Predictions complete", flush=True)
-
-        # --- BUILD HEATMAP BASED ON PREDICTIONS ---
-        heatmap_sum = np.zeros((h, w), dtype=np.float32)
-        heatmap_count = np.zeros((h, w), dtype=np.float32)
-
-        for (row, col), p in zip(coords, predictions):
-            heatmap_sum[row:row+patch_size, col:col+patch_size] += p
-            heatmap_count[row:row+patch_size, col:col+patch_size] += 1
-        
-        # Avoid division by zero error
-        heatmap = heatmap_sum / (heatmap_count + 1e-8)
-
-        # Normalize heatmap to [0,1]
-        hm_norm = (heatmap - heatmap.min()) / (heatmap.max() - heatmap.min() + 1e-8)
-
-        # Apply jet colormap (returns RGBA, keep RGB only)
-        heatmap_color = cm.jet(hm_norm)[..., :3]
-
-        # --- OVERLAY HEATMAP ON ORIGINAL SLICE ---
-        overlay = (0.5 * (img / 255.0)) + (0.5 * heatmap_color)
-        overlay = np.clip(overlay, 0, 1)
-
-        # Convert overlay back to uint8 for display/frontend transmission
-        result = {
-            "heatmap": (heatmap_color * 255).astype(np.uint8),
-            "overlay": (overlay * 255).astype(np.uint8)
-        }
-
-        if return_originals:
-            result["raw_slice"] = img
-
-        results.append(result)
-        print(f"[INFO] Completed slice {i+1}/{total_slices}", flush=True)
+    # Iterate through the slices as their predictions complete
+    for i, (img, coords, predictions) in enumerate(
+        iter_patch_predictions(model, slices_array, patch_size=patch_size, stride=stride)
+    ):
+        results.append(render_heatmap(img, coords, predictions, patch_size, return_originals))
+        print(f"[INFO] Completed slice {i+1}/{total_slices} ({len(coords)} patches)", flush=True)
         sys.stdout.flush()
 
     print("[INFO] Finished MS inference for all slices.", flush=True)
@@ -449,24 +2067,67 @@ def main(args):
     train_dir = os.path.join(base_dir, 'preprocessed_training')
     val_dir = os.path.join(base_dir, 'preprocessed_validation')
 
-    # process data into usable arrays
-    if args.make_dataset:
-        create_dataset_stream(train_dir, 'training_patches.h5', threads=8)
-        create_dataset_stream(val_dir, 'val_patches.h5', threads=8)
+    # process data into usable arrays (stacks are used as they are)
+    if args.make_dataset and args.data_format != 'stacks':
+        for split_dir, output_file in [(train_dir, 'training_patches.h5'), (val_dir, 'val_patches.h5')]:
+            # datasets preprocessed with --patch_format shards have an index instead of patch PNGs
+            if os.path.exists(os.path.join(split_dir, SHARD_INDEX)):
+                create_dataset_from_shards(split_dir, output_file)
+            else:
+                create_dataset_stream(split_dir, output_file, threads=8)
+
+            # uncompressed copy for --data_format mmap
+            if args.data_format == 'mmap':
+                convert_h5_to_mmap_shards(output_file, os.path.splitext(output_file)[0] + '_shards')
+
+    # hyperparameter search reads its own cached subsets
+    if args.hypertune:
+        hypertune(args)
+        return
 
     # create datasets
-    training = data_gen('training_patches.h5', batch_size=batch_size, shuffle=True)
-    val = data_gen('val_patches.h5', batch_size=batch_size, shuffle=True)
+    steps = None
+    if args.data_format == 'stacks':
+        training = stack_data_gen(train_dir, batch_size=batch_size, samples_per_epoch=args.samples_per_epoch)
+        steps = training.cardinality().numpy()
+    elif args.data_format == 'mmap':
+        training = mmap_data_gen('training_patches_shards', batch_size=batch_size, shuffle=True, readers=args.readers)
+    else:
+        training = chunked_data_gen('training_patches.h5', batch_size=batch_size, shuffle=True, readers=args.readers)
+    if args.data_format == 'stacks' and os.path.exists(os.path.join(val_dir, STACK_INDEX)):
+        if args.full_validation:
+            # every valid window once, in order
+            val = stack_full_val_gen(val_dir, batch_size=args.val_batch_size)
+        else:
+            val = val_subset_gen(val_dir, n_samples=args.val_samples, batch_size=args.val_batch_size)
+    elif args.full_validation:
+        # whole file, in order
+        val = chunked_data_gen('val_patches.h5', batch_size=args.val_batch_size, shuffle=False, readers=args.readers)
+    else:
+        val = val_subset_gen('val_patches.h5', n_samples=args.val_samples, batch_size=args.val_batch_size)
+
+    # optional training metrics / profiler trace
+    extra_callbacks = []
+    if args.val_every:
+        extra_callbacks.append(PeriodicValidation(val, n=args.val_every))
+    if args.metrics_log or args.profile_steps:
+        stats = None
+        if args.metrics_log:
+            training, stats = instrument_dataset(training)
+        extra_callbacks.append(TrainingMonitor(args.metrics_log or 'logs/training_metrics', stats=stats,
+                                               profile_steps=args.profile_steps))
 
     # build model
-    model, checkpoint_path, callback = model_builder(32, args.resume)
+    model, checkpoint_path, callback = model_builder(32, args.resume, jit_compile=args.jit_compile,
+                                                    mixed_precision=args.mixed_precision)
 
     # train or test the model
     if args.train:
-        train_model(model, training, val, callback, batch_size)
+        train_model(model, training, val, callback, batch_size, steps, extra_callbacks)
     else:
         print("[INFO] Model ready for inference")
         print("[INFO] Use app.py to run predictions on uploaded .nii files")
+        print("[INFO] Use score_cohort.py to score a whole dataset of .nii files at once")
 
 if __name__ == "__main__":
     args = parse_args()
@@ -0,0 +1,256 @@
+"""
+-----------------------------------------------------------
+Model registry for the API.
+
+Maps a model ID (or a modality, ex: "T1") to a weights file and
+the architecture needed to rebuild it, and keeps the loaded
+models in memory:
+    - models are built, loaded and warmed up lazily, the first
+      time a request asks for them (one load per model, requests
+      that arrive during the load wait for it)
+    - the memory a model costs is estimated from its architecture
+      (see estimate_model_mb), so identical models cost the same
+    - a model is shared by every request using it at the same
+      time (reference counted)
+    - loaded models are kept in LRU order and the least recently
+      used ones that no request is using are dropped once the
+      total goes over the memory budget (every reference the
+      registry holds is released, and the Keras session is
+      cleared once no model is in use or loading)
+
+The registry file (MODEL_REGISTRY in app.py) is JSON:
+    {
+        "default": "t1",
+        "models": {
+            "t1":   {"weights": "weights/cp_mid.weights.h5", "modality": "T1"},
+            "t2":   {"weights": "weights/t2.weights.h5", "modality": "T2"},
+            "t1_b": {"weights": "weights/t1_small.weights.h5",
+                     "filters": [16, 32, 64], "dense_units": [64, 128]}
+        }
+    }
+relative weights paths are relative to the registry file. Any key
+besides "weights" and "modality" is passed to the loader (ex: the
+model_builder architecture), and "memory_mb" overrides the memory
+estimate of a model.
+-----------------------------------------------------------
+"""
+
+import os
+import gc
+import json
+import time
+import math
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+"""
+-----------------------------------------------------------
+Class: UnknownModelError
+Raised for a model ID or modality that is not in the registry.
+-----------------------------------------------------------
+"""
+class UnknownModelError(KeyError):
+    def __str__(self):
+        return str(self.args[0]) if self.args else "unknown model"
+
+"""
+-----------------------------------------------------------
+Function: load_registry_file
+Reads a registry JSON file, returns (specs, default model ID).
+-----------------------------------------------------------
+"""
+def load_registry_file(path):
+    with open(path) as f:
+        config = json.load(f)
+
+    root = os.path.dirname(os.path.abspath(path))
+    specs = {}
+    for model_id, spec in config["models"].items():
+        spec = dict(spec)
+        if not os.path.isabs(spec["weights"]):
+            spec["weights"] = os.path.join(root, spec["weights"])
+        specs[model_id] = spec
+
+    default = config.get("default", next(iter(specs)))
+    if default not in specs:
+        raise ValueError(f"default model '{default}' is not in {path}")
+    return specs, default
+
+"""
+-----------------------------------------------------------
+Function: estimate_model_mb
+Memory estimate of a loaded model from its architecture alone:
+its float32 weights plus the float32 output of every layer for a
+batch of <batch_size> (the buffers inference on the largest batch
+keeps). Identical architectures always get the same estimate,
+unlike the process RSS, which also holds TensorFlow's one-time
+start-up and memory freed by earlier evictions.
+-----------------------------------------------------------
+"""
+def estimate_model_mb(model, batch_size=128):
+    model = getattr(model, "model", model)   # PatchPredictor
+    activations = 0
+    for layer in getattr(model, "layers", []):
+        shape = getattr(layer, "output", None)
+        shape = getattr(shape, "shape", None)
+        if shape:
+            activations += math.prod(dim for dim in shape if dim is not None)
+    return (model.count_params() + batch_size * activations) * 4 / (1024 ** 2)
+
+"""
+-----------------------------------------------------------
+Class: ModelRegistry
+<loader(model_id, spec)> builds, loads and warms up one model,
+<batch_size> is the largest batch a model runs (see
+estimate_model_mb), <clear_session()> (optional, ex:
+keras.backend.clear_session) is called after evictions, once no
+model is in use or loading.
+Use acquire() around every use of a model:
+    with registry.acquire(model_id=..., modality=...) as (model_id, model):
+        ...
+-----------------------------------------------------------
+"""
+class ModelRegistry:
+    def __init__(self, specs, default, loader, memory_budget_mb=1024, batch_size=128, clear_session=None):
+        self.specs = specs
+        self.default = default
+        self.loader = loader
+        self.memory_budget_mb = memory_budget_mb
+        self.batch_size = batch_size
+        self.clear_session = clear_session
+
+        self._lock = threading.Lock()       # guards everything below
+        self._load_locks = {model_id: threading.Lock() for model_id in specs}
+        self._loading = 0                   # loads in progress
+        self._loaded = OrderedDict()        # model_id -> model, least recently used first
+        self._memory_mb = {}                # model_id -> estimated MB
+        self._refs = {}                     # model_id -> requests using it
+        self._clear_pending = False         # models were evicted since the last clear_session
+        self.loads = 0
+        self.evictions = 0
+        self.session_clears = 0
+
+    """
+    Model ID for a request: the given ID, else the model registered
+    for the modality, else the default model.
+    """
+    def resolve(self, model_id=None, modality=None):
+        if model_id:
+            if model_id not in self.specs:
+                raise UnknownModelError(f"Unknown model '{model_id}' (available: {', '.join(sorted(self.specs))})")
+            return model_id
+        if modality:
+            for candidate, spec in self.specs.items():
+                if str(spec.get("modality", "")).upper() == modality.upper():
+                    return candidate
+            raise UnknownModelError(f"No model registered for modality '{modality}'")
+        return self.default
+
+    @contextmanager
+    def acquire(self, model_id=None, modality=None):
+        model_id = self.resolve(model_id, modality)
+        model = self._get(model_id)
+        try:
+            yield model_id, model
+        finally:
+            with self._lock:
+                self._refs[model_id] -= 1
+                self._evict()
+
+    def _get(self, model_id):
+        # already loaded: take a reference and mark it as recently used
+        with self._lock:
+            if model_id in self._loaded:
+                self._loaded.move_to_end(model_id)
+                self._refs[model_id] += 1
+                return self._loaded[model_id]
+
+        # one load per model, other requests for it wait here (loads of different models run side by side)
+        with self._load_locks[model_id]:
+            with self._lock:
+                if model_id in self._loaded:
+                    self._loaded.move_to_end(model_id)
+                    self._refs[model_id] += 1
+                    return self._loaded[model_id]
+                self._loading += 1
+
+            try:
+                spec = self.specs[model_id]
+                start = time.perf_counter()
+                model = self.loader(model_id, spec)
+            finally:
+                with self._lock:
+                    self._loading -= 1
+            memory_mb = spec.get("memory_mb") or estimate_model_mb(model, self.batch_size)
+
+            with self._lock:
+                self._loaded[model_id] = model
+                self._memory_mb[model_id] = memory_mb
+                self._refs[model_id] = 1
+                self.loads += 1
+                print(f"[INFO] Worker {os.getpid()}: Model '{model_id}' loaded in "
+                      f"{time.perf_counter() - start:.2f}s (~{memory_mb:.0f} MB, "
+                      f"{self.memory_in_use_mb():.0f}/{self.memory_budget_mb:.0f} MB in use)", flush=True)
+                self._evict()
+        return model
+
+    def memory_in_use_mb(self):
+        return sum(self._memory_mb.values())
+
+    """
+    Drops least recently used models nobody is using until the total
+    is under the budget (called with self._lock held). Models in use
+    are never dropped, so the budget can be exceeded while they are.
+
+    An evicted model is released (PatchPredictor.release drops its
+    compiled function and Keras model) and dropped from the registry.
+    clear_session resets Keras' global state and TensorFlow's kernel
+    cache for every thread, which breaks a model being built or run at
+    the same time, so it only runs once no model is in use or loading.
+    An eviction usually happens while the model that pushed the total
+    over the budget is still held, so the clear waits for the release
+    of the last reference (acquire calls _evict again then). Under
+    steady concurrent traffic it can stay pending.
+    """
+    def _evict(self):
+        for model_id in list(self._loaded):
+            if self.memory_in_use_mb() <= self.memory_budget_mb:
+                break
+            if self._refs.get(model_id, 0) > 0:
+                continue
+            model = self._loaded.pop(model_id)
+            release = getattr(model, "release", None)
+            if release is not None:
+                release()
+            del model
+            freed = self._memory_mb.pop(model_id)
+            self._refs.pop(model_id, None)
+            self.evictions += 1
+            self._clear_pending = True
+            print(f"[INFO] Worker {os.getpid()}: Evicted model '{model_id}' (~{freed:.0f} MB)", flush=True)
+            gc.collect()
+
+        if self._clear_pending and self._loading == 0 and not any(self._refs.values()):
+            self._clear_pending = False
+            if self.clear_session is not None:
+                self.clear_session()
+                self.session_clears += 1
+
+        if self.memory_in_use_mb() > self.memory_budget_mb:
+            print(f"[WARNING] Worker {os.getpid()}: Models in use take {self.memory_in_use_mb():.0f} MB, "
+                  f"over the {self.memory_budget_mb:.0f} MB budget", flush=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "default": self.default,
+                "available": sorted(self.specs),
+                "loaded": list(self._loaded),
+                "in_use": {model_id: n for model_id, n in self._refs.items() if n},
+                "memory_mb": round(self.memory_in_use_mb(), 1),
+                "memory_budget_mb": self.memory_budget_mb,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "session_clears": self.session_clears,
+            }
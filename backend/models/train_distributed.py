@@ -0,0 +1,320 @@
+"""
+-----------------------------------------
+Data parallel training on several processes
+(tf.distribute.MultiWorkerMirroredStrategy)
+
+Every worker process trains a copy of the model
+on its own part of the data, and the gradients
+are averaged between workers at every step.
+
+Data is split deterministically: worker i reads
+every N-th h5 chunk / patch starting at chunk i
+(the shard_index / num_shards of the readers),
+so no two workers ever read the same samples.
+Stacks (--data_format stacks) are sampled at
+random, every worker just draws its own batches.
+
+Only the chief (worker 0) writes the real
+checkpoints (cp_mid.weights.h5 / cp.weights.h5).
+The other workers still go through the same
+saving steps, so every worker stays in step,
+but they write to a temp folder that is
+deleted afterwards.
+
+Run from the project root.
+Local test, 4 processes on this machine:
+    python backend/models/train_distributed.py --launch 4 --batch_size 128
+On several machines, start one process per machine
+with TF_CONFIG set for that machine, ex:
+    TF_CONFIG='{"cluster": {"worker": ["host1:12345", "host2:12345"]},
+                "task": {"type": "worker", "index": 0}}' \
+    python backend/models/train_distributed.py --batch_size 128
+
+NOTE: --batch_size is the GLOBAL batch size, each
+      worker uses batch_size / number of workers
+-----------------------------------------
+"""
+import os
+import sys
+import json
+import socket
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import h5py
+import pandas as pd
+
+"""
+----------------
+Argparser
+----------------
+"""
+def parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--launch", type=int, default=0,
+                        help="start this many worker processes on this machine (sets TF_CONFIG for each of them)")
+    parser.add_argument("--data_format", choices=["h5", "mmap", "stacks"], default="h5")
+    parser.add_argument("--train_data", default=None,
+                        help="training data (default: training_patches.h5, training_patches_shards, or the stacks folder)")
+    parser.add_argument("--val_data", default=None, help="validation h5 file (default: val_patches.h5 if it exists)")
+    parser.add_argument("--batch_size", type=int, default=128, help="global batch size (split between the workers)")
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--steps_per_epoch", type=int, default=None, help="default: one pass over the training data")
+    parser.add_argument("--readers", type=int, default=2, help="parallel chunk/shard readers per worker")
+    parser.add_argument("--checkpoint_every", type=int, default=500, help="steps between mid-epoch checkpoints")
+    parser.add_argument("--resume", action="store_true", help="start from backend/models/cp_mid.weights.h5")
+    parser.add_argument("--jit_compile", action="store_true")
+    parser.add_argument("--mixed_precision", action="store_true")
+    return parser.parse_args(args)
+
+"""
+-----------------------------------------
+Function: free_ports
+    asks the OS for <n> free TCP ports
+-----------------------------------------
+"""
+def free_ports(n):
+    sockets = [socket.socket() for _ in range(n)]
+    for s in sockets:
+        s.bind(("localhost", 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+"""
+-----------------------------------------
+Function: launch_local
+    starts <n> workers of this script on this
+    machine, each with its own TF_CONFIG and an
+    equal share of the CPU threads, and waits
+    for all of them. If one fails the others
+    are stopped.
+-----------------------------------------
+"""
+def launch_local(n, worker_args):
+    cluster = {"worker": [f"localhost:{port}" for port in free_ports(n)]}
+    threads = max(1, (os.cpu_count() or n) // n)
+
+    procs = []
+    for i in range(n):
+        env = dict(os.environ)
+        env["TF_CONFIG"] = json.dumps({"cluster": cluster, "task": {"type": "worker", "index": i}})
+        env["TF_NUM_INTRAOP_THREADS"] = str(threads)
+        env["TF_NUM_INTEROP_THREADS"] = "2"
+        env["OMP_NUM_THREADS"] = str(threads)
+        procs.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), *worker_args], env=env))
+    print(f"[INFO] Started {n} workers ({threads} threads each): {cluster['worker']}")
+
+    # wait for every worker, stop the rest as soon as one fails
+    exit_code = 0
+    remaining = list(procs)
+    while remaining:
+        for p in list(remaining):
+            try:
+                code = p.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                continue
+            remaining.remove(p)
+            if code != 0 and exit_code == 0:
+                exit_code = code
+                print(f"[ERROR] Worker {procs.index(p)} exited with code {code}, stopping the others")
+                for other in remaining:
+                    other.terminate()
+                # TF catches SIGTERM (preemption handling), so kill what is still running after a while
+                for other in remaining:
+                    try:
+                        other.wait(timeout=10)
+                    except subprocess.TimeoutExpired:
+                        other.kill()
+    return exit_code
+
+"""
+-----------------------------------------
+Function: worker_role
+    (task type, task index, number of workers,
+    is chief) from the strategy's cluster
+-----------------------------------------
+"""
+def worker_role(strategy):
+    resolver = strategy.cluster_resolver
+    task_type, task_id = resolver.task_type, resolver.task_id
+    cluster = resolver.cluster_spec().as_dict()
+    num_workers = len(cluster.get("worker", [])) + len(cluster.get("chief", []))
+
+    # with no chief in the cluster, worker 0 plays that role
+    if task_type is None or task_type == "chief":
+        is_chief = True
+    else:
+        is_chief = task_type == "worker" and task_id == 0 and "chief" not in cluster
+    return task_type, task_id, max(1, num_workers), is_chief
+
+"""
+-----------------------------------------
+Function: data_length
+    number of samples in one pass over the data
+-----------------------------------------
+"""
+def data_length(data_format, path):
+    if data_format == "mmap":
+        with open(os.path.join(path, "index.json")) as f:
+            return json.load(f)["n_patches"]
+    if data_format == "stacks":
+        return int(pd.read_csv(os.path.join(path, "slice_stacks.csv"))["n_windows"].sum())
+    with h5py.File(path, "r") as f:
+        return len(f["train_x"])
+
+def main(args):
+    # launcher mode: start the workers and wait for them
+    if args.launch:
+        worker_args = [a for a in sys.argv[1:]]
+        i = worker_args.index("--launch")
+        del worker_args[i:i + 2]
+        return launch_local(args.launch, worker_args)
+
+    # TensorFlow is only imported in the worker processes
+    import tensorflow as tf
+    from patch_based_tensor import (model_builder, BatchCheckpoint, chunked_data_gen, mmap_data_gen,
+                                    stack_data_gen)
+    import keras
+
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    task_type, task_id, num_workers, is_chief = worker_role(strategy)
+    print(f"[INFO] Worker {task_id} of {num_workers} ({'chief' if is_chief else task_type}), "
+          f"{strategy.num_replicas_in_sync} replicas in sync")
+
+    default_train = {"h5": "training_patches.h5", "mmap": "training_patches_shards",
+                     "stacks": os.path.join("patients", "preprocessed_training")}
+    train_path = args.train_data or default_train[args.data_format]
+    val_path = args.val_data or ("val_patches.h5" if os.path.exists("val_patches.h5") else None)
+
+    # every worker must run the same number of steps, so they come from the global data size
+    steps = args.steps_per_epoch or max(1, data_length(args.data_format, train_path) // args.batch_size)
+
+    def train_fn(input_context):
+        per_replica = input_context.get_per_replica_batch_size(args.batch_size)
+        shard, shards = input_context.input_pipeline_id, input_context.num_input_pipelines
+        if args.data_format == "mmap":
+            ds = mmap_data_gen(train_path, per_replica, shuffle=True, readers=args.readers,
+                               shard_index=shard, num_shards=shards)
+        elif args.data_format == "stacks":
+            ds = stack_data_gen(train_path, per_replica, samples_per_epoch=steps * per_replica)
+        else:
+            ds = chunked_data_gen(train_path, per_replica, shuffle=True, readers=args.readers,
+                                  shard_index=shard, num_shards=shards)
+        # workers never run out of data before the last step
+        return ds.repeat()
+
+    training = strategy.distribute_datasets_from_function(train_fn)
+
+    val, val_steps = None, None
+    if val_path:
+        with h5py.File(val_path, "r") as f:
+            val_steps = max(1, len(f["train_x"]) // args.batch_size)
+
+        def val_fn(input_context):
+            per_replica = input_context.get_per_replica_batch_size(args.batch_size)
+            ds = chunked_data_gen(val_path, per_replica, shuffle=False, readers=args.readers,
+                                  shard_index=input_context.input_pipeline_id,
+                                  num_shards=input_context.num_input_pipelines)
+            return ds.repeat()
+
+        val = strategy.distribute_datasets_from_function(val_fn)
+
+    # model, optimizer and metric variables are mirrored on every worker
+    with strategy.scope():
+        model, checkpoint_path, _ = model_builder(32, args.resume, jit_compile=args.jit_compile,
+                                                  mixed_precision=args.mixed_precision)
+        loss_fn = keras.losses.BinaryCrossentropy(reduction=None)
+        train_loss = keras.metrics.Mean()
+        train_acc = keras.metrics.BinaryAccuracy()
+        val_loss = keras.metrics.Mean()
+        val_acc = keras.metrics.BinaryAccuracy()
+
+    # only the chief writes the real checkpoints
+    temp_dir = None
+    mid_path = "backend/models/cp_mid.weights.h5"
+    if not is_chief:
+        temp_dir = tempfile.mkdtemp(prefix=f"worker{task_id}_checkpoints_")
+        checkpoint_path = os.path.join(temp_dir, os.path.basename(checkpoint_path))
+        mid_path = os.path.join(temp_dir, os.path.basename(mid_path))
+
+    # the training loop is written out with strategy.run instead of model.fit:
+    # Keras 3 fit() averages the first (x, y) batch over the workers to build
+    # the model, which fails on multi-worker distributed datasets
+    def train_step(x, y):
+        x = tf.cast(x, tf.float32)
+        y = tf.cast(tf.reshape(y, (-1, 1)), tf.float32)
+        with tf.GradientTape() as tape:
+            pred = model(x, training=True)
+            # loss is averaged over the GLOBAL batch, the gradients are summed between workers
+            loss = tf.nn.compute_average_loss(loss_fn(y, pred), global_batch_size=args.batch_size)
+        grads = tape.gradient(loss, model.trainable_variables)
+        model.optimizer.apply_gradients(zip(grads, model.trainable_variables))
+        train_loss.update_state(loss * strategy.num_replicas_in_sync)
+        train_acc.update_state(y, pred)
+
+    def val_step(x, y):
+        x = tf.cast(x, tf.float32)
+        y = tf.cast(tf.reshape(y, (-1, 1)), tf.float32)
+        pred = model(x, training=False)
+        val_loss.update_state(loss_fn(y, pred))
+        val_acc.update_state(y, pred)
+
+    @tf.function(jit_compile=args.jit_compile)
+    def distributed_train_step(iterator):
+        strategy.run(train_step, args=next(iterator))
+
+    @tf.function(jit_compile=args.jit_compile)
+    def distributed_val_step(iterator):
+        strategy.run(val_step, args=next(iterator))
+
+    # mid-epoch checkpoints use the same callback as patch_based_tensor.py
+    batch_checkpoint = BatchCheckpoint(filepath=mid_path, n=args.checkpoint_every, keep=3 if is_chief else 0)
+    batch_checkpoint.set_model(model)
+
+    best_val_loss = float("inf")
+    train_iter = iter(training)
+    val_iter = iter(val) if val is not None else None
+    try:
+        batch_checkpoint.on_train_begin()
+        step = 0
+        for epoch in range(args.epochs):
+            for metric in (train_loss, train_acc, val_loss, val_acc):
+                metric.reset_state()
+
+            progress = keras.utils.Progbar(steps, verbose=1 if is_chief else 0,
+                                           stateful_metrics=["loss", "accuracy"])
+            for batch in range(steps):
+                distributed_train_step(train_iter)
+                batch_checkpoint.on_batch_end(step)
+                step += 1
+                progress.update(batch + 1, [("loss", float(train_loss.result())),
+                                            ("accuracy", float(train_acc.result()))])
+
+            summary = f"loss {float(train_loss.result()):.4f}, accuracy {float(train_acc.result()):.4f}"
+            if val_iter is not None:
+                for _ in range(val_steps):
+                    distributed_val_step(val_iter)
+                current = float(val_loss.result())
+                summary += f", val_loss {current:.4f}, val_accuracy {float(val_acc.result()):.4f}"
+
+                # every worker saves (so they all stay in step), only the chief's copy is kept
+                if current < best_val_loss:
+                    best_val_loss = current
+                    model.save_weights(checkpoint_path)
+                    if is_chief:
+                        print(f"[INFO] val_loss improved, saved weights to {checkpoint_path}")
+            if is_chief:
+                print(f"[INFO] Epoch {epoch + 1}/{args.epochs}: {summary}")
+        batch_checkpoint.on_train_end()
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    return 0
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.exit(main(args))
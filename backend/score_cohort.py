@@ -0,0 +1,346 @@
+"""
+-----------------------------------------------------------
+Offline batch scoring of a whole cohort.
+
+Runs the patch model over every volume of a dataset without going
+through the API one upload at a time:
+    - volumes are preprocessed in a process pool (--workers), a few
+      volumes ahead of the inference
+    - the slices of consecutive volumes are packed together into
+      large patch batches (--batch_size), so the model never waits
+      on a ragged per-volume tail batch
+    - every slice gets a grid of patch scores (one per stride step)
+      and a slice score, every volume a patient score (aggregated
+      with --aggregate, see aggregate_scores)
+
+Input is either a dataset root in the usual layout
+    dataset_root/
+        control/patient_#/patient_#_T1.nii
+        ms/patient_#/patient_#_T1.nii
+or a manifest CSV with a "path" column (relative to the CSV) and
+optional "patient_id" and "label" (0/1 or control/ms) columns.
+
+Output (--out directory):
+    scores.npz      - patient arrays (patient_id, label, path,
+                      score, slice_start, n_slices) and slice arrays
+                      (slice_patient, slice_score, score_grid)
+    patients.csv    - one row per patient
+    summary.json    - settings, failures and timings
+    patients.parquet / slices.parquet with --parquet
+
+Usage (from the project root):
+    python backend/score_cohort.py --input /path/to/dataset_root --out scores/T1 --workers 8
+    python backend/score_cohort.py --manifest cohort.csv --out scores/cohort --all_slices --parquet
+-----------------------------------------------------------
+"""
+
+import os
+import csv
+import json
+import time
+import argparse
+from collections import deque
+import numpy as np
+from tqdm import tqdm
+
+os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+
+# Only numpy/nibabel/scipy/PIL here, TensorFlow is imported once the preprocessing pool is forked (see main)
+from utils.preprocess_mri_to_png import preprocess_single_file
+from utils.preprocess_pool import PreprocessPool
+
+LABELS = {"control": 0, "ms": 1}
+
+"""
+-----------------------------------------------------------
+Argument parser:
+    - dataset root or manifest CSV, and the output directory
+    - model weights and architecture
+    - slices per volume (or every slice in the brain bounds)
+    - patch stride, inference batch size and precision
+    - how patch scores become slice and patient scores
+    - number of preprocessing processes
+-----------------------------------------------------------
+"""
+def parse_args(args=None):
+    p = argparse.ArgumentParser()
+    source = p.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input", type=str, help="Dataset root folder (contains control/ and ms/)")
+    source.add_argument("--manifest", type=str, help="CSV with a path column (and optional patient_id, label)")
+    p.add_argument("--out", required=True, type=str, help="Output directory")
+    p.add_argument("--weights", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "weights", "cp_mid.weights.h5"))
+    p.add_argument("--filters", default="32,64,128", help="Conv filters of the model (ex: a compressed model)")
+    p.add_argument("--dense_units", default="256,512", help="Dense units of the model")
+    p.add_argument("--n_slices", type=int, default=20, help="Evenly spaced slices scored per volume")
+    p.add_argument("--all_slices", action="store_true", help="Score every slice in the brain bounds instead")
+    p.add_argument("--min_tissue_fraction", type=float, default=None, help="Replace slices with less tissue than this")
+    p.add_argument("--stride", type=int, default=8, help="Step in pixels between patch windows")
+    p.add_argument("--batch_size", type=int, default=1024, help="Patches per inference batch (across volumes)")
+    p.add_argument("--jit_compile", action="store_true", help="XLA compiled inference")
+    p.add_argument("--mixed_precision", action="store_true", help="bfloat16 inference (CPUs with native bf16 only)")
+    p.add_argument("--aggregate", choices=("mean", "max", "top_k"), default="top_k",
+                   help="How patch scores become a slice score and slice scores a patient score")
+    p.add_argument("--patch_k", type=int, default=16, help="Patches averaged per slice with --aggregate top_k")
+    p.add_argument("--slice_k", type=int, default=3, help="Slices averaged per patient with --aggregate top_k")
+    p.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                   help="Preprocessing processes (0 = preprocess in the main process)")
+    p.add_argument("--parquet", action="store_true", help="Also write patients.parquet and slices.parquet")
+    return p.parse_args(args)
+
+"""
+-----------------------------------------------------------
+Function: collect_dataset
+One volume per patient folder of a control/ms dataset root:
+[{"patient_id", "label", "path"}, ...]
+-----------------------------------------------------------
+"""
+def collect_dataset(root):
+    volumes = []
+    for cls, label in LABELS.items():
+        class_in = os.path.join(root, cls)
+        if not os.path.exists(class_in):
+            continue  # Skip if class folder missing
+
+        for pid in sorted(os.listdir(class_in)):
+            patient_dir = os.path.join(class_in, pid)
+            if not os.path.isdir(patient_dir):
+                continue
+
+            nii_files = sorted(f for f in os.listdir(patient_dir) if f.endswith(".nii") or f.endswith(".nii.gz"))
+            if not nii_files:
+                print(f"[WARNING] No NIfTI file for {patient_dir}, skipping")
+                continue
+            volumes.append({"patient_id": pid, "label": label, "path": os.path.join(patient_dir, nii_files[0])})
+    return volumes
+
+"""
+-----------------------------------------------------------
+Function: read_manifest
+Volumes listed in a manifest CSV, paths relative to the CSV.
+Missing labels are -1.
+-----------------------------------------------------------
+"""
+def read_manifest(path):
+    root = os.path.dirname(os.path.abspath(path))
+    volumes = []
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            file_path = row["path"] if os.path.isabs(row["path"]) else os.path.join(root, row["path"])
+            label = (row.get("label") or "").strip().lower()
+            name = os.path.basename(file_path)
+            stem = name[:-len(".nii.gz")] if name.endswith(".nii.gz") else os.path.splitext(name)[0]
+            volumes.append({
+                "patient_id": row.get("patient_id") or stem,
+                "label": LABELS.get(label, int(label) if label.lstrip("-").isdigit() else -1),
+                "path": file_path,
+            })
+    return volumes
+
+"""
+-----------------------------------------------------------
+Function: iter_cohort_slices
+Yields the slices of every volume in order, keeping up to
+<ahead> volumes queued in the pool. The index of the volume each
+slice belongs to is appended to <owners> and the number of
+slices of each volume stored in volume["n_slices"] (0 for volumes
+that failed, their error goes to <failures>).
+-----------------------------------------------------------
+"""
+def iter_cohort_slices(volumes, pool, kwargs, owners, failures, ahead):
+    jobs = deque()
+    submitted = 0
+    try:
+        for i, volume in enumerate(volumes):
+            # keep the pool busy a few volumes ahead of the inference
+            while pool is not None and submitted < min(len(volumes), i + ahead):
+                jobs.append(pool.submit(file_path=volumes[submitted]["path"], **kwargs))
+                submitted += 1
+
+            try:
+                if pool is not None:
+                    slices = pool.result(jobs.popleft())
+                else:
+                    slices = preprocess_single_file(file_path=volume["path"], **kwargs)
+            except Exception as e:
+                print(f"\n[ERROR] Preprocessing failed for {volume['path']}: {e}")
+                failures.append({"patient_id": volume["patient_id"], "path": volume["path"], "error": str(e)})
+                volume["n_slices"] = 0
+                continue
+
+            volume["n_slices"] = len(slices)
+            for img in slices:
+                owners.append(i)
+                yield img
+    finally:
+        # every submitted job has to be collected, or its shared memory block is never freed
+        for job in jobs:
+            try:
+                pool.result(job)
+            except Exception:
+                pass
+
+"""
+-----------------------------------------------------------
+Function: build_model
+Model for the cohort: weights loaded, BatchNormalization folded
+away and wrapped in a PatchPredictor (one tf.function call per
+batch instead of model.predict)
+-----------------------------------------------------------
+"""
+def build_model(args):
+    from models.patch_based_tensor import model_builder, fold_batchnorm, PatchPredictor
+
+    filters = tuple(int(f) for f in args.filters.split(","))
+    dense_units = tuple(int(d) for d in args.dense_units.split(","))
+    model, _, _ = model_builder(32, mixed_precision=args.mixed_precision, filters=filters, dense_units=dense_units)
+    model.load_weights(args.weights)
+    try:
+        model = fold_batchnorm(model, mixed_precision=args.mixed_precision)
+    except ValueError as e:
+        print(f"[WARNING] Could not fold BatchNormalization ({e}), using the original model")
+    return PatchPredictor(model, jit_compile=args.jit_compile)
+
+"""
+-----------------------------------------------------------
+Function: write_outputs
+Writes scores.npz and patients.csv (and the Parquet tables) to
+<out_dir>
+-----------------------------------------------------------
+"""
+def write_outputs(out_dir, volumes, slice_patient, slice_scores, grids, parquet=False):
+    n_slices = np.array([v["n_slices"] for v in volumes], dtype=np.int32)
+    patients = {
+        "patient_id": np.array([v["patient_id"] for v in volumes]),
+        "label": np.array([v["label"] for v in volumes], dtype=np.int8),
+        "path": np.array([v["path"] for v in volumes]),
+        "score": np.array([v["score"] for v in volumes], dtype=np.float32),
+        "n_slices": n_slices,
+        "slice_start": np.concatenate([[0], np.cumsum(n_slices)[:-1]]).astype(np.int64),
+    }
+    slices = {
+        "slice_patient": np.array(slice_patient, dtype=np.int32),
+        "slice_score": np.array(slice_scores, dtype=np.float32),
+        "score_grid": np.stack(grids) if grids else np.zeros((0, 0, 0), dtype=np.float32),
+    }
+    np.savez(os.path.join(out_dir, "scores.npz"), **patients, **slices)
+
+    with open(os.path.join(out_dir, "patients.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, ["patient_id", "label", "score", "n_slices", "path"])
+        writer.writeheader()
+        for v in volumes:
+            writer.writerow({key: v[key] for key in writer.fieldnames})
+
+    if parquet:
+        import pandas as pd
+        pd.DataFrame(patients).to_parquet(os.path.join(out_dir, "patients.parquet"), index=False)
+        pd.DataFrame({
+            "patient_id": patients["patient_id"][slices["slice_patient"]] if len(slice_patient) else [],
+            "slice": np.concatenate([np.arange(n) for n in n_slices]) if len(slice_patient) else [],
+            "score": slices["slice_score"],
+            "score_grid": [grid.reshape(-1) for grid in slices["score_grid"]],
+        }).to_parquet(os.path.join(out_dir, "slices.parquet"), index=False)
+
+def main(args):
+    volumes = collect_dataset(args.input) if args.input else read_manifest(args.manifest)
+    if not volumes:
+        print("[ERROR] No volumes found")
+        return 1
+    os.makedirs(args.out, exist_ok=True)
+
+    # fail now rather than after scoring the whole cohort
+    if args.parquet:
+        import pandas as pd
+        try:
+            pd.io.parquet.get_engine("auto")
+        except ImportError as e:
+            print(f"[ERROR] --parquet needs pyarrow or fastparquet ({e})")
+            return 1
+
+    # CRITICAL: the pool is forked HERE, before TensorFlow is imported, so the workers never contain TensorFlow
+    pool = PreprocessPool(args.workers) if args.workers > 0 else None
+    from models.patch_based_tensor import iter_patch_predictions, warm_up_model, aggregate_scores
+
+    try:
+        print(f"[INFO] Scoring {len(volumes)} volumes with {args.workers} preprocessing process(es)")
+        model = build_model(args)
+
+        # every batch is padded to the one batch size, so a single graph is ever built
+        buckets = (args.batch_size,)
+        warm_up_model(model, patch_size=32, buckets=buckets)
+
+        kwargs = {"n_slices": args.n_slices, "use_all_slices": args.all_slices, "size": 224, "axis": 2,
+                  "min_tissue_fraction": args.min_tissue_fraction}
+        owners = deque()
+        failures = []
+        slices = iter_cohort_slices(volumes, pool, kwargs, owners, failures, ahead=2 * max(1, args.workers))
+
+        grid_side = (224 - 32) // args.stride + 1
+        slice_patient, slice_scores, grids = [], [], []
+        volume_slices = {}    # volume index -> slice scores so far
+        n_patches = 0
+        progress = tqdm(total=len(volumes), unit="volume")
+
+        start = time.perf_counter()
+        for img, coords, preds in iter_patch_predictions(model, slices, patch_size=32, stride=args.stride,
+                                                         batch_size=args.batch_size, buckets=buckets):
+            i = owners.popleft()
+            score = aggregate_scores(preds, args.aggregate, args.patch_k)
+            slice_patient.append(i)
+            slice_scores.append(score)
+            grids.append(preds.reshape(grid_side, grid_side))
+            volume_slices.setdefault(i, []).append(score)
+            n_patches += len(preds)
+
+            # volume complete
+            if len(volume_slices[i]) == volumes[i]["n_slices"]:
+                volumes[i]["score"] = aggregate_scores(volume_slices.pop(i), args.aggregate, args.slice_k)
+                progress.update(1)
+        elapsed = time.perf_counter() - start
+        progress.close()
+    finally:
+        if pool is not None:
+            pool.close()
+
+    # failed volumes have no slices and no score
+    for v in volumes:
+        if v["n_slices"] == 0:
+            v["score"] = float('nan')
+
+    write_outputs(args.out, volumes, slice_patient, slice_scores, grids, parquet=args.parquet)
+
+    scored = len(volumes) - len(failures)
+    summary = {
+        "settings": vars(args),
+        "volumes": len(volumes),
+        "scored": scored,
+        "failures": failures,
+        "slices": len(slice_scores),
+        "patches": n_patches,
+        "seconds": elapsed,
+        "volumes_per_sec": scored / elapsed,
+        "patches_per_sec": n_patches / elapsed,
+    }
+
+    # cohort with both classes known: how well the patient scores separate them
+    labels = np.array([v["label"] for v in volumes])
+    scores = np.array([v["score"] for v in volumes])
+    known = (labels >= 0) & ~np.isnan(scores)
+    if len(np.unique(labels[known])) == 2:
+        from sklearn.metrics import roc_auc_score
+        summary["patient_auc"] = float(roc_auc_score(labels[known], scores[known]))
+
+    with open(os.path.join(args.out, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+
+    print(f"[SUCCESS] Scored {scored}/{len(volumes)} volumes ({len(slice_scores)} slices, {n_patches:,} patches) "
+          f"in {elapsed:.1f}s: {summary['volumes_per_sec']:.2f} volumes/s, {summary['patches_per_sec']:,.0f} patches/s")
+    if "patient_auc" in summary:
+        print(f"[INFO] Patient level ROC AUC: {summary['patient_auc']:.4f}")
+    if failures:
+        print(f"[WARNING] {len(failures)} volume(s) failed, see {os.path.join(args.out, 'summary.json')}")
+    print(f"[INFO] Results written to {args.out}")
+    return 0
+
+if __name__ == "__main__":
+    args = parse_args()
+    raise SystemExit(main(args))
@@ -0,0 +1,225 @@
+"""
+-----------------------------------------------------------
+This module performs the "pre-flight" checks on an uploaded
+NIfTI volume before the API commits to saving and loading it.
+
+Only the header (the first few hundred bytes of the file, or of
+the decompressed stream for .nii.gz) is read. From it we get:
+    - The volume dimensions (and whether it is 4D)
+    - The voxel datatype
+    - The voxel spacing (zooms)
+
+These are used to estimate how much memory and time the request
+will need, so that a malformed or oversized upload is rejected
+before it can take down the single worker.
+
+The parsed header is then passed down to load_volume_get_array
+so the file does not need to be parsed a second time.
+-----------------------------------------------------------
+"""
+
+import io
+import zlib
+import struct
+import numpy as np
+import nibabel as nib
+
+# Size of the NIfTI-1 and NIfTI-2 headers in bytes (the first 4 bytes of the file store this value)
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+
+# How many compressed bytes to pull from a .nii.gz upload to decompress the header
+GZIP_PEEK_BYTES = 64 * 1024
+
+# Datatypes we know how to turn into float32 intensities
+SUPPORTED_DTYPE_KINDS = ("u", "i", "f")
+
+"""
+-----------------------------------------------------------
+Exceptions raised by the pre-flight stage.
+    InvalidVolumeError  -> the upload is not a usable NIfTI volume (HTTP 400)
+    VolumeTooLargeError -> the volume is valid but over the configured limits (HTTP 413)
+-----------------------------------------------------------
+"""
+class InvalidVolumeError(ValueError):
+    pass
+
+class VolumeTooLargeError(ValueError):
+    pass
+
+"""
+-----------------------------------------------------------
+Function: read_nifti_header
+Reads ONLY the header from a binary stream positioned at the start
+of a .nii or .nii.gz file. The stream is rewound afterwards so the
+caller can still save the full upload.
+
+Returns: nibabel Nifti1Header or Nifti2Header
+-----------------------------------------------------------
+"""
+def read_nifti_header(stream, gzipped):
+    start = stream.tell()
+    try:
+        if gzipped:
+            # Decompress only as much as we need for the largest possible header
+            compressed = stream.read(GZIP_PEEK_BYTES)
+            try:
+                raw = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(compressed, NIFTI2_HEADER_SIZE)
+            except zlib.error as e:
+                raise InvalidVolumeError(f"File is not a valid gzip stream: {e}")
+        else:
+            raw = stream.read(NIFTI2_HEADER_SIZE)
+    finally:
+        stream.seek(start)
+
+    if len(raw) < NIFTI1_HEADER_SIZE:
+        raise InvalidVolumeError("File is too small to contain a NIfTI header.")
+
+    # sizeof_hdr tells us both the NIfTI version and the byte order of the file
+    header_class = None
+    for endian in ("<", ">"):
+        sizeof_hdr = struct.unpack(f"{endian}i", raw[:4])[0]
+        if sizeof_hdr == NIFTI1_HEADER_SIZE:
+            header_class = nib.Nifti1Header
+        elif sizeof_hdr == NIFTI2_HEADER_SIZE:
+            header_class = nib.Nifti2Header
+        if header_class is not None:
+            break
+
+    if header_class is None:
+        raise InvalidVolumeError("File does not start with a NIfTI-1 or NIfTI-2 header.")
+    if len(raw) < sizeof_hdr:
+        raise InvalidVolumeError("File is too small to contain a NIfTI-2 header.")
+
+    # Only the fixed-size header is parsed, header extensions are skipped (the data offset still comes from vox_offset)
+    try:
+        header = header_class.from_fileobj(io.BytesIO(raw[:sizeof_hdr]))
+    except Exception as e:
+        raise InvalidVolumeError(f"Could not parse NIfTI header: {e}")
+
+    # Uploads are single files, so the magic string must be the single-file variant ("n+1" / "n+2")
+    if header["magic"].item() != header.single_magic:
+        raise InvalidVolumeError("NIfTI header is not a single-file (.nii) header.")
+
+    return header
+
+"""
+-----------------------------------------------------------
+Function: describe_header
+Pulls the fields we care about out of a parsed header into a
+plain dictionary (also used for logging).
+-----------------------------------------------------------
+"""
+def describe_header(header):
+    shape = tuple(int(d) for d in header.get_data_shape())
+    zooms = tuple(float(z) for z in header.get_zooms()[:3])
+    dtype = header.get_data_dtype()
+
+    return {
+        "shape": shape,
+        "zooms": zooms,
+        "dtype": str(dtype),
+        "is_4d": len(shape) == 4,
+        "n_volumes": shape[3] if len(shape) == 4 else 1,
+        "data_offset": int(header.get_data_offset()),
+        "data_bytes": int(np.prod(shape, dtype=np.int64)) * dtype.itemsize,
+    }
+
+"""
+-----------------------------------------------------------
+Function: validate_header
+Rejects headers that describe something load_volume_get_array
+cannot turn into a 3D volume (wrong number of dimensions, empty
+axes, unusable spacing or an unsupported datatype).
+If the size of the upload is known (uncompressed .nii) it also
+checks that the file actually contains all of the voxel data.
+-----------------------------------------------------------
+"""
+def validate_header(header, upload_bytes=None):
+    info = describe_header(header)
+    shape = info["shape"]
+
+    if len(shape) not in (3, 4):
+        raise InvalidVolumeError(f"Expected a 3D (or 4D) volume, got {len(shape)} dimensions {shape}.")
+    if min(shape) < 1:
+        raise InvalidVolumeError(f"Volume has an empty dimension: {shape}.")
+    if len(shape) == 3 and min(shape) < 3:
+        raise InvalidVolumeError(f"Volume is too thin to be an MRI scan: {shape}.")
+    if not all(np.isfinite(z) and z > 0 for z in info["zooms"]):
+        raise InvalidVolumeError(f"Invalid voxel spacing in header: {info['zooms']}.")
+    if header.get_data_dtype().kind not in SUPPORTED_DTYPE_KINDS:
+        raise InvalidVolumeError(f"Unsupported voxel datatype: {info['dtype']}.")
+
+    # For an uncompressed upload we can detect a truncated file without reading it
+    if upload_bytes is not None and upload_bytes < info["data_offset"] + info["data_bytes"]:
+        raise InvalidVolumeError(
+            f"File is truncated: header describes {info['data_offset'] + info['data_bytes']} bytes "
+            f"but only {upload_bytes} were uploaded."
+        )
+
+    return info
+
+"""
+-----------------------------------------------------------
+Function: estimate_resources
+Estimates the peak memory and wall time that preprocessing and
+inference will need for a volume, using only its header.
+
+Memory model (float32, only the first volume of a 4D file is read):
+    - the volume as loaded                      (voxels * 4 bytes)
+    - the 1mm resampled copy plus the temporaries
+      created while normalizing it              (3 * resampled voxels * 4 bytes)
+    - the preprocessed slices and their patches (small, counted per slice)
+      for <resident_slices> slices held at once (defaults to n_slices)
+
+Time model:
+    seconds = resampled voxels * seconds_per_voxel + patches * seconds_per_patch
+-----------------------------------------------------------
+"""
+def estimate_resources(header, n_slices, size=224, patch_size=32, stride=8,
+                       seconds_per_voxel=2e-8, seconds_per_patch=4e-4, resident_slices=None):
+    info = describe_header(header)
+    dims = np.array(info["shape"][:3], dtype=np.float64)
+    zooms = np.array(info["zooms"], dtype=np.float64)
+
+    voxels = int(np.prod(dims))
+    resampled_voxels = int(np.prod(np.ceil(dims * zooms)))
+
+    # Patches per slice for the sliding window used by predict_patients_slices
+    windows_per_axis = max(0, (size - patch_size) // stride + 1)
+    patches = n_slices * windows_per_axis ** 2
+
+    # float32 slice (size x size x 3), its uint8 copy, and the float32 patches of that slice
+    per_slice_bytes = size * size * 3 * 5 + windows_per_axis ** 2 * patch_size * patch_size * 3 * 4
+    resident_slices = n_slices if resident_slices is None else min(n_slices, resident_slices)
+    memory_bytes = voxels * 4 + 3 * resampled_voxels * 4 + resident_slices * per_slice_bytes
+
+    return {
+        "voxels": voxels,
+        "resampled_voxels": resampled_voxels,
+        "resampled_shape": tuple(int(d) for d in np.ceil(dims * zooms)),
+        "patches": patches,
+        "memory_mb": memory_bytes / (1024 ** 2),
+        "seconds": resampled_voxels * seconds_per_voxel + patches * seconds_per_patch,
+    }
+
+"""
+-----------------------------------------------------------
+Function: check_limits
+Raises VolumeTooLargeError if an estimate from estimate_resources
+is over any of the configured limits (a limit of None is ignored).
+-----------------------------------------------------------
+"""
+def check_limits(plan, max_voxels=None, max_memory_mb=None, max_seconds=None):
+    if max_voxels is not None and plan["resampled_voxels"] > max_voxels:
+        raise VolumeTooLargeError(
+            f"Volume has {plan['resampled_voxels']} voxels after resampling (limit {max_voxels})."
+        )
+    if max_memory_mb is not None and plan["memory_mb"] > max_memory_mb:
+        raise VolumeTooLargeError(
+            f"Volume would need about {plan['memory_mb']:.0f} MB to process (limit {max_memory_mb} MB)."
+        )
+    if max_seconds is not None and plan["seconds"] > max_seconds:
+        raise VolumeTooLargeError(
+            f"Volume would take about {plan['seconds']:.0f}s to process (limit {max_seconds}s)."
+        )
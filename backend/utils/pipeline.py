@@ -0,0 +1,155 @@
+"""
+-----------------------------------------------------------
+Small helpers used by app.py to overlap the stages of a request
+(preprocessing -> inference -> PNG encoding) on separate threads.
+
+Each stage hands its output to the next one through a bounded
+queue, so at most <maxsize> items are waiting between two stages
+no matter how many slices are requested. numpy, scipy and PIL
+release the GIL for most of their heavy work, which is what lets
+the stages actually run at the same time.
+-----------------------------------------------------------
+"""
+
+import queue
+import threading
+
+# How long a blocked put/get waits before checking whether the other side has given up
+POLL_SECONDS = 0.1
+
+# Marks the end of a stream inside a queue
+_DONE = object()
+
+"""
+-----------------------------------------------------------
+Class: _StageError
+Wraps an exception raised inside a background stage so it can
+be re-raised on the thread that consumes the stage's output.
+-----------------------------------------------------------
+"""
+class _StageError:
+    def __init__(self, exc):
+        self.exc = exc
+
+"""
+-----------------------------------------------------------
+Function: _put
+Puts an item into a bounded queue, giving up if <stop> is set
+(the other side of the queue has stopped reading).
+Returns False if the item was not delivered.
+-----------------------------------------------------------
+"""
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+"""
+-----------------------------------------------------------
+Function: prefetch
+Runs <iterable> on a background thread and yields its items in
+the calling thread. At most <maxsize> items are buffered.
+Exceptions from the background thread are re-raised here, and
+closing the generator early stops the background thread.
+-----------------------------------------------------------
+"""
+def prefetch(iterable, maxsize=4, name="prefetch"):
+    q = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def producer():
+        try:
+            for item in iterable:
+                if not _put(q, item, stop):
+                    return
+            _put(q, _DONE, stop)
+        except BaseException as e:
+            _put(q, _StageError(e), stop)
+        finally:
+            # Let a generator release whatever it holds (ex: the loaded volume)
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=producer, name=name, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = q.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _StageError):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+"""
+-----------------------------------------------------------
+Function: map_in_background
+Iterates <iterable> in the calling thread and applies <fn> to each
+item on a background thread. At most <maxsize> items wait between
+the two. Returns the list of fn(item) results, in order.
+-----------------------------------------------------------
+"""
+def map_in_background(fn, iterable, maxsize=4, name="map"):
+    q = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    results = []
+    errors = []
+
+    def consumer():
+        try:
+            while not stop.is_set():
+                try:
+                    item = q.get(timeout=POLL_SECONDS)
+                except queue.Empty:
+                    continue
+                if item is _DONE:
+                    return
+                results.append(fn(item))
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    thread = threading.Thread(target=consumer, name=name, daemon=True)
+    thread.start()
+
+    try:
+        for item in iterable:
+            if not _put(q, item, stop):
+                break  # The consumer failed, its error is raised below
+    except BaseException:
+        # The producing side failed, tell the consumer to drop what is left
+        stop.set()
+        thread.join()
+        raise
+
+    _put(q, _DONE, stop)
+    thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+"""
+-----------------------------------------------------------
+Function: iter_slabs
+Groups the items of <iterable> into lists of at most <slab_size>
+consecutive items (the last slab may be shorter).
+-----------------------------------------------------------
+"""
+def iter_slabs(iterable, slab_size):
+    slab = []
+    for item in iterable:
+        slab.append(item)
+        if len(slab) == slab_size:
+            yield slab
+            slab = []
+    if slab:
+        yield slab
@@ -60,6 +60,8 @@ def parse_args():
     p.add_argument("--validation_percentage", type=float, default=0.3, help="The percentage of patients that you want to be placed in the validation dataset (default for this value is 30%).")
     p.add_argument("--seed", type=int, default=42, help="Random seed for reproducibility.")
     p.add_argument("--cleanup", action="store_true", help="If set, deletes raw split .nii data after preprocessing.")
+    p.add_argument("--patch_format", choices=("png", "shards", "stacks"), default="png",
+                   help="Write patches as PNG files, straight into .npy shards, or keep only slice stacks for on-the-fly patch sampling (--data_format stacks).")
     return p.parse_args()
 
 """
@@ -145,7 +147,7 @@ training and validation. Based on cleanup flag it will either delete the origina
 raw split datasets, or keep them
 -----------------------------------------------------------
 """
-def preprocess_split_datasets(training_root, validation_root, cleanup):
+def preprocess_split_datasets(training_root, validation_root, cleanup, patch_format="png"):
     splits = [("training", training_root), ("Validation", validation_root)]
 
     for split, split_directory in splits:
@@ -160,7 +162,8 @@ def preprocess_split_datasets(training_root, validation_root, cleanup):
         "--input", split_directory,
         "--out", preprocessed_output_directory,
         "--patching",  # Force patching on
-        "--modality", "T1"
+        "--modality", "T1",
+        "--patch_format", patch_format
         ])
 
         preprocess_main(args)
@@ -191,4 +194,4 @@ if __name__ == "__main__":
     )
 
     # Step 2: Preprocess splits
-    preprocess_split_datasets(train_root, val_root, cleanup=args.cleanup)
\ No newline at end of file
+    preprocess_split_datasets(train_root, val_root, cleanup=args.cleanup, patch_format=args.patch_format)
\ No newline at end of file
@@ -30,6 +30,14 @@ Usage:
         --use_25d \
         --size 224 \
         --modality T2 \
+
+    # Preprocess 8 patients at a time, and continue an interrupted run
+    python preprocess_mri_to_pngs.py --input /path/to/ms_T1_dataset \
+        --out /path/to/prepared_pngs/T1 \
+        --modality T1 \
+        --patching \
+        --workers 8 \
+        --resume
 -----------------------------------------------------------
 """
 
@@ -38,13 +46,16 @@ import gc
 import os
 import argparse
 import nibabel as nib # Library for handling medical images (in our case NifTI)
+from nibabel.arrayproxy import ArrayProxy
 import numpy as np
 import csv  # Library for writing the csv file
 import scipy.ndimage
 import traceback
 import shutil
 import datetime
-from sklearn.feature_extraction.image import extract_patches_2d
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from PIL import Image   # Library to save PNGs
 
 """
@@ -60,8 +71,10 @@ Define configurable options such as:
     - output image size
     - which axis to treat as axial (after canonical reorientation)
     - Whether or not to patch the data into smaller pieces for sliding window image model
-    - Size of the patch window (ex: 32x32)
+    - Size of the patch window (ex: 32x32) and the stride between windows
     - Threshold for when we patch as to if a patch is "interesting" (ex: a patch is interesting if 50% or more of the patch image is brain tissue)
+    - Whether patches are written as PNG files, into .npy shards (and the shard size) or sampled later from slice stacks
+    - Number of worker processes, and whether to resume an interrupted run
 -----------------------------------------------------------
 """
 def parse_args(args=None):
@@ -76,6 +89,13 @@ def parse_args(args=None):
     p.add_argument("--patching", action="store_true", help="Select whether you want to further preprocess the resulting slices into patches")
     p.add_argument("--slider_size", type=int, default=32, help="Select the size of the sliding window that goes over the image data to split it into image segments")
     p.add_argument("--threshold", type=float, default=0.5, help="Select the threshold for the minimum amount of black space a patch image can have")
+    p.add_argument("--patch_stride", type=int, default=1, help="Step in pixels between neighbouring patch windows (1 = every window)")
+    p.add_argument("--patch_format", choices=("png", "shards", "stacks"), default="png",
+                   help="Write patches as one PNG each, straight into .npy shards, or only save the slice stacks and "
+                        "their valid windows for on-the-fly patch sampling (with --patching)")
+    p.add_argument("--shard_size", type=int, default=16384, help="Number of patches per .npy shard when --patch_format shards")
+    p.add_argument("--workers", type=int, default=1, help="Number of patients to preprocess in parallel (separate processes)")
+    p.add_argument("--resume", action="store_true", help="Continue in an existing dataset folder, skipping patients that are already up to date")
     return p.parse_args(args)
 
 """
@@ -124,6 +144,55 @@ def choose_indices(z_start, z_end, N):
     indicies = [int(round(z_start + p * (z_end - z_start))) for p in positions]
     return indicies
     
+"""
+-----------------------------------------------------------
+Function: slice_tissue_fraction
+Cheap "how much brain is in this slice" score used to gate
+near-empty slices. For every slice along <axis> it returns the
+fraction of pixels brighter than <level> of the way between the
+darkest and brightest voxel of the (normalized) volume.
+-----------------------------------------------------------
+"""
+def slice_tissue_fraction(arr, axis=2, level=0.1):
+    low, high = arr.min(), arr.max()
+    tissue = arr > low + level * (high - low)
+
+    # Average over the two in-plane axes, leaving one score per slice
+    other_axes = tuple(a for a in range(arr.ndim) if a != axis)
+    return tissue.mean(axis=other_axes)
+
+"""
+-----------------------------------------------------------
+Function: plan_slice_indices
+Slice planner used for inference. Picks N evenly spaced slices
+between z_start and z_end like choose_indices, but:
+    - Repeated indices (when the brain range is short compared
+      to N) are only returned once, so no slice is preprocessed
+      or scored twice
+    - If min_tissue_fraction is set, slices whose tissue fraction
+      is below it are left out and the even spacing is done over
+      the remaining (more informative) slices instead
+If N is None every candidate slice in the range is returned.
+Returns: sorted list of unique slice indices
+-----------------------------------------------------------
+"""
+def plan_slice_indices(arr, z_start, z_end, N, axis=2, min_tissue_fraction=None):
+    candidates = list(range(z_start, z_end + 1))
+
+    # Drop the low-information slices (but never all of them)
+    if min_tissue_fraction is not None:
+        scores = slice_tissue_fraction(arr, axis)
+        informative = [z for z in candidates if scores[z] >= min_tissue_fraction]
+        if informative:
+            candidates = informative
+
+    if N is None:
+        return candidates
+
+    # Evenly spaced positions over the candidate list, each index kept once
+    positions = choose_indices(0, len(candidates) - 1, N)
+    return sorted(set(candidates[p] for p in positions))
+
 """
 -----------------------------------------------------------
 Function: find_brain_bounds
@@ -165,15 +234,27 @@ Function: load_volume_get_array
 Loads a NIfTI MRI, canonicalizes to RAS+, standardizes
 the visual orientation, resamples to 1mm isotropic spacing,
 and normalizes intensities.
+If a header that was already parsed (ex: by the API's
+pre-flight check) is passed in, it is used directly instead
+of parsing the file again.
 Returns: float32 3D NumPy array (H, W, Z)
 -----------------------------------------------------------
 """
-def load_volume_get_array(nifti_path):
+def load_volume_get_array(nifti_path, header=None):
     # --- Step 1. Load the NIfTI volume ---
-    img = nib.load(str(nifti_path))
+    if header is None:
+        img = nib.load(str(nifti_path))
+    else:
+        # Build the image around the existing header, the voxel data is only read on demand
+        img_class = nib.Nifti2Image if isinstance(header, nib.Nifti2Header) else nib.Nifti1Image
+        img = img_class(ArrayProxy(str(nifti_path), header), header.get_best_affine(), header=header)
     orig_axcodes = nib.aff2axcodes(img.affine)
     print(f"[INFO] Original orientation for {os.path.basename(nifti_path)}: {orig_axcodes}")
 
+    # --- Step 1b. For 4D files only read the first volume from disk ---
+    if len(img.shape) == 4:
+        img = img.slicer[:, :, :, 0]
+
     # --- Step 2. Canonicalize to RAS+ ---
     img = nib.as_closest_canonical(img)
 
@@ -202,7 +283,7 @@ def load_volume_get_array(nifti_path):
 
 """
 -----------------------------------------------------------
-Function: process_and_save_volume
+Function: render_volume_slices / process_and_save_volume
 Converts a single MRI volume into multiple PNG slices.
 Steps:
     1. Load and normalize MRI
@@ -211,10 +292,12 @@ Steps:
     4. Create 2.5D triplets or single-channel stacks
     5. Normalize + resize
     6. Save as slice_01.png, slice_02.png, ...
-Returns: number of slices saved
+render_volume_slices does steps 1-5 and returns the PIL images
+(used directly when patches are written to shards).
+process_and_save_volume returns the number of slices saved.
 -----------------------------------------------------------
 """
-def process_and_save_volume(nifti_path, out_dir, n_slices, use_25d, size, axis):
+def render_volume_slices(nifti_path, n_slices, use_25d, size, axis):
     # Load and preprocess the 3D MRI array
     arr = load_volume_get_array(nifti_path)
     
@@ -227,12 +310,16 @@ def process_and_save_volume(nifti_path, out_dir, n_slices, use_25d, size, axis):
     # Choose slice indices evenly spaced between bounds
     inds = choose_indices(z_start, z_end, n_slices)
 
-    # Create the output folder if it doesn’t exist
-    os.makedirs(out_dir, exist_ok=True)
-    count = 0 # Counter for how many slices are saved
+    images = []
+    rendered = {} # Slice index -> resized image, so repeated indices are only computed once
 
      # Loop through each selected slice index
-    for i, idx in enumerate(inds, start=1):
+    for idx in inds:
+        # Short brain ranges can repeat an index, reuse the image we already made
+        if idx in rendered:
+            images.append(rendered[idx])
+            continue
+
          # For 2.5D: pick previous, current, and next slices (edge protected)
         i0 = max(0, idx - 1)
         i1 = idx
@@ -260,7 +347,19 @@ def process_and_save_volume(nifti_path, out_dir, n_slices, use_25d, size, axis):
         # Convert NumPy array → PIL Image and resize to target dimensions
         img = Image.fromarray(trip_u8)
         img = img.resize((size, size), Image.LANCZOS)
+        rendered[idx] = img
+        images.append(img)
 
+    return images
+
+def process_and_save_volume(nifti_path, out_dir, n_slices, use_25d, size, axis):
+    images = render_volume_slices(nifti_path, n_slices, use_25d, size, axis)
+
+    # Create the output folder if it doesn’t exist
+    os.makedirs(out_dir, exist_ok=True)
+    count = 0 # Counter for how many slices are saved
+
+    for i, img in enumerate(images, start=1):
         # Save PNG file into patient folder
         fname = os.path.join(out_dir, f"slice_{i:02d}.png")
         img.save(fname)
@@ -277,7 +376,7 @@ Function: image_splitter
 -----------------------------------------------------------
 """
 
-def image_splitter(out_patient, window_size, threshold):
+def image_splitter(out_patient, window_size, threshold, stride=1):
     for i, file in enumerate(sorted(os.listdir(out_patient))):
         # create patch dir for current slice
         slice_folder = os.path.join(out_patient, f"Slice_{i}")
@@ -290,17 +389,84 @@ def image_splitter(out_patient, window_size, threshold):
         with Image.open(slc_path) as slc: # Using with will cause the file to be closed immediately after reading which helps performance
             slc = np.array(slc)
 
-        # creates a new array of patches with shape (patch#, h, w, ch)
-        patches = extract_patches_2d(slc, (window_size, window_size))
+        # only the "interesting" windows are copied out of the slice, with their index in the full window grid
+        patches, window_ids = select_patches(slc, window_size, threshold, stride)
 
         # save patches to slice dir
-        for j, patch in enumerate(patches):
-            if (image_evaluation(patch, 20, threshold, 40)):
-                Image.fromarray(patch).save(os.path.join(slice_folder, f"patch_{j}.png"))
+        for j, patch in zip(window_ids, patches):
+            Image.fromarray(patch).save(os.path.join(slice_folder, f"patch_{j}.png"))
 
         # Remove the original slice after sucessful patch creation
         os.remove(slc_path)
-        
+
+"""
+-----------------------------------------------------------
+Function: window_sums
+    Sum of <values> over every (window x window) square, computed
+    from an integral image (4 lookups per window instead of
+    window^2 additions). Returns shape (h - window + 1, w - window + 1)
+-----------------------------------------------------------
+"""
+def window_sums(values, window):
+    integral = np.zeros((values.shape[0] + 1, values.shape[1] + 1), dtype=np.int64)
+    integral[1:, 1:] = values.cumsum(axis=0).cumsum(axis=1)
+    return (integral[window:, window:] - integral[:-window, window:]
+            - integral[window:, :-window] + integral[:-window, :-window])
+
+"""
+-----------------------------------------------------------
+Function: select_windows
+    Vectorized version of running image_evaluation on every patch
+    from extract_patches_2d. The tissue fraction and variance of
+    ALL windows are computed at once from integral images, on a
+    grid with the given <stride>.
+Returns: (rows, cols) top-left corner of every accepted window
+-----------------------------------------------------------
+"""
+def select_windows(slc, window_size, min_brain_percentage, stride=1, intensity_threshold=20, var_threshold=40):
+    img = slc if slc.ndim == 3 else slc[..., None]
+    n = window_size * window_size * img.shape[-1]  # values per patch
+
+    # per-pixel totals over the channels, then per-window totals
+    values = img.astype(np.int64)
+    tissue = window_sums((img > intensity_threshold).sum(axis=-1), window_size)
+    total = window_sums(values.sum(axis=-1), window_size)
+    total_sq = window_sums((values * values).sum(axis=-1), window_size)
+
+    # only look at windows on the stride grid
+    tissue = tissue[::stride, ::stride]
+    total = total[::stride, ::stride]
+    total_sq = total_sq[::stride, ::stride]
+
+    # same tests as image_evaluation, var = E[x^2] - E[x]^2 kept in integers (scaled by n^2)
+    accept = (tissue > min_brain_percentage * n) & (n * total_sq - total * total > var_threshold * n * n)
+    rows, cols = np.nonzero(accept)
+    return rows * stride, cols * stride
+
+"""
+-----------------------------------------------------------
+Function: select_patches
+    Copies the windows accepted by select_windows out of the slice.
+Returns:
+    patches    - uint8 array (n_accepted, window, window[, ch])
+    window_ids - index of each patch in the stride-1 window grid
+                 (the same numbering as extract_patches_2d)
+-----------------------------------------------------------
+"""
+def select_patches(slc, window_size, min_brain_percentage, stride=1, intensity_threshold=20, var_threshold=40):
+    img = slc if slc.ndim == 3 else slc[..., None]
+    w = img.shape[1]
+    rows, cols = select_windows(slc, window_size, min_brain_percentage, stride, intensity_threshold, var_threshold)
+
+    # copy out only the accepted windows: (k, ch, w, w) -> (k, w, w, ch)
+    windows = np.lib.stride_tricks.sliding_window_view(img, (window_size, window_size), axis=(0, 1))
+    patches = windows[rows, cols].transpose(0, 2, 3, 1)
+    if slc.ndim == 2:
+        patches = patches[..., 0]
+
+    window_ids = rows * (w - window_size + 1) + cols
+    return np.ascontiguousarray(patches), window_ids
+
 """
 -----------------------------------------------------------
 Function:
@@ -322,46 +488,130 @@ def image_evaluation(patch, intensity_threshold, min_brain_percentage, var_thres
 
 """
 -----------------------------------------------------------
-Function: preprocess_single_file
-Lightweight version of the preprocessing pipeline for inference.
-    Works on ONE .nii file and returns a NumPy array of preprocessed slices.
-    Called by app.py for the testing pipeline
+Class: PatchShardWriter
+    Writes accepted patches straight into uncompressed .npy
+    shards of (up to) <shard_size> patches each, instead of one
+    PNG file per patch:
+        <out_dir>/patches_00000.npy   uint8 (n, w, w, 3)
+        <out_dir>/patches_00001.npy   ...
+    Each shard is saved to a temp file and renamed into place.
+    close() returns [{"file": ..., "n_patches": ...}, ...] with
+    paths relative to <root>, used to build the shard index.
+-----------------------------------------------------------
+"""
+class PatchShardWriter:
+    def __init__(self, out_dir, root, shard_size=16384):
+        self.out_dir = out_dir
+        self.root = root
+        self.shard_size = shard_size
+        self.buffer = []     # patch arrays waiting to be written
+        self.buffered = 0
+        self.shards = []
+        os.makedirs(out_dir, exist_ok=True)
 
-    Args:
-        file_path (str or Path): path to a single .nii or .nii.gz file
-        n_slices (int): number of slices to extract
-        use_25d (bool): whether to use 2.5D (3-channel) triplets
-        size (int): target slice size (square)
-        axis (int): axis to treat as axial (2 = default)
-    
-    Returns:
-        np.ndarray: array of shape (n_slices, size, size, 3)
+    def add(self, patches):
+        if len(patches) == 0:
+            return
+        self.buffer.append(patches)
+        self.buffered += len(patches)
+        while self.buffered >= self.shard_size:
+            self._write(self.shard_size)
+
+    def _write(self, n):
+        data = np.concatenate(self.buffer) if len(self.buffer) > 1 else self.buffer[0]
+        shard, rest = data[:n], data[n:]
+        self.buffer = [rest] if len(rest) else []
+        self.buffered = len(rest)
+
+        path = os.path.join(self.out_dir, f"patches_{len(self.shards):05d}.npy")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(shard, dtype=np.uint8))
+        os.replace(tmp_path, path)
+        self.shards.append({"file": os.path.relpath(path, self.root), "n_patches": int(len(shard))})
+
+    def close(self):
+        if self.buffered:
+            self._write(self.buffered)
+        return self.shards
+
+"""
+-----------------------------------------------------------
+Function: split_into_shards
+    Same patch selection as image_splitter, but works on the
+    in-memory slices and writes the accepted patches to shards.
+    No slice or patch PNGs are written.
+Returns: shard list from PatchShardWriter.close()
+-----------------------------------------------------------
+"""
+def split_into_shards(images, out_patient, root, window_size, threshold, shard_size, stride=1):
+    writer = PatchShardWriter(out_patient, root, shard_size)
+    for img in images:
+        # keep only the "interesting" patches
+        patches, _ = select_patches(np.asarray(img), window_size, threshold, stride)
+        writer.add(patches)
+    return writer.close()
+
+"""
+-----------------------------------------------------------
+Function: save_slice_stack
+    Instead of writing patches, saves the patient's slices as one
+    stack plus the list of windows that pass the same patch filter,
+    so patches can be cut out at training time:
+        <out_patient>/slices.npy    uint8 (n_slices, size, size, 3)
+        <out_patient>/windows.npy   int32 (n_windows, 3) rows of
+                                    (slice index, top row, left col)
+Returns: {"slices", "windows", "n_slices", "n_windows"} with paths
+         relative to <root>, used to build the stack index.
+-----------------------------------------------------------
+"""
+def save_slice_stack(images, out_patient, root, window_size, threshold, stride=1):
+    stack = np.stack([np.asarray(img, dtype=np.uint8) for img in images])
+
+    windows = []
+    for i, slc in enumerate(stack):
+        rows, cols = select_windows(slc, window_size, threshold, stride)
+        windows.append(np.stack([np.full_like(rows, i), rows, cols], axis=1))
+    windows = np.concatenate(windows).astype(np.int32) if windows else np.empty((0, 3), dtype=np.int32)
+
+    entry = {"n_slices": int(len(stack)), "n_windows": int(len(windows))}
+    for key, arr in [("slices", stack), ("windows", windows)]:
+        path = os.path.join(out_patient, f"{key}.npy")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, arr)
+        os.replace(tmp_path, path)
+        entry[key] = os.path.relpath(path, root)
+    return entry
+
+"""
+-----------------------------------------------------------
+Function: iter_slice_images
+Generator behind preprocess_single_file. Loads ONE .nii file and
+yields the selected slices one at a time as resized PIL images,
+so callers can start working on the first slice while the rest
+are still being prepared.
 -----------------------------------------------------------
 """
-def preprocess_single_file(file_path, n_slices=20, use_25d=False, size=224, axis=2, out_dir=None, use_all_slices=False):
+def iter_slice_images(file_path, n_slices=20, use_25d=False, size=224, axis=2, use_all_slices=False, header=None,
+                      min_tissue_fraction=None):
     # Step 1: Load and preprocess the MRI volume as a numpy array
-    arr = load_volume_get_array(file_path)
+    arr = load_volume_get_array(file_path, header=header)
 
     # Step 2: Remove the slices where there is little to no tissue in the scan
     z_start, z_end = find_brain_bounds(arr, axis)
     z = arr.shape[axis]
 
-    # Either use ALL slices in brain bounds OR sample n evenly spaced slices
+    # Either use ALL slices in brain bounds OR sample n evenly spaced slices (each unique slice once)
     if use_all_slices:
-        indices = list(range(z_start, z_end + 1)) # Include every slice
+        indices = plan_slice_indices(arr, z_start, z_end, None, axis, min_tissue_fraction)
         print(f"[INFO] Using all {len(indices)} slices between bounds [{z_start}, {z_end}]")
     else:
-        indices = choose_indices(z_start, z_end, n_slices)
-        print(f"[INFO] Sampling {n_slices} evenly spaced slices")
+        indices = plan_slice_indices(arr, z_start, z_end, n_slices, axis, min_tissue_fraction)
+        print(f"[INFO] Sampling {len(indices)} unique evenly spaced slices (requested {n_slices})")
 
-    # Step 4: If an output directory is specified, create it (this would be only for debugging or visualization)
-    if out_dir is not None:
-        os.makedirs(out_dir, exist_ok=True)
-
-    slices_out = []
-
-    # Step 5: Iterate over each selected index of the brain scan
-    for i, index in enumerate(indices): # If we use 2.5D we get the previous, current, and next slice to make a "2.5D triplet"
+    # Step 3: Iterate over each selected index of the brain scan
+    for index in indices: # If we use 2.5D we get the previous, current, and next slice to make a "2.5D triplet"
 
         # Compute neighbor slice indicies with boundary protection
         i0 = max(0, index - 1) # Previous slice
@@ -374,7 +624,7 @@ def preprocess_single_file(file_path, n_slices=20, use_25d=False, size=224, axis
         elif axis == 1:
             s0, s1, s2 = arr[:, i0, :], arr[:, i1, :], arr[:, i2, :]
         else: # Axis = 0
-            s0, s1, s2 = arr[i0, :, :], arr[i1, :, :]
+            s0, s1, s2 = arr[i0, :, :], arr[i1, :, :], arr[i2, :, :]
 
         # Create triplet or grayscale stack
         if use_25d:
@@ -382,109 +632,308 @@ def preprocess_single_file(file_path, n_slices=20, use_25d=False, size=224, axis
         else:
             triplet = np.stack([s1, s1, s1], axis=-1)
 
-        # Step 7: Normalize from raw MRI intensities -> uint8 (0-255)
+        # Step 4: Normalize from raw MRI intensities -> uint8 (0-255)
         trip_u8 = normalize_triplet_to_uint8(triplet)
         img = Image.fromarray(trip_u8) # Convert to PIL image for resizing
 
-        # Step 8: Resize slice to model's fixed input resolution (ex: 224 x 224)
-        img = img.resize((size, size), Image.LANCZOS)
+        # Step 5: Resize slice to model's fixed input resolution (ex: 224 x 224)
+        yield img.resize((size, size), Image.LANCZOS)
+
+"""
+-----------------------------------------------------------
+Function: iter_preprocessed_slices
+Streaming version of preprocess_single_file: yields each slice as
+a float32 array of shape (size, size, 3) as soon as it is ready.
+Used by app.py to overlap preprocessing with inference.
+-----------------------------------------------------------
+"""
+def iter_preprocessed_slices(file_path, n_slices=20, use_25d=False, size=224, axis=2, use_all_slices=False, header=None,
+                             min_tissue_fraction=None):
+    for img in iter_slice_images(file_path, n_slices, use_25d, size, axis, use_all_slices, header, min_tissue_fraction):
+        yield np.asarray(img, dtype=np.float32)
+
+"""
+-----------------------------------------------------------
+Function: preprocess_single_file
+Lightweight version of the preprocessing pipeline for inference.
+    Works on ONE .nii file and returns a NumPy array of preprocessed slices.
+    Called by app.py for the testing pipeline
 
-        # Step 9: Either save slice as PNG (for debugging) OR store it in-memory to retur as NumPy arrays
+    Args:
+        file_path (str or Path): path to a single .nii or .nii.gz file
+        n_slices (int): number of slices to extract
+        use_25d (bool): whether to use 2.5D (3-channel) triplets
+        size (int): target slice size (square)
+        axis (int): axis to treat as axial (2 = default)
+        header (nibabel header, optional): header already parsed by the caller
+        min_tissue_fraction (float, optional): skip slices with less tissue than this
+    
+    Returns:
+        np.ndarray: array of shape (n_unique_slices, size, size, 3)
+        (repeated slice indices are only returned once, so this can be fewer than n_slices)
+-----------------------------------------------------------
+"""
+def preprocess_single_file(file_path, n_slices=20, use_25d=False, size=224, axis=2, out_dir=None, use_all_slices=False, header=None,
+                           min_tissue_fraction=None):
+    # If an output directory is specified, create it (this would be only for debugging or visualization)
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+
+    slices_out = []
+
+    for i, img in enumerate(iter_slice_images(file_path, n_slices, use_25d, size, axis, use_all_slices, header,
+                                              min_tissue_fraction)):
+        # Either save slice as PNG (for debugging) OR store it in-memory to retur as NumPy arrays
         if out_dir is not None:
             img.save(os.path.join(out_dir, f"slice_{i:03d}.png"))
         else:
             # Store as float32 array for neural network input
             slices_out.append(np.asarray(img, dtype=np.float32))
 
-    # Step 10: Return all collected slices (if not saving to a disk) (shape: n_slices, size, size, 3)
+    # Return all collected slices (if not saving to a disk) (shape: n_slices, size, size, 3)
     if out_dir is None:
         return np.stack(slices_out, axis=0)
     else:
         return None
 
+"""
+-----------------------------------------------------------
+Resumable preprocessing
+Every finished patient gets a small JSON marker in
+<out_root>/_progress/ holding its manifest row and a cache key
+(hash of the input file + the preprocessing parameters).
+Markers are written atomically (temp file + rename), so a patient
+either has a complete marker or is redone on the next run.
+On restart, patients whose marker matches their key are skipped.
+-----------------------------------------------------------
+"""
+PROGRESS_DIR = "_progress"
+
+# Arguments that change the output of a patient (part of the cache key)
+CACHE_PARAMS = ["modality", "n_slices", "use_25d", "size", "axis", "patching", "slider_size", "threshold",
+                "patch_format", "shard_size", "patch_stride"]
+
+# Index of every patch shard (written by main when --patch_format shards)
+SHARD_INDEX = "patch_shards.csv"
+
+# Index of every slice stack (written by main when --patch_format stacks)
+STACK_INDEX = "slice_stacks.csv"
+
+"""
+-----------------------------------------------------------
+Function: hash_file
+SHA-256 of a file, read in 1MB chunks
+-----------------------------------------------------------
+"""
+def hash_file(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+"""
+-----------------------------------------------------------
+Function: patient_cache_key
+Key that changes whenever the input volume or any parameter
+that affects the output changes
+-----------------------------------------------------------
+"""
+def patient_cache_key(nii_file, args):
+    params = {name: getattr(args, name, None) for name in CACHE_PARAMS}
+    payload = hash_file(nii_file) + json.dumps(params, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+"""
+-----------------------------------------------------------
+Function: write_json_atomic
+Writes JSON to a temp file next to <path> and renames it into
+place, so readers never see a half-written file
+-----------------------------------------------------------
+"""
+def write_json_atomic(path, data):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+"""
+-----------------------------------------------------------
+Function: process_patient
+Runs the whole pipeline for ONE patient (called from a worker
+process by main). Skips the patient if its completion marker is
+up to date. Returns (marker, skipped), where the marker holds
+the manifest row and the patient's patch shards or slice stack (if any)
+-----------------------------------------------------------
+"""
+def process_patient(job):
+    cls, pid, nii_file, out_root, args = job
+    out_patient = os.path.join(out_root, cls, pid)  # Where to save this patient’s slices
+    marker_path = os.path.join(out_root, PROGRESS_DIR, f"{cls}_{pid}.json")
+
+    # Skip patients that were already finished with the same input and parameters
+    key = patient_cache_key(nii_file, args)
+    if os.path.exists(marker_path):
+        with open(marker_path) as f:
+            marker = json.load(f)
+        if marker.get("key") == key:
+            return marker, True
+
+    # Start from an empty folder so output from an interrupted run is not mixed in
+    if os.path.exists(out_patient):
+        shutil.rmtree(out_patient)
+    os.makedirs(out_patient, exist_ok=True)
+
+    shards = []
+    stack = None
+    if args.patching and getattr(args, "patch_format", "png") == "stacks":
+        # Keep the slices in one array, patches are sampled from it during training
+        images = render_volume_slices(nii_file, args.n_slices, args.use_25d, args.size, args.axis)
+        stack = save_slice_stack(images, out_patient, out_root, args.slider_size, args.threshold, args.patch_stride)
+        n_written = len(images)
+    elif args.patching and getattr(args, "patch_format", "png") == "shards":
+        # Patch the in-memory slices straight into shards, no PNGs are written
+        images = render_volume_slices(nii_file, args.n_slices, args.use_25d, args.size, args.axis)
+        shards = split_into_shards(images, out_patient, out_root, args.slider_size, args.threshold, args.shard_size,
+                                   args.patch_stride)
+        n_written = len(images)
+    else:
+        # Process MRI and save PNGs
+        n_written = process_and_save_volume(
+            nii_file, out_patient, args.n_slices, args.use_25d, args.size, args.axis
+        )
+
+        # Split saved slices into smaller image patches if the args.patching is true
+        if args.patching:
+            image_splitter(out_patient, args.slider_size, args.threshold, args.patch_stride)
+
+    # One row of metadata for this patient
+    row = {
+        "patient_id": pid,
+        "label": 1 if cls == "ms" else 0,
+        "modality": args.modality,
+        "slice_dir": os.path.abspath(out_patient),
+        "n_slices": n_written
+    }
+
+    # Mark the patient as complete only once all of its output exists
+    marker = {"key": key, "row": row, "shards": shards, "stack": stack}
+    write_json_atomic(marker_path, marker)
+    gc.collect()
+    return marker, False
+
 """
 -----------------------------------------------------------
 Function: main
 Top-level function that coordinates the whole pipeline.
-It loops through every patient, processes each scan,
-and writes all results to a manifest.csv file.
+It finds every patient, processes the scans in parallel
+(--workers processes), and writes all results to a
+manifest.csv file. A failed patient no longer throws away
+the others: finished patients keep their output and are
+skipped when the run is repeated.
 -----------------------------------------------------------
 """
 
 def main(args):
     root = args.input   # Root dataset directory (contains “control” and “ms”)
     out_root = args.out # Output directory for PNGs + manifest
-    rows = []           # Will store metadata for CSV
-    iterations = 0
-    try:
-        # Iterate through both possible class labels
-        for cls in ["control", "ms"]:
-            class_in = os.path.join(root, cls)
-            if not os.path.exists(class_in):
-                continue  # Skip if class folder missing
-
-            # Each patient folder inside contains one MRI (.nii) file
-            for pid in sorted(os.listdir(class_in)):
-                iterations += 1
-                patient_dir = os.path.join(class_in, pid)
-                if not os.path.isdir(patient_dir):
-                    continue
-
-                nii_files = [f for f in os.listdir(patient_dir) if f.endswith(".nii") or f.endswith(".nii.gz")]
-                if not nii_files:
-                    print(f"[WARNING] No NIfTI file for {patient_dir}, skipping")
+    os.makedirs(os.path.join(out_root, PROGRESS_DIR), exist_ok=True)
+
+    # Collect one job per patient
+    jobs = []
+    for cls in ["control", "ms"]:
+        class_in = os.path.join(root, cls)
+        if not os.path.exists(class_in):
+            continue  # Skip if class folder missing
+
+        # Each patient folder inside contains one MRI (.nii) file
+        for pid in sorted(os.listdir(class_in)):
+            patient_dir = os.path.join(class_in, pid)
+            if not os.path.isdir(patient_dir):
+                continue
+
+            nii_files = [f for f in os.listdir(patient_dir) if f.endswith(".nii") or f.endswith(".nii.gz")]
+            if not nii_files:
+                print(f"[WARNING] No NIfTI file for {patient_dir}, skipping")
+                continue
+
+            jobs.append((cls, pid, os.path.join(patient_dir, nii_files[0]), out_root, args))
+
+    markers = [None] * len(jobs)  # Finished patients, kept in the same order as the jobs
+    failures = []
+
+    def record(i, outcome):
+        cls, pid = jobs[i][0], jobs[i][1]
+        try:
+            marker, skipped = outcome()
+        except Exception:
+            print(f"\n[ERROR] Preprocessing failed for patient {pid} ({cls}):")
+            print(traceback.format_exc())
+            failures.append(f"{cls}/{pid}")
+            return
+        markers[i] = marker
+        row = marker["row"]
+        status = "Up to date" if skipped else "Wrote"
+        print(f"{status} patient {pid} ({cls}, {args.modality}): slices={row['n_slices']}")
+
+    workers = max(1, getattr(args, "workers", 1))
+    print(f"[INFO] Preprocessing {len(jobs)} patients with {workers} worker(s)")
+
+    if workers == 1:
+        for i, job in enumerate(jobs):
+            record(i, lambda: process_patient(job))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(process_patient, job): i for i, job in enumerate(jobs)}
+            for future in as_completed(futures):
+                record(futures[future], future.result)
+
+    # ---------- Write manifest.csv (finished patients only) ----------
+    manifest_path = os.path.join(out_root, "manifest.csv")
+    tmp_path = f"{manifest_path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w", newline="") as f:
+        fieldnames = ["patient_id", "label", "modality", "slice_dir", "n_slices"]
+        writer = csv.DictWriter(f, fieldnames)
+        writer.writeheader()
+        for marker in markers:
+            if marker is not None:
+                writer.writerow(marker["row"])
+    os.replace(tmp_path, manifest_path)
+
+    # ---------- Write the shard index (one row per shard) ----------
+    if args.patching and getattr(args, "patch_format", "png") == "shards":
+        index_path = os.path.join(out_root, SHARD_INDEX)
+        tmp_path = f"{index_path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, ["file", "n_patches", "label", "patient_id"])
+            writer.writeheader()
+            for marker in markers:
+                if marker is None:
                     continue
-
-                nii_file = os.path.join(patient_dir, nii_files[0])
-                out_patient = os.path.join(out_root, cls, pid)  # Where to save this patient’s slices
-                os.makedirs(out_patient, exist_ok=True)
-
-                # Process MRI and save PNGs
-                n_written = process_and_save_volume(
-                    nii_file, out_patient, args.n_slices, args.use_25d, args.size, args.axis
-                )
-
-                # Split saved slices into smaller image patches if the args.patching is true
-                if args.patching:
-                    image_splitter(out_patient, args.slider_size, args.threshold)
-
-                # Store one row of metadata for this patient
-                rows.append({
-                    "patient_id": pid,
-                    "label": 1 if cls == "ms" else 0,
-                    "modality": args.modality,
-                    "slice_dir": os.path.abspath(out_patient),
-                    "n_slices": n_written
-                })
-
-                print(f"Wrote patient {pid} ({cls}, {args.modality}): slices={n_written}")
-                if iterations % 10 == 0:
-                    gc.collect()
-                    
-
-        # ---------- Write manifest.csv ----------
-        os.makedirs(out_root, exist_ok=True)
-        manifest_path = os.path.join(out_root, "manifest.csv")
-        with open(manifest_path, "w", newline="") as f:
-            fieldnames = ["patient_id", "label", "modality", "slice_dir", "n_slices"]
-            writer = csv.DictWriter(f, fieldnames)
+                for shard in marker["shards"]:
+                    writer.writerow({**shard, "label": marker["row"]["label"], "patient_id": marker["row"]["patient_id"]})
+        os.replace(tmp_path, index_path)
+
+    # ---------- Write the stack index (one row per patient) ----------
+    if args.patching and getattr(args, "patch_format", "png") == "stacks":
+        index_path = os.path.join(out_root, STACK_INDEX)
+        tmp_path = f"{index_path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, ["slices", "windows", "n_slices", "n_windows", "label", "patient_id"])
             writer.writeheader()
-            for r in rows:
-                writer.writerow(r)
+            for marker in markers:
+                if marker is None or not marker.get("stack"):
+                    continue
+                writer.writerow({**marker["stack"], "label": marker["row"]["label"], "patient_id": marker["row"]["patient_id"]})
+        os.replace(tmp_path, index_path)
 
-        print("Done. Prepared PNGs + manifest at:", out_root)
-    
-    except Exception as e:
-        print("\n[ERROR] Preprocessing failed due to an unexpected error:")
-        print(traceback.format_exc())
+    if failures:
+        # Finished patients are kept, re-running with --resume only redoes the failed ones
+        raise RuntimeError(f"Preprocessing failed for {len(failures)} patient(s): {', '.join(failures)}")
 
-        # Cleanup partially written output
-        if os.path.exists(out_root):
-            print(f"[CLEANUP] Removing incomplete output directory: {out_root}")
-            shutil.rmtree(out_root, ignore_errors=True)
-
-        # Re-raise to make sure CLI sees the failure
-        raise e
+    print("Done. Prepared PNGs + manifest at:", out_root)
 
 """
 -----------------------------------------------------------
@@ -502,22 +951,23 @@ if __name__ == "__main__":
     dataset_name = f"preprocessed_{args.modality}_dataset"
     dataset_root = os.path.join(args.out, dataset_name)
 
-    try:
-        os.makedirs(dataset_root, exist_ok=False)
-    except FileExistsError:
-        print(f"[WARNING] Folder {dataset_root} already exists — using unique fallback name.")
-        dataset_root += "_dup"
-        os.makedirs(dataset_root, exist_ok=True)
+    if args.resume and os.path.isdir(dataset_root):
+        # Keep going in the existing folder, finished patients are skipped
+        print(f"[INFO] Resuming in existing dataset root folder: {dataset_root}")
+    else:
+        try:
+            os.makedirs(dataset_root, exist_ok=False)
+        except FileExistsError:
+            print(f"[WARNING] Folder {dataset_root} already exists — using unique fallback name.")
+            dataset_root += "_dup"
+            os.makedirs(dataset_root, exist_ok=True)
+        print(f"[INFO] Created dataset root folder: {dataset_root}")
 
     # Update args.out so that the rest of the pipeline writes into that folder
     args.out = dataset_root
 
-    print(f"[INFO] Created dataset root folder: {dataset_root}")
-
     try:
         main(args)
     except Exception as e:
-        print("[ERROR] Pipeline failed — cleaning up dataset root folder.")
-        if os.path.exists(dataset_root):
-            shutil.rmtree(dataset_root, ignore_errors=True)
+        print("[ERROR] Pipeline failed — finished patients were kept, re-run with --resume to continue.")
         raise e
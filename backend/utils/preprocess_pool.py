@@ -0,0 +1,120 @@
+"""
+-----------------------------------------------------------
+Optional process pool for the API's volume preprocessing.
+
+preprocess_single_file is pure CPU work (zoom, percentiles,
+resizing) and holds the GIL for much of it, so when it runs in a
+request thread it slows down the other gthread thread and the
+inference it is doing. With the pool, preprocessing runs in a
+separate process (on another core) and the request thread only
+waits for the result.
+
+The slice stack is handed back through multiprocessing.shared_memory
+rather than being pickled: the worker writes the array into a
+shared block and only its name, shape and dtype travel back.
+
+IMPORTANT: the pool uses fork, so it must be created BEFORE
+TensorFlow is imported (see app.py). The forked workers then
+only contain numpy/nibabel/scipy/PIL and never touch TensorFlow.
+-----------------------------------------------------------
+"""
+
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+from utils.preprocess_mri_to_png import preprocess_single_file
+
+"""
+-----------------------------------------------------------
+Function: _create_untracked_block
+Creates a shared memory block that the worker's resource tracker
+will not try to clean up, since ownership passes to the parent
+process (which unlinks it once the array has been read).
+-----------------------------------------------------------
+"""
+def _create_untracked_block(size):
+    try:
+        # Python 3.13+
+        return shared_memory.SharedMemory(create=True, size=size, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+"""
+-----------------------------------------------------------
+Function: _preprocess_job
+Runs in a pool worker. Preprocesses one volume and copies the
+slice stack into a new shared memory block.
+Returns (block name, shape, dtype string), or None when the
+slices were written to out_dir instead of being returned.
+-----------------------------------------------------------
+"""
+def _preprocess_job(kwargs):
+    arr = preprocess_single_file(**kwargs)
+    if arr is None:
+        return None
+
+    shm = _create_untracked_block(max(1, arr.nbytes))
+    try:
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    return shm.name, arr.shape, arr.dtype.str
+
+"""
+-----------------------------------------------------------
+Function: _take_shared_array
+Runs in the parent. Attaches to a block made by _preprocess_job,
+copies the array out (a single memcpy) and frees the block.
+-----------------------------------------------------------
+"""
+def _take_shared_array(name, shape, dtype):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        # The view must be released before the block can be closed
+        view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        arr = view.copy()
+        del view
+        return arr
+    finally:
+        shm.close()
+        shm.unlink()
+
+"""
+-----------------------------------------------------------
+Class: PreprocessPool
+    pool = PreprocessPool(workers=1)      # before importing TensorFlow!
+    slices = pool.preprocess(file_path=..., n_slices=20, ...)
+Takes the same keyword arguments as preprocess_single_file.
+To keep several volumes in flight, submit() them and collect each
+one with result() (every submitted job must be collected, or its
+shared memory block is never freed).
+-----------------------------------------------------------
+"""
+class PreprocessPool:
+    def __init__(self, workers):
+        self.workers = workers
+        self._pool = multiprocessing.get_context("fork").Pool(processes=workers)
+
+    def preprocess(self, **kwargs):
+        return self.result(self.submit(**kwargs))
+
+    def submit(self, **kwargs):
+        # Queues one volume and returns at once
+        return self._pool.apply_async(_preprocess_job, (kwargs,))
+
+    def result(self, job):
+        # The calling thread blocks here without holding the GIL
+        result = job.get()
+        if result is None:
+            return None
+        return _take_shared_array(*result)
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
@@ -0,0 +1,113 @@
+"""
+-----------------------------------------------------------
+Disk-backed store for per-slice outputs (raw slice, overlay, ...).
+
+Used by the full-volume mode of /predict: every slice of the brain
+is rendered as soon as its predictions are ready and appended to
+one flat binary file per output, so the number of slices held in
+RAM does not grow with the size of the volume. Once all slices are
+written the files are read back through np.memmap, one slice at a
+time, while the response is streamed to the client.
+-----------------------------------------------------------
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import numpy as np
+
+"""
+-----------------------------------------------------------
+Class: SliceStore
+    store = SliceStore(keys=("raw", "overlay"))
+    store.append(raw=img, overlay=overlay)   # once per slice, in order
+    store[i]  -> {"raw": array, "overlay": array}
+    store.close()                             # deletes the files
+-----------------------------------------------------------
+"""
+class SliceStore:
+    def __init__(self, keys, directory=None):
+        self.keys = tuple(keys)
+        self._owns_dir = directory is None
+        self.directory = tempfile.mkdtemp(prefix="slice_store_") if directory is None else directory
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._files = {key: open(os.path.join(self.directory, f"{key}.bin"), "wb") for key in self.keys}
+        self._specs = {}      # key -> (shape, dtype) of a single slice
+        self._maps = None     # key -> np.memmap, opened on first read
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    # Write the outputs of the next slice to disk
+    def append(self, **arrays):
+        if set(arrays) != set(self.keys):
+            raise KeyError(f"Expected outputs {self.keys}, got {tuple(arrays)}")
+
+        with self._lock:
+            if self._maps is not None:
+                raise RuntimeError("Cannot append to a SliceStore after it has been read")
+
+            for key in self.keys:
+                arr = np.ascontiguousarray(arrays[key])
+                spec = (arr.shape, arr.dtype)
+                if self._specs.setdefault(key, spec) != spec:
+                    raise ValueError(f"Slice output '{key}' changed shape/dtype: {self._specs[key]} -> {spec}")
+                self._files[key].write(arr.tobytes())
+            self._count += 1
+
+    # Finish writing and map the files for reading
+    def _open_maps(self):
+        with self._lock:
+            if self._maps is None:
+                for f in self._files.values():
+                    f.close()
+                self._maps = {}
+                for key in self.keys:
+                    if self._count == 0:
+                        continue
+                    shape, dtype = self._specs[key]
+                    self._maps[key] = np.memmap(os.path.join(self.directory, f"{key}.bin"),
+                                                dtype=dtype, mode="r", shape=(self._count,) + shape)
+        return self._maps
+
+    def __getitem__(self, i):
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        maps = self._open_maps()
+        return {key: maps[key][i] for key in self.keys}
+
+    # Close the files and remove the store's directory
+    def close(self):
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._maps = None
+            if self._owns_dir:
+                shutil.rmtree(self.directory, ignore_errors=True)
+
+"""
+-----------------------------------------------------------
+Function: plan_slab_size
+Works out how many slices can be in flight at once (the slab size)
+so that the slices, their patches and their rendered outputs stay
+under <memory_limit_mb>. Two slabs are counted because the next
+slab is preprocessed while the current one is being scored.
+-----------------------------------------------------------
+"""
+def plan_slab_size(memory_limit_mb, size=224, patch_size=32, stride=8, max_slab=64):
+    windows_per_axis = max(1, (size - patch_size) // stride + 1)
+    pixels = size * size
+
+    per_slice = (
+        pixels * 3 * 4 +                                        # float32 slice from preprocessing
+        pixels * 3 +                                            # uint8 copy used for patches and the raw image
+        windows_per_axis ** 2 * patch_size * patch_size * 3 +   # uint8 patches
+        pixels * 4 * 6 +                                        # float heatmap buffers while rendering
+        pixels * 3 * 2                                          # uint8 overlay + heatmap
+    )
+    slab = int(memory_limit_mb * 1024 ** 2 // (2 * per_slice))
+    return max(1, min(max_slab, slab))